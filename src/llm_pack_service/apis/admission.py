@@ -0,0 +1,182 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+from itertools import count
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+from . import metrics
+from .error import get_error_response
+from .lifecycle import lifecycle
+
+# 是否启用准入控制
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# 请求体不超过该字节数的请求视为短请求, 排队时优先放行
+ADMISSION_SHORT_REQUEST_BYTES = int(os.getenv("ADMISSION_SHORT_REQUEST_BYTES", "4096"))
+# 被拒绝时建议客户端等待的秒数
+ADMISSION_RETRY_AFTER = os.getenv("ADMISSION_RETRY_AFTER", "5")
+
+# 各请求池的默认(并发数, 等待队列长度, 最长等待秒数), 按1核1G的容器估算
+DEFAULT_POOLS = {
+    "chat_stream": (64, 128, 5.0),
+    "chat": (32, 64, 10.0),
+    "image": (8, 16, 15.0),
+    "audio": (4, 8, 15.0),
+}
+
+# 路径到请求池的映射, 对话按stream参数再区分; 图像任务队列(/jobs/*)有自己的限流
+IMAGE_PATHS = ("/api/v1/txt2img", "/api/v1/txt2img/batch", "/api/v1/img2img",
+               "/api/v1/out_painting", "/api/v1/img_enhance")
+AUDIO_PATHS = ("/api/v1/auc",)
+CHAT_PATHS = ("/api/v1/chat",)
+
+
+class AdmissionRejected(Exception):
+    """请求未被放行, status_code为429(队列已满)或503(等待超时)"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AdmissionPool:
+    """带优先级和等待期限的并发池
+
+    并发数未满时直接放行; 否则进入有界等待队列, 短请求优先, 同优先级先到先得;
+    队列已满立即拒绝, 等待超过期限也拒绝。
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0) -> None:
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+        if self.waiting >= self.queue_size:
+            raise AdmissionRejected(f"{self.name} queue is full", 429)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # 超时的同时刚好被放行, 直接使用这个名额
+                return
+            future.cancel()
+            raise AdmissionRejected(
+                f"{self.name} wait exceeded {self.timeout:g}s", 503)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+    def release(self) -> None:
+        """释放名额, 有人等待时直接把名额交给优先级最高的等待者"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+def _load_pools() -> Dict[str, AdmissionPool]:
+    pools = {}
+    for name, (limit, queue_size, timeout) in DEFAULT_POOLS.items():
+        prefix = f"ADMISSION_{name.upper()}"
+        pool = AdmissionPool(
+            name,
+            int(os.getenv(f"{prefix}_CONCURRENCY", str(limit))),
+            int(os.getenv(f"{prefix}_QUEUE", str(queue_size))),
+            float(os.getenv(f"{prefix}_TIMEOUT", str(timeout))))
+        metrics.admission_in_use.set_function(lambda p=pool: p.active, name)
+        metrics.queue_depth.set_function(lambda p=pool: p.waiting, f"admission_{name}")
+        pools[name] = pool
+    return pools
+
+
+pools = _load_pools()
+
+
+def classify(scope) -> Optional[str]:
+    """按路径和查询参数确定请求池, 不需要准入控制的请求返回None"""
+    if scope["type"] != "http" or scope["method"] != "POST":
+        return None
+    path = scope["path"].rstrip("/")
+    if path in CHAT_PATHS:
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        stream = query.get("stream", ["true"])[-1].lower()
+        return "chat" if stream in ("false", "0", "no", "off") else "chat_stream"
+    if path in IMAGE_PATHS:
+        return "image"
+    if path in AUDIO_PATHS:
+        return "audio"
+    return None
+
+
+def _priority(scope) -> int:
+    """请求体较小的请求(短对话, 单张图片)优先; 没有Content-Length的按长请求处理"""
+    for key, value in scope.get("headers", []):
+        if key == b"content-length":
+            try:
+                return 0 if int(value) <= ADMISSION_SHORT_REQUEST_BYTES else 1
+            except ValueError:
+                break
+    return 1
+
+
+class AdmissionMiddleware:
+    """按请求类别限制并发, 超出容量时快速返回429/503和Retry-After
+
+    名额在响应体发送完毕后才释放, 流式响应会占用名额直到流结束。
+    进程排空期间不再接受新的POST请求。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if lifecycle.draining and scope["type"] == "http" and scope["method"] == "POST":
+            metrics.admission_rejected_total.inc(classify(scope) or "other", "draining")
+            response = get_error_response(
+                "服务正在重启, 请稍后重试", status=503, status_code=503,
+                headers={"Retry-After": ADMISSION_RETRY_AFTER, "Connection": "close"})
+            await response(scope, receive, send)
+            return
+        pool_name = classify(scope) if ADMISSION_ENABLED else None
+        if pool_name is None:
+            await self.app(scope, receive, send)
+            return
+        pool = pools[pool_name]
+        start = time.perf_counter()
+        try:
+            await pool.acquire(_priority(scope))
+        except AdmissionRejected as e:
+            reason = "queue_full" if e.status_code == 429 else "timeout"
+            metrics.admission_rejected_total.inc(pool_name, reason)
+            logging.warning("Admission rejected %s: %s", scope["path"], e)
+            response = get_error_response(
+                f"服务繁忙, 请稍后重试: {e}", status=e.status_code,
+                status_code=e.status_code,
+                headers={"Retry-After": ADMISSION_RETRY_AFTER})
+            await response(scope, receive, send)
+            return
+        metrics.admission_wait_seconds.observe(time.perf_counter() - start, pool_name)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            pool.release()
@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Dict, List, Set, Union
 from fastapi import APIRouter, UploadFile, Request
 from fastapi.responses import StreamingResponse, Response
 import httpx
@@ -6,16 +6,40 @@ import json
 import logging
 import asyncio
 import uuid
+import time
 import tempfile
 import os
 import aiofiles
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows没有fcntl, 改用msvcrt加锁
+    fcntl = None
+    import msvcrt
 
-from .error import get_error_response, TaskSubmissionError, TaskQueryError
+from .error import get_error_response, CircuitOpenError, TaskSubmissionError, TaskQueryError
+from .utils import get_http_client
+from . import metrics, resilience
+from .logs import log_payload
+from .lifecycle import lifecycle, SHUTDOWN_DRAIN_TIMEOUT
+from .responses import envelope_response
+from .records import RecordStore
 
 router = APIRouter(prefix="/api/v1", tags=["语音转文字"])
 
-JSON_MEDIA_TYPE = "application/json"
+AUC_TIMEOUT = httpx.Timeout(5.0)
+# 退出时未完成的任务保存在该文件中, 下次启动继续轮询
+AUC_PENDING_FILE = os.getenv("AUC_PENDING_FILE", "./data/pending_auc.json")
+# 交接任务的结果保留秒数
+AUC_RESULT_TTL = float(os.getenv("AUC_RESULT_TTL", "3600"))
+# 重启后继续处理的任务结果写在该目录中, 多worker时任一worker都能查到
+AUC_RESULT_DIR = os.getenv("AUC_RESULT_DIR", "./data/auc_results")
+
+# task_id -> 轮询所需信息, 包括进行中和已交接的任务
+pending_tasks: Dict[str, Dict] = {}
+# 重启后继续处理的任务结果
+auc_results = RecordStore(AUC_RESULT_DIR, AUC_RESULT_TTL)
+_resume_tasks: Set[asyncio.Task] = set()
 
 @router.get("/tw", response_model=None)
 async def temp_mp3(file_name: str = "./test/data/audio_01.mp3") -> Union[StreamingResponse, Response]:
@@ -38,7 +62,7 @@ async def submit_task(request_data):
     """提交语音任务"""
     logging.debug("Submitting task to AUC API")
     submit_url = os.getenv("DOUBAO_AUC_API_SUBMIT_URL", "https://openspeech.bytedance.com/api/v3/auc/bigmodel/submit")
-    logging.debug(f'submit_url: {submit_url}')
+    logging.debug('submit_url: %s', submit_url)
     task_id = str(uuid.uuid4())
     headers = {
         "X-Api-App-Key": os.getenv("X_Api_App_Id", "5722492847"),
@@ -48,21 +72,27 @@ async def submit_task(request_data):
         "X-Api-Sequence": "-1"
     }
     
-    logging.debug(f'Submit task request headers: \n{json.dumps(headers, indent=2)}\n')
-    logging.debug(f'Submit task request data: \n{json.dumps(request_data, indent=2)}\n')
+    log_payload('Submit task request headers: \n%s\n', headers)
+    log_payload('Submit task request data: \n%s\n', request_data)
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(submit_url, json=request_data, headers=headers)
-        logging.debug(f'Submit task response headers: \n{response.headers}\n')
-        if 'X-Api-Status-Code' in response.headers and response.headers["X-Api-Status-Code"] == "20000000":
-            logging.debug(f'Submit task response header X-Api-Status-Code: {response.headers["X-Api-Status-Code"]}')
-            logging.debug(f'Submit task response header X-Api-Message: {response.headers["X-Api-Message"]}')
-            x_tt_logid = response.headers.get("X-Tt-Logid", "")
-            logging.debug(f'Submit task response header X-Tt-Logid: {x_tt_logid}\n')
-            return task_id, x_tt_logid
-        else:
-            logging.debug('Submit task failed\n')
-            raise TaskSubmissionError("Task submission failed: X-Api-Status-Code not in response headers")
+    client = get_http_client()
+    # 同一个X-Api-Request-Id重复提交不会产生新任务, 可以按幂等请求重试
+    response = await resilience.call(
+        "doubao_auc",
+        lambda: client.post(submit_url, json=request_data, headers=headers,
+                            timeout=AUC_TIMEOUT,
+                            extensions=metrics.trace_upstream("doubao_auc")),
+        idempotent=True)
+    logging.debug('Submit task response headers: \n%s\n', response.headers)
+    if 'X-Api-Status-Code' in response.headers and response.headers["X-Api-Status-Code"] == "20000000":
+        logging.debug('Submit task response header X-Api-Status-Code: %s', response.headers["X-Api-Status-Code"])
+        logging.debug('Submit task response header X-Api-Message: %s', response.headers.get("X-Api-Message"))
+        x_tt_logid = response.headers.get("X-Tt-Logid", "")
+        logging.debug('Submit task response header X-Tt-Logid: %s\n', x_tt_logid)
+        return task_id, x_tt_logid
+    else:
+        logging.debug('Submit task failed\n')
+        raise TaskSubmissionError("Task submission failed: X-Api-Status-Code not in response headers")
     
     return task_id
 
@@ -76,30 +106,65 @@ async def query_task(task_id, x_tt_logid):
         "X-Api-Request-Id": task_id,
         "X-Tt-Logid": x_tt_logid  # 固定传递 x-tt-logid
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(query_url, json={}, headers=headers)
-        logging.debug(f'Query task response headers: \n{response.headers}\n')
-        if 'X-Api-Status-Code' in response.headers:
-            logging.debug(f'Query task response header X-Api-Status-Code: {response.headers["X-Api-Status-Code"]}')
-            logging.debug(f'Query task response header X-Api-Message: {response.headers["X-Api-Message"]}')
-            logging.debug(f'Query task response header X-Tt-Logid: {response.headers["X-Tt-Logid"]}\n')
-        else:
-            logging.debug(f'Query task failed and the response headers are: {response.headers}')
-            raise TaskSubmissionError("Task query failed: X-Api-Status-Code not in response headers")    
-        if response.status_code != 200:
-            raise TaskQueryError("Task query failed with non-200 status code")
-        return response
+    client = get_http_client()
+    response = await resilience.call(
+        "doubao_auc",
+        lambda: client.post(query_url, json={}, headers=headers,
+                            timeout=AUC_TIMEOUT,
+                            extensions=metrics.trace_upstream("doubao_auc")),
+        idempotent=True)
+    logging.debug('Query task response headers: \n%s\n', response.headers)
+    if 'X-Api-Status-Code' in response.headers:
+        logging.debug('Query task response header X-Api-Status-Code: %s', response.headers["X-Api-Status-Code"])
+        logging.debug('Query task response header X-Api-Message: %s', response.headers.get("X-Api-Message"))
+        logging.debug('Query task response header X-Tt-Logid: %s\n', response.headers.get("X-Tt-Logid"))
+    else:
+        logging.debug('Query task failed and the response headers are: %s', response.headers)
+        raise TaskSubmissionError("Task query failed: X-Api-Status-Code not in response headers")    
+    if response.status_code != 200:
+        raise TaskQueryError("Task query failed with non-200 status code")
+    return response
     
+class AucHandoff(Exception):
+    """排空期限将到, 任务交给下次启动继续处理"""
+    pass
+
+
+async def wait_for_result(task_id: str, x_tt_logid: str) -> str:
+    """轮询任务直到完成, 返回识别文本
+
+    Raises:
+        TaskQueryError: 任务失败或结果格式错误
+        AucHandoff: 进程正在排空且期限将到
+    """
+    while True:
+        query_response = await query_task(task_id, x_tt_logid)  # 查询任务状态
+        code = query_response.headers.get('X-Api-Status-Code', "")
+        if code == '20000000':
+            logging.debug('Query task success')
+            query_result = query_response.json()
+            if 'result' not in query_result or 'text' not in query_result['result']:
+                logging.error("Query result does not contain expected 'result' or 'text'")
+                raise TaskQueryError("Invalid task result format")
+            return query_result['result']['text']
+        elif code != '20000001' and code != '20000002':
+            logging.error("Task failed with code: %s", code)
+            raise TaskQueryError("Task failed")
+        if lifecycle.handoff_due():
+            raise AucHandoff(task_id)
+        await asyncio.sleep(3)
+
+
 def del_file(file_path: str):
     """删除文件"""
     try:
         if os.path.exists(file_path):
             os.remove(file_path)
-            logging.debug(f"Deleted temporary file: {file_path}")
+            logging.debug("Deleted temporary file: %s", file_path)
         else:
-            logging.debug(f"File not found for deletion: {file_path}")
+            logging.debug("File not found for deletion: %s", file_path)
     except Exception as e:
-        logging.error(f"Error deleting file {file_path}: {str(e)}")
+        logging.error("Error deleting file %s: %s", file_path, e)
 
 
 @router.post("/auc", response_model=None)
@@ -116,7 +181,7 @@ async def auc(request: Request, audio: UploadFile) -> Union[StreamingResponse, R
         async with aiofiles.open(temp_audio_path, 'wb') as temp_file:
             await temp_file.write(audio_data)
     except Exception as e:
-        logging.error(f"Error creating temporary audio file: {str(e)}")
+        logging.error("Error creating temporary audio file: %s", e)
         return get_error_response(f"Error saving audio file: {str(e)}")
     
     try:
@@ -124,7 +189,7 @@ async def auc(request: Request, audio: UploadFile) -> Union[StreamingResponse, R
             temp_audio_url = "http://8.137.149.26:8808/api/v1/tw?file_name=./test/output.mp3"
         else:
             temp_audio_url = f"{request.url.scheme}://{request.url.netloc}/api/v1/tw?file_name={temp_audio_path}"
-        logging.debug(f"temp_audio_url: {temp_audio_url}")
+        logging.debug("temp_audio_url: %s", temp_audio_url)
     except Exception as e:
         return get_error_response(f"Error generating file URL: {str(e)}")
         
@@ -154,38 +219,141 @@ async def auc(request: Request, audio: UploadFile) -> Union[StreamingResponse, R
     
     try:
         task_id, x_tt_logid = await submit_task(data)  # 提交任务
-    except TaskSubmissionError as e:
-        # delete temp_file
+    except (TaskSubmissionError, CircuitOpenError, httpx.HTTPError) as e:
+        # 熔断或重试用尽时同样返回错误信封, 并删除临时文件
         del_file(temp_audio_path)
         return get_error_response(str(e))
-    
-    while True:
-        try:
-            query_response = await query_task(task_id, x_tt_logid)  # 查询任务状态
-            code = query_response.headers.get('X-Api-Status-Code', "")
-            if code == '20000000':
-                logging.debug('Query task success')
-                query_result = query_response.json()
-                if 'result' not in query_result or 'text' not in query_result['result']:
-                    logging.error("Query result does not contain expected 'result' or 'text'")
-                    del_file(temp_audio_path)
-                    return get_error_response("Invalid task result format")
-                del_file(temp_audio_path)
-                resp_data = {
-                    "code": 1,
-                    "msg": 'success',
-                    "data": query_result['result']['text'],
-                    "status": 200
-                }
-                return Response(
-                    json.dumps(resp_data),
-                    media_type="application/json"
-                )
-            elif code != '20000001' and code != '20000002':
-                logging.error(f"Task failed with code: {code}")
-                del_file(temp_audio_path)
-                return get_error_response("Task failed")
-            await asyncio.sleep(3)
-        except TaskQueryError as e:
+
+    pending_tasks[task_id] = {"x_tt_logid": x_tt_logid, "audio_path": temp_audio_path,
+                              "submitted_at": time.time()}
+    handed_off = False
+    lifecycle.enter("auc")
+    try:
+        text = await wait_for_result(task_id, x_tt_logid)
+    except AucHandoff:
+        # 进程即将退出, 任务交给下次启动继续轮询, 客户端稍后按task_id取结果
+        handed_off = True
+        logging.info("Handing off AUC task %s for resumption after restart", task_id)
+        return envelope_response(
+            {"task_id": task_id, "result_url": f"/api/v1/auc/{task_id}"},
+            msg="服务正在重启, 请稍后按task_id查询结果", code=0, status=503,
+            status_code=503, headers={"Retry-After": str(int(SHUTDOWN_DRAIN_TIMEOUT))})
+    except asyncio.CancelledError:
+        # 排空超时被取消, 退出时会持久化pending_tasks
+        handed_off = True
+        raise
+    except (TaskQueryError, TaskSubmissionError, CircuitOpenError, httpx.HTTPError) as e:
+        return get_error_response(str(e))
+    finally:
+        lifecycle.leave("auc")
+        if not handed_off:
+            pending_tasks.pop(task_id, None)
             del_file(temp_audio_path)
-            return get_error_response(str(e))
+    return envelope_response(text)
+
+
+@router.get("/auc/{task_id}", response_model=None)
+async def auc_result(task_id: str) -> Response:
+    """查询重启前交接的语音任务结果"""
+    result = await auc_results.get(task_id)
+    if result is None:
+        if task_id in pending_tasks:
+            result = {"status": "running"}
+        else:
+            return get_error_response(f"Task {task_id} not found", status=404)
+    return envelope_response(dict(result, task_id=task_id))
+
+
+async def _resume_task(task_id: str, info: Dict) -> None:
+    """继续轮询上次退出前交接的任务"""
+    try:
+        text = await wait_for_result(task_id, info["x_tt_logid"])
+    except AucHandoff:
+        # 再次退出, 任务保留在pending_tasks中继续交接, 结果仍为running
+        return
+    except Exception as e:
+        logging.error("Resumed AUC task %s failed: %s", task_id, e)
+        result = {"status": "failed", "error": str(e), "finished_at": time.time()}
+    else:
+        result = {"status": "succeeded", "text": text, "finished_at": time.time()}
+    try:
+        await auc_results.put(task_id, result)
+    except (OSError, ValueError) as e:
+        logging.error("Failed to save result of AUC task %s: %s", task_id, e)
+    pending_tasks.pop(task_id, None)
+    del_file(info.get("audio_path", ""))
+
+
+def _lock_file(lock) -> None:
+    """独占锁定已打开的文件, 文件关闭时释放"""
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    else:
+        msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def save_pending_tasks() -> None:
+    """把尚未完成的任务写入AUC_PENDING_FILE, 下次启动时继续
+
+    多worker运行时各worker同时退出, 加文件锁后与文件中已有的任务合并。
+    """
+    if not pending_tasks:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(AUC_PENDING_FILE)), exist_ok=True)
+    with open(f"{AUC_PENDING_FILE}.lock", "w") as lock:
+        _lock_file(lock)
+        tasks = {}
+        try:
+            with open(AUC_PENDING_FILE, "r", encoding="utf-8") as f:
+                tasks = json.load(f)
+        except (OSError, ValueError):
+            pass
+        tasks.update(pending_tasks)
+        tmp_path = f"{AUC_PENDING_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(tasks, f)
+        os.replace(tmp_path, AUC_PENDING_FILE)
+    logging.info("Saved %d pending AUC task(s) to %s", len(pending_tasks), AUC_PENDING_FILE)
+
+
+async def resume_pending_tasks() -> None:
+    """读取上次退出时保存的任务并在后台继续轮询
+
+    先把文件改名认领, 多worker同时启动时只有一个worker继续这些任务;
+    结果写入AUC_RESULT_DIR, 查询被分到其他worker时也能返回。
+    """
+    claimed_path = f"{AUC_PENDING_FILE}.{os.getpid()}"
+    try:
+        os.rename(AUC_PENDING_FILE, claimed_path)
+        with open(claimed_path, "r", encoding="utf-8") as f:
+            tasks = json.load(f)
+        os.remove(claimed_path)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.error("Failed to load pending AUC tasks from %s: %s", AUC_PENDING_FILE, e)
+        return
+    logging.info("Resuming %d pending AUC task(s)", len(tasks))
+    for task_id, info in tasks.items():
+        pending_tasks[task_id] = info
+        try:
+            await auc_results.put(task_id, {"status": "running"})
+        except (OSError, ValueError) as e:
+            logging.error("Failed to save status of AUC task %s: %s", task_id, e)
+        task = asyncio.create_task(_resume_task(task_id, info))
+        _resume_tasks.add(task)
+        task.add_done_callback(_resume_tasks.discard)
+
+
+def upstream_urls() -> List[str]:
+    """启动时用于预热连接的上游地址"""
+    return [os.getenv("DOUBAO_AUC_API_SUBMIT_URL",
+                      "https://openspeech.bytedance.com/api/v3/auc/bigmodel/submit")]
+
+
+async def on_startup() -> None:
+    await resume_pending_tasks()
+
+
+async def on_shutdown() -> None:
+    save_pending_tasks()
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import aiofiles
+
+# 写入中途退出留下的临时文件超过该秒数后清理
+DISK_TMP_MAX_AGE = 3600
+
+
+def make_cache_key(*parts: Any) -> str:
+    """根据参数生成稳定的缓存键"""
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """两级结果缓存: 内存LRU + 可选的磁盘层
+
+    内存层保存小体积结果(例如图片URL), 磁盘层保存大体积结果(例如base64图片),
+    两层都按TTL过期。磁盘层由后台任务定期清理过期文件, 总大小超过
+    disk_max_bytes时从最早写入的文件开始删除; 文件操作都在线程中进行。
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1024,
+                 disk_dir: Optional[str] = None, disk_ttl: Optional[float] = None,
+                 disk_max_bytes: int = 0, sweep_interval: float = 600):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_ttl = disk_ttl if disk_ttl is not None else ttl
+        self.disk_max_bytes = disk_max_bytes
+        self.sweep_interval = sweep_interval
+        self._memory: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._sweep_task: Optional[asyncio.Task] = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir or "", f"{key}.json")
+
+    def _fresh_path(self, key: str) -> Optional[str]:
+        path = self._disk_path(key)
+        try:
+            if os.path.getmtime(path) + self.disk_ttl > time.time():
+                return path
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    async def disk_file(self, key: str) -> Optional[str]:
+        """返回未过期的磁盘缓存文件路径, 用于直接流式返回"""
+        if not self.disk_dir:
+            return None
+        self._ensure_sweeping()
+        return await asyncio.to_thread(self._fresh_path, key)
+
+    def disk_writer(self, key: str) -> Optional["DiskCacheWriter"]:
+        """返回增量写入磁盘层的写入器, 未配置磁盘层时返回None"""
+        if not self.disk_dir:
+            return None
+        self._ensure_sweeping()
+        return DiskCacheWriter(self._disk_path(key))
+
+    async def get(self, key: str) -> Optional[Dict]:
+        """读取缓存, 未命中或已过期返回None"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                return value
+            del self._memory[key]
+
+        path = await self.disk_file(key)
+        if path is None:
+            return None
+        try:
+            async with aiofiles.open(path, "r", encoding="utf-8") as f:
+                return json.loads(await f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to read cache file %s: %s", path, e)
+            return None
+
+    async def set(self, key: str, value: Dict, disk: bool = False) -> None:
+        """写入缓存, disk=True时写入磁盘层(未配置磁盘层时不缓存, 避免大对象占用内存)"""
+        if disk:
+            if not self.disk_dir:
+                return
+            self._ensure_sweeping()
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                    await f.write(json.dumps(value))
+                await asyncio.to_thread(os.replace, tmp_path, path)
+            except OSError as e:
+                logging.warning("Failed to write cache file %s: %s", path, e)
+            return
+
+        self._memory[key] = (time.time() + self.ttl, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _ensure_sweeping(self) -> None:
+        """在第一次写入磁盘层时启动定期清理"""
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep_disk)
+            except Exception as e:
+                logging.error("Failed to sweep cache directory %s: %s", self.disk_dir, e)
+            await asyncio.sleep(self.sweep_interval)
+
+    def sweep_disk(self) -> int:
+        """删除过期文件和残留的临时文件, 超出disk_max_bytes时删除最早写入的文件, 返回删除数"""
+        now = time.time()
+        removed = 0
+        files: List[Tuple[float, int, str]] = []
+        with os.scandir(self.disk_dir) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(".tmp"):
+                    expired = stat.st_mtime + DISK_TMP_MAX_AGE <= now
+                elif entry.name.endswith(".json"):
+                    expired = stat.st_mtime + self.disk_ttl <= now
+                    if not expired:
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+                else:
+                    continue
+                if expired:
+                    removed += _remove(entry.path)
+        total = sum(size for _, size, _ in files)
+        if self.disk_max_bytes and total > self.disk_max_bytes:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.disk_max_bytes:
+                    break
+                removed += _remove(path)
+                total -= size
+        if removed:
+            logging.debug("Removed %d file(s) from cache directory %s", removed, self.disk_dir)
+        return removed
+
+
+def _remove(path: str) -> int:
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
+
+
+class DiskCacheWriter:
+    """增量写入缓存文件, 写完后原子替换, 中途失败则丢弃"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        self._file = None
+        self._failed = False
+
+    async def write(self, data: bytes) -> None:
+        if self._failed:
+            return
+        try:
+            if self._file is None:
+                self._file = await aiofiles.open(self.tmp_path, "wb")
+            await self._file.write(data)
+        except OSError as e:
+            logging.warning("Failed to write cache file %s: %s", self.path, e)
+            self._failed = True
+
+    async def commit(self) -> None:
+        if self._failed:
+            await self.abort()
+            return
+        try:
+            if self._file is not None:
+                await self._file.close()
+                self._file = None
+                await asyncio.to_thread(os.replace, self.tmp_path, self.path)
+        except OSError as e:
+            logging.warning("Failed to write cache file %s: %s", self.path, e)
+            await self.abort()
+
+    async def abort(self) -> None:
+        if self._file is not None:
+            await self._file.close()
+            self._file = None
+        await asyncio.to_thread(_remove, self.tmp_path)
@@ -1,21 +1,53 @@
 from enum import Enum
-from typing import List, Dict, Union, AsyncGenerator, Optional, Tuple
+from typing import List, Dict, Union, AsyncGenerator, Awaitable, Callable, Optional, Tuple
 from fastapi.responses import StreamingResponse, Response
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Header, Request
 from pydantic import BaseModel, Field
+import os
 import httpx
 import json
+import asyncio
+import time
 import logging
-from .utils import Token, Url
-from .error import get_error_response
-import configparser
+from .utils import get_http_client
+from .providers import Endpoint, RequestBudget, provider_registry
+from . import metrics, resilience
+from .logs import lazy_json, log_payload, truncate
+from .error import get_error_response, CircuitOpenError, QuotaExceededError
+from .usage import Caller, usage_ledger, API_KEY_HEADER
+from .lifecycle import lifecycle
+from .responses import dumps_str, envelope_response, loads
+from .models import ModelSpec, model_registry
+from .context_cache import CONTEXT_CACHE_ENABLED, context_cache, split_prefix
+from .semantic_cache import (AnswerBuilder, SEMANTIC_CACHE_ENABLED, answer_cache,
+                             replay_events)
+from .semantic_cache import on_startup as semantic_cache_startup
+from .sessions import (SESSION_CONTEXT_TOKENS, SESSION_DB, SESSION_ID_MAX_LENGTH,
+                       SESSION_SUMMARY_ENABLED,
+                       SESSION_SUMMARY_MAX_TOKENS, SESSION_SUMMARY_MIN_MESSAGES,
+                       Session, message_tokens, session_store)
 
 router = APIRouter(prefix="/api/v1", tags=["对话"])
 
-JSON_MEDIA_TYPE = "application/json"
-
-config = configparser.ConfigParser()
-config.read("model_config.ini")
+# 完整的回答返回后调用, 用于写入语义缓存和会话历史
+AnswerHook = Callable[[Dict], None]
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+    "Transfer-Encoding": "chunked"
+}
+
+# 非流式对话的对冲请求, 默认关闭, 也可以按请求用hedge参数开启
+CHAT_HEDGE_ENABLED = os.getenv("CHAT_HEDGE_ENABLED", "false").lower() == "true"
+# 主请求超过端点近期延迟的该分位数仍未返回时发出对冲请求
+CHAT_HEDGE_PERCENTILE = float(os.getenv("CHAT_HEDGE_PERCENTILE", "95"))
+# 延迟样本不足CHAT_HEDGE_MIN_SAMPLES个时使用的固定等待秒数
+CHAT_HEDGE_MIN_SAMPLES = int(os.getenv("CHAT_HEDGE_MIN_SAMPLES", "20"))
+CHAT_HEDGE_DEFAULT_DELAY = float(os.getenv("CHAT_HEDGE_DEFAULT_DELAY", "10"))
+# 对冲请求最多占非流式请求量的比例, 以及允许的突发数量
+hedge_budget = RequestBudget(float(os.getenv("CHAT_HEDGE_BUDGET", "0.1")),
+                             float(os.getenv("CHAT_HEDGE_BURST", "5")))
 
 @router.get("/tw", response_model=None)
 async def temp_file(request: Request, file_name: str = "./test/data/audio_01.mp3") -> Union[StreamingResponse, Response]:
@@ -44,7 +76,7 @@ def trans_chunk(chunk: str) -> Tuple:
             return {"isDone": "True"}, "end"
         if chunk.startswith("data: "):
             chunk = chunk[6:]
-        chunk_data = json.loads(chunk)
+        chunk_data = loads(chunk)
         chunk_short = {}
         if len(chunk_data['choices']) > 0:
             chunk_short = chunk_data['choices'][0].get('delta', {})
@@ -53,53 +85,346 @@ def trans_chunk(chunk: str) -> Tuple:
         else:
             return "", "empty"
     except json.JSONDecodeError as e:
-        logging.warning(f"Failed to parse chunk: {chunk}, error: {e}")
+        logging.warning("Failed to parse chunk: %s, error: %s", truncate(chunk), e)
         return "", "empty"
 
 
-async def stream_generator(url: str, headers: Dict,
-                           data: Dict) -> AsyncGenerator[str, None]:
+def _record_usage(model_name: str, usage: Optional[Dict],
+                  caller: Optional[Caller] = None) -> None:
+    """累计上游usage中的token数, 有调用方时同时记入用量账本"""
+    if caller is not None:
+        usage_ledger.record(caller, model_name, usage)
+    if not usage:
+        return
+    for token_type in ("prompt_tokens", "completion_tokens"):
+        if usage.get(token_type):
+            metrics.chat_tokens_total.inc(model_name, token_type,
+                                          amount=usage[token_type])
+    # 上游按缓存计费的prompt token, 来自上下文缓存或上游自动的前缀缓存
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached_tokens:
+        metrics.chat_tokens_total.inc(model_name, "cached_tokens", amount=cached_tokens)
+
+
+class StreamTimer:
+    """记录一次流式对话各阶段的耗时
+
+    阶段: 上游请求开始, 收到响应头, 收到第一行数据, 第一个内容增量,
+    内容增量之间的间隔, 以及总耗时。
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.trace = metrics.UpstreamTrace("doubao_chat")
+        self.start = time.perf_counter()
+        self.first_byte: Optional[float] = None
+        self.first_content: Optional[float] = None
+        self.last_content: Optional[float] = None
+        self.end: Optional[float] = None
+        self.chunks = 0
+        self.max_gap = 0.0
+        self.usage: Optional[Dict] = None
+
+    def on_line(self) -> None:
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+            metrics.chat_first_byte_seconds.observe(
+                self.first_byte - self.start, self.model_name)
+
+    def on_content(self) -> None:
+        now = time.perf_counter()
+        if self.first_content is None:
+            self.first_content = now
+            metrics.chat_ttft_seconds.observe(now - self.start, self.model_name)
+        elif self.last_content is not None:
+            gap = now - self.last_content
+            self.max_gap = max(self.max_gap, gap)
+            metrics.chat_inter_chunk_seconds.observe(gap, self.model_name)
+        self.last_content = now
+        self.chunks += 1
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+        metrics.chat_duration_seconds.observe(
+            self.end - self.start, self.model_name, "true")
+        usage = self.usage
+        if usage and self.first_content is not None and self.end > self.first_content:
+            completion_tokens = usage.get("completion_tokens") or 0
+            metrics.chat_tokens_per_second.observe(
+                completion_tokens / (self.end - self.first_content), self.model_name)
+
+    def summary(self) -> Dict:
+        """各阶段相对请求开始的毫秒数"""
+        def since_start(moment: Optional[float]) -> Optional[float]:
+            return None if moment is None else round((moment - self.start) * 1000, 1)
+
+        streaming = None
+        if self.first_content is not None and self.last_content is not None:
+            streaming = self.last_content - self.first_content
+        return {
+            "model": self.model_name,
+            "upstream_headers_ms": None if self.trace.ttfb is None
+            else round(self.trace.ttfb * 1000, 1),
+            "first_byte_ms": since_start(self.first_byte),
+            "first_content_ms": since_start(self.first_content),
+            "total_ms": since_start(self.end or time.perf_counter()),
+            "chunks": self.chunks,
+            "mean_gap_ms": round(streaming / (self.chunks - 1) * 1000, 1)
+            if streaming is not None and self.chunks > 1 else None,
+            "max_gap_ms": round(self.max_gap * 1000, 1)
+        }
+
+
+def _should_failover(error: Exception) -> bool:
+    """连接错误, 超时, 熔断, 429和5xx可以换一个端点重试; 其他4xx是请求本身的问题"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, (httpx.TransportError, CircuitOpenError))
+
+
+def _upstream_label(endpoint: Endpoint) -> str:
+    return f"{endpoint.label}_chat"
+
+
+async def stream_generator(endpoints: List[Endpoint], data: Dict,
+                           model_name: str = "",
+                           timing: bool = False,
+                           caller: Optional[Caller] = None,
+                           on_answer: Optional[AnswerHook] = None
+                           ) -> AsyncGenerator[str, None]:
     """流生成器
 
+    在收到上游第一行数据之前出错时, 按顺序切换到下一个端点;
+    已经开始输出后出错则直接结束, 不会重复输出。
+
     Args:
-        url (str): 模型地址
-        headers (Dict): 请求头
+        endpoints (List[Endpoint]): 按健康度排序的上游端点
         data (Dict): 请求数据
+        model_name (str): 模型名称, 用于指标标签
+        timing (bool): 是否在结束前追加一个timing事件
+        caller (Optional[Caller]): 调用方, 结束时记录用量
+        on_answer (Optional[AnswerHook]): 完整输出后以拼接的回答调用
 
     Yields:
         str: streaming response in JSON format
     """
-    async with httpx.AsyncClient(timeout=httpx.Timeout(300.0)) as client:
-        async with client.stream("POST", url, headers=headers,
-                                 json=data) as response:
-            response.raise_for_status()
-            role = ""
-            async for chunk in response.aiter_lines():
-                new_chunk, _ = trans_chunk(chunk)
-                if new_chunk:
-                    role = new_chunk.get("role", role)
-                    new_chunk["role"] = role
-                    yield "data: " + json.dumps(new_chunk,
-                                                ensure_ascii=False) + "\n\n"
-
-
-async def nonstream_generator(url: str, headers: Dict, data: Dict) -> Dict:
+    timer = StreamTimer(model_name)
+    answer = AnswerBuilder() if on_answer is not None else None
+    outcome = "error"
+    metrics.chat_streams_in_flight.inc(model_name)
+    lifecycle.enter("chat_stream")
+    try:
+        for index, endpoint in enumerate(endpoints):
+            attempt_start = time.perf_counter()
+            received = False
+            try:
+                async for line in _stream_lines(endpoint, data, timer, timing, answer):
+                    if not received:
+                        received = True
+                        endpoint.record(time.perf_counter() - attempt_start, True)
+                    yield line
+            except Exception as e:
+                endpoint.record(None, False)
+                metrics.upstream_requests_total.inc(_upstream_label(endpoint), "error")
+                if received or index == len(endpoints) - 1 or not _should_failover(e):
+                    raise
+                logging.warning("Endpoint %s failed before first byte, failing over: %s",
+                                endpoint.name, e)
+                metrics.chat_failovers_total.inc(model_name, endpoint.label)
+                continue
+            metrics.upstream_requests_total.inc(_upstream_label(endpoint), "ok")
+            break
+        outcome = "ok"
+        if answer is not None:
+            on_answer(answer.message())
+        if timing and timer.end is None:
+            timer.finish()
+            yield "event: timing\ndata: " + dumps_str(timer.summary()) + "\n\n"
+    finally:
+        if timer.end is None:
+            timer.finish()
+        metrics.chat_streams_in_flight.dec(model_name)
+        lifecycle.leave("chat_stream")
+        _record_usage(model_name, timer.usage, caller)
+        logging.info("stream_timing %s outcome=%s", lazy_json(timer.summary), outcome)
+
+
+async def _stream_lines(endpoint: Endpoint, data: Dict, timer: StreamTimer,
+                        timing: bool, answer: Optional[AnswerBuilder] = None
+                        ) -> AsyncGenerator[str, None]:
+    """向单个端点发起流式请求, 逐行转换为SSE事件
+
+    建立连接和等待响应头的阶段经过熔断和重试, 开始输出后不再重试。
+    """
+    client = get_http_client()
+    upstream = await context_cache.prepare(endpoint, data, timer.model_name)
+
+    def send() -> Awaitable[httpx.Response]:
+        request = client.build_request(
+            "POST", upstream.url, headers=endpoint.headers(), json=upstream.body,
+            extensions=timer.trace.extensions())
+        return client.send(request, stream=True)
+
+    response = await resilience.call(_upstream_label(endpoint), send)
+    if upstream.context is not None and _context_rejected(response):
+        await response.aclose()
+        upstream = context_cache.invalidate(upstream, timer.model_name)
+        response = await resilience.call(_upstream_label(endpoint), send)
+    try:
+        response.raise_for_status()
+        context_cache.record_success(upstream, timer.model_name)
+        role = ""
+        async for chunk in response.aiter_lines():
+            timer.on_line()
+            new_chunk, chunk_type = trans_chunk(chunk)
+            if new_chunk:
+                if chunk_type == "content":
+                    timer.on_content()
+                    timer.usage = new_chunk.get("usage") or timer.usage
+                    if answer is not None:
+                        answer.add(new_chunk)
+                elif chunk_type == "end" and timing and timer.end is None:
+                    # 在结束标记之前发送, 读到isDone就断开的客户端也能收到
+                    timer.finish()
+                    yield "event: timing\ndata: " + dumps_str(timer.summary()) + "\n\n"
+                role = new_chunk.get("role", role)
+                new_chunk["role"] = role
+                yield "data: " + dumps_str(new_chunk) + "\n\n"
+    finally:
+        await response.aclose()
+
+
+def _context_rejected(response: httpx.Response) -> bool:
+    """引用上下文的请求返回4xx(429除外)时, 视为上下文已失效"""
+    return 400 <= response.status_code < 500 and response.status_code != 429
+
+
+async def _post_chat(endpoint: Endpoint, data: Dict, model_name: str = "") -> httpx.Response:
+    """向单个端点发起非流式请求并记录端点统计
+
+    被对冲取消的请求不算失败, 但已等待的时间计入延迟, 避免慢端点一直排在前面。
+    """
+    attempt_start = time.perf_counter()
+    try:
+        client = get_http_client()
+        upstream = await context_cache.prepare(endpoint, data, model_name)
+
+        def send() -> Awaitable[httpx.Response]:
+            return client.post(
+                upstream.url, headers=endpoint.headers(), json=upstream.body,
+                extensions=metrics.trace_upstream(_upstream_label(endpoint)))
+
+        response = await resilience.call(_upstream_label(endpoint), send)
+        if upstream.context is not None and _context_rejected(response):
+            upstream = context_cache.invalidate(upstream, model_name)
+            response = await resilience.call(_upstream_label(endpoint), send)
+        response.raise_for_status()
+        context_cache.record_success(upstream, model_name)
+    except asyncio.CancelledError:
+        endpoint.observe_latency(time.perf_counter() - attempt_start)
+        raise
+    except Exception:
+        endpoint.record(None, False)
+        metrics.upstream_requests_total.inc(_upstream_label(endpoint), "error")
+        raise
+    endpoint.record(time.perf_counter() - attempt_start, True)
+    metrics.upstream_requests_total.inc(_upstream_label(endpoint), "ok")
+    return response
+
+
+def _hedge_delay(endpoint: Endpoint) -> float:
+    delay = endpoint.latency_percentile(CHAT_HEDGE_PERCENTILE, CHAT_HEDGE_MIN_SAMPLES)
+    return CHAT_HEDGE_DEFAULT_DELAY if delay is None else delay
+
+
+async def _hedged_post(primary: Endpoint, alternate: Endpoint, data: Dict,
+                       model_name: str, tried: Optional[List[Endpoint]] = None) -> httpx.Response:
+    """对冲请求: 主请求超过近期延迟分位数仍未返回时, 再向备用端点发一个相同请求
+
+    先成功返回的结果胜出, 另一个请求被取消; 两个都失败时抛出主请求的异常。
+    真正发出了对冲请求时把备用端点加入tried, 故障切换不再重试它。
+    """
+    hedge_budget.deposit()
+    delay = _hedge_delay(primary)
+    primary_task = asyncio.ensure_future(_post_chat(primary, data, model_name))
+    done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    if done:
+        return primary_task.result()
+    if not hedge_budget.try_withdraw():
+        metrics.chat_hedges_total.inc(model_name, "over_budget")
+        return await primary_task
+    metrics.chat_hedges_total.inc(model_name, "sent")
+    logging.info("Hedging chat request to %s after %.3fs", alternate.name, delay)
+    if tried is not None:
+        tried.append(alternate)
+    hedge_task = asyncio.ensure_future(_post_chat(alternate, data, model_name))
+    pending = {primary_task, hedge_task}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = "primary" if task is primary_task else "hedge"
+                    metrics.chat_hedge_wins_total.inc(model_name, winner)
+                    return task.result()
+        return primary_task.result()
+    finally:
+        for task in (primary_task, hedge_task):
+            if not task.done():
+                task.cancel()
+
+
+async def nonstream_generator(endpoints: List[Endpoint], data: Dict,
+                              model_name: str = "",
+                              hedge: bool = False,
+                              caller: Optional[Caller] = None) -> Dict:
     """非流生成器
 
     Args:
-        url (str): 模型地址
-        headers (Dict): 请求头
+        endpoints (List[Endpoint]): 按健康度排序的上游端点, 失败时依次切换
         data (Dict): 请求数据
+        model_name (str): 模型名称, 用于指标标签
+        hedge (bool): 是否对第一个端点的请求做对冲
+        caller (Optional[Caller]): 调用方, 用于记录用量
 
     Returns:
         Dict: 封装的json回答
 
     """
-    async with httpx.AsyncClient(timeout=httpx.Timeout(300.0)) as client:
-        response = await client.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        data = response.json()['choices'][0]['message']
-        return data
+    start = time.perf_counter()
+    remaining = list(endpoints)
+    usage = None
+    try:
+        while remaining:
+            endpoint = remaining.pop(0)
+            try:
+                if hedge:
+                    hedge = False
+                    # 有备用端点时对冲到备用端点, 否则对冲到同一端点
+                    alternate = remaining[0] if remaining else endpoint
+                    hedged: List[Endpoint] = []
+                    try:
+                        response = await _hedged_post(endpoint, alternate, data, model_name, hedged)
+                    finally:
+                        # 对冲过的端点已经失败或被取消, 不再作为切换目标
+                        remaining = [e for e in remaining if e not in hedged]
+                else:
+                    response = await _post_chat(endpoint, data, model_name)
+            except Exception as e:
+                if not remaining or not _should_failover(e):
+                    raise
+                logging.warning("Endpoint %s failed, failing over: %s", endpoint.name, e)
+                metrics.chat_failovers_total.inc(model_name, endpoint.label)
+                continue
+            response_json = response.json()
+            usage = response_json.get("usage")
+            return response_json['choices'][0]['message']
+        raise ValueError("没有可用的上游端点")
+    finally:
+        _record_usage(model_name, usage, caller)
+        metrics.chat_duration_seconds.observe(
+            time.perf_counter() - start, model_name, "false")
 
 
 class ChatMessage(BaseModel):
@@ -116,10 +441,10 @@ class ReqJson(BaseModel):
     """纯文本的请求体"""
     messages: List[ChatMessage] = Field(..., description="List of chat messages")
     files: List[str] = Field([], description="List of file URLs")
+    session_id: Optional[str] = Field(
+        None, description="Session returned in X-Session-Id; messages then only hold the new turn")
 
 
-ModelSection = Enum("ModelSection", {section.upper(): section.lower()
-                                     for section in config.sections()})
 Thinking = Enum("Thinking", {"enabled": "enabled", "disabled": "disabled",
                              "auto": "auto"})
 
@@ -188,7 +513,8 @@ async def _build_messages(_messages: List[Dict], _file_urls: List[str],
             and not f.endswith(_img_suffix))
     ]
 
-    logging.debug(f"{_text_urls=}\n{_img_urls=}\n{_other_urls=}")
+    logging.debug("_text_urls=%s\n_img_urls=%s\n_other_urls=%s",
+                  _text_urls, _img_urls, _other_urls)
 
     if _other_urls:
         raise ValueError(f"上传了不允许的文件：{_other_urls}")
@@ -209,6 +535,16 @@ async def _build_messages(_messages: List[Dict], _file_urls: List[str],
         })
     elif _text_urls:
         _text_content = await _fetch_text_content(_text_urls)
+        if CONTEXT_CACHE_ENABLED:
+            # 文档放在开头的system消息之后, 每轮都相同, 可以作为上游缓存的前缀
+            _prefix, _history = split_prefix(_messages[:-1])
+            return _prefix + [{
+                "role": "system",
+                "content": "基于以下内容回答: " + _text_content
+            }] + _history + [{
+                "role": "user",
+                "content": _messages[-1]["content"]
+            }]
         _last_message_content = [{
             "text": _messages[-1]["content"] + "\t基于以下内容回答: " + _text_content,
             "type": "text"
@@ -222,48 +558,109 @@ async def _build_messages(_messages: List[Dict], _file_urls: List[str],
     }]
 
 
-async def handle_stream_response(url: str, headers: Dict,
-                                 data: Dict) -> StreamingResponse:
+class QuotaStreamingResponse(StreamingResponse):
+    """发送结束后归还调用方的流式并发名额
+
+    名额在返回响应之前由usage_ledger.admit占用。客户端在第一个数据块之前断开时
+    生成器可能从未开始执行, 它的finally也不会运行, 所以在响应本身结束时归还。
+    """
+
+    def __init__(self, content, caller: Optional[Caller] = None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.caller = caller
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.caller is not None:
+                usage_ledger.release_stream(self.caller)
+
+
+async def handle_stream_response(endpoints: List[Endpoint], data: Dict,
+                                 model_name: str = "",
+                                 timing: bool = False,
+                                 caller: Optional[Caller] = None,
+                                 on_answer: Optional[AnswerHook] = None
+                                 ) -> StreamingResponse:
     """Handle streaming response generation
     
     Note: This function is async because it uses an async generator internally,
     even though it doesn't directly await anything.
     """
-    return StreamingResponse(
-        stream_generator(url, headers, data),
+    return QuotaStreamingResponse(
+        stream_generator(endpoints, data, model_name, timing, caller, on_answer),
+        caller=caller,
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "X-Accel-Buffering": "no",
-            "Connection": "keep-alive",
-            "Transfer-Encoding": "chunked"
-        }
+        headers=SSE_HEADERS
     )
 
 
-async def handle_nonstream_response(url: str,
-                                    headers: Dict, data: Dict) -> Response:
+async def handle_nonstream_response(endpoints: List[Endpoint], data: Dict,
+                                    model_name: str = "",
+                                    hedge: bool = False,
+                                    caller: Optional[Caller] = None,
+                                    on_answer: Optional[AnswerHook] = None) -> Response:
     """Handle non-streaming response generation"""
-    data = await nonstream_generator(url, headers, data)
-    return Response(
-        json.dumps({
-            "code": 1,
-            "msg": "success",
-            "data": data,
-            "status": 200
-        }),
-        status_code=200,
-        media_type=JSON_MEDIA_TYPE
-    )
+    data = await nonstream_generator(endpoints, data, model_name, hedge, caller)
+    if on_answer is not None:
+        on_answer(data)
+    return envelope_response(data)
+
+
+async def cached_stream_generator(message: Dict, model_name: str, similarity: float,
+                                  timing: bool = False,
+                                  caller: Optional[Caller] = None,
+                                  on_answer: Optional[AnswerHook] = None
+                                  ) -> AsyncGenerator[str, None]:
+    """以上游流式输出的格式返回语义缓存中的回答"""
+    start = time.perf_counter()
+    try:
+        for event in replay_events(message):
+            if timing and event.startswith('data: {"isDone"'):
+                yield "event: timing\ndata: " + dumps_str({
+                    "model": model_name,
+                    "semantic_cache_similarity": round(similarity, 4),
+                    "total_ms": round((time.perf_counter() - start) * 1000, 1)
+                }) + "\n\n"
+            yield event
+        if on_answer is not None:
+            on_answer(message)
+    finally:
+        _record_usage(model_name, None, caller)
+
+
+def cached_response(message: Dict, model_name: str, similarity: float, stream: bool,
+                    timing: bool = False, caller: Optional[Caller] = None,
+                    on_answer: Optional[AnswerHook] = None) -> Response:
+    """语义缓存命中时的响应, 带X-Semantic-Cache头"""
+    logging.info("Semantic cache hit for %s, similarity %.4f", model_name, similarity)
+    if stream:
+        return QuotaStreamingResponse(
+            cached_stream_generator(message, model_name, similarity, timing, caller,
+                                    on_answer),
+            caller=caller,
+            media_type="text/event-stream",
+            headers={**SSE_HEADERS, "X-Semantic-Cache": "hit"}
+        )
+    _record_usage(model_name, None, caller)
+    if on_answer is not None:
+        on_answer(message)
+    return envelope_response(message, headers={"X-Semantic-Cache": "hit"})
 
 
 @router.post("/chat", response_model=None)
 async def chat(
     req_json: ReqJson,
-    model: ModelSection,
+    model: str,
     stream: bool = True,
     thinking: Optional[Thinking] = None,
-    max_tokens: int = 4096
+    max_tokens: int = 4096,
+    timing: bool = False,
+    hedge: Optional[bool] = None,
+    semantic_cache: bool = True,
+    new_session: bool = False,
+    x_api_key: Optional[str] = Header(None, alias=API_KEY_HEADER)
 ) -> Union[StreamingResponse, Response]:
     """对外提供大模型聊天服务
     Args:
@@ -271,6 +668,12 @@ async def chat(
         model str: 模型名称
         stream bool: 是否流式返回, 默认为True
         thinking bool: 是否深度思考, 默认为False
+        timing bool: 流式返回时是否在结束前追加timing事件, 默认为False
+        hedge bool: 非流式返回时是否发送对冲请求, 默认取CHAT_HEDGE_ENABLED
+        semantic_cache bool: 开启了SEMANTIC_CACHE_ENABLED时, False表示本次不读写语义缓存
+        new_session bool: 开始一个服务端会话, 会话id在响应头X-Session-Id中返回,
+            之后的请求在请求体中带上session_id, messages只需包含新消息
+        x_api_key str: 调用方的API key, 用于限额和用量统计, 会话按调用方隔离
     Returns:
         要么StreamingResponse，要么Response
     """
@@ -278,15 +681,50 @@ async def chat(
         req_dict = req_json.dict()
         _messages = req_dict.get("messages", [])
         _files = req_dict.get("files", [])
-        logging.debug(f"Received messages: {_messages}")
-        logging.debug(f"Received files: {_files}")
+        log_payload("Received messages: %s", _messages)
+        logging.debug("Received files: %s", _files)
     except Exception as e:
         return get_error_response(f"请求格式错误，请检查输入数据：{e}")
 
-    model_name = model.value.lower()
-    if model_name not in config.sections():
+    # 取一次当前配置, 请求处理期间配置被重新加载也不受影响
+    spec = model_registry.snapshot.get(model)
+    if spec is None:
         return get_error_response(
-            f"模型 {model_name} 不在 DouBao 支持的模型列表中: {config.sections()}")
+            f"模型 {model} 不在 DouBao 支持的模型列表中: {list(model_registry.snapshot.names)}")
+    model_name = spec.name
+
+    # 先识别调用方, 未登记的key不能读取或创建会话
+    try:
+        caller = usage_ledger.caller(x_api_key)
+    except QuotaExceededError as e:
+        return _quota_error_response(e)
+
+    # 带session_id时messages只包含本轮的新消息, 之前的对话从会话中取出;
+    # new_session的会话在通过限额检查后才创建, 被拒绝的请求不留下会话
+    session = None
+    session_id = req_dict.get("session_id")
+    new_messages = _messages
+    dropped: List[Dict] = []
+    if session_id or new_session:
+        unavailable = _sessions_unavailable()
+        if unavailable is not None:
+            return unavailable
+    if session_id:
+        if len(session_id) > SESSION_ID_MAX_LENGTH:
+            return get_error_response(f"session_id不能超过{SESSION_ID_MAX_LENGTH}个字符")
+        session = await session_store.get(caller.id, session_id)
+        if session is None:
+            return get_error_response(
+                f"会话 {session_id} 不存在或已过期, 请使用new_session=true开始新的会话", status=404)
+    if session is not None:
+        budget = SESSION_CONTEXT_TOKENS - sum(message_tokens(m) for m in new_messages)
+        # 本轮的system消息替换会话中保存的, 放在历史之前
+        new_system = [m for m in new_messages if m.get("role") == "system"]
+        history, dropped = session.window(budget, pin_system=not new_system)
+        _messages = new_system + history + [m for m in new_messages if m.get("role") != "system"]
+        metrics.chat_session_messages_total.inc("client", amount=len(new_messages))
+        metrics.chat_session_messages_total.inc("history", amount=len(history))
+        metrics.chat_session_messages_total.inc("dropped", amount=len(dropped))
 
     try:
         messages = await _build_messages(_messages, _files, model_name)
@@ -297,12 +735,12 @@ async def chat(
 
     thinking_obj = {
         "type": thinking.value,
-    } if config[model_name]["thinking"] == "true" else None
+    } if spec.thinking else None
 
     max_tokens = min(max_tokens, 16000)
 
     data = {
-        "model": "-".join([model_name, config[model_name]["version"]]),
+        "model": spec.upstream_model,
         "messages": messages,
         "stream": stream,
         "thinking": thinking_obj,
@@ -317,35 +755,179 @@ async def chat(
             }
         })
 
-    logging.debug(f"Request data:\n {data}\n")
+    log_payload("Request data:\n %s\n", data)
 
-    url = Url.DOUBAO.value
-    token = Token.DOUBAO.value
-    headers = {
-        "Accept": JSON_MEDIA_TYPE,
-        "Content-Type": JSON_MEDIA_TYPE,
-        "Authorization": f"Bearer {token}"
-    }
+    endpoints = provider_registry.select(list(spec.endpoints))
+    if not endpoints:
+        return get_error_response(f"模型 {model_name} 没有可用的上游端点")
 
     try:
-        if stream:
-            return await handle_stream_response(url, headers, data)
-        return await handle_nonstream_response(url, headers, data)
+        usage_ledger.admit(caller, stream)
+    except QuotaExceededError as e:
+        return _quota_error_response(e)
+
+    cache_query = None
+    created = False
+
+    def on_answer(message: Dict, cached: bool = False) -> None:
+        if cache_query is not None and not cached:
+            answer_cache.store(cache_query, message)
+        if session is not None:
+            _record_session_turn(session, new_messages, message, dropped,
+                                 spec, endpoints, caller)
+
+    try:
+        if new_session and session is None:
+            session = await session_store.create(caller.id)
+            session_id = session.key[1]
+            created = True
+        answer_hook = on_answer if session is not None else None
+        if SEMANTIC_CACHE_ENABLED and semantic_cache:
+            cache_query = await answer_cache.query(
+                _messages, _files, model_name, caller.id, spec.upstream_model,
+                data["thinking"], max_tokens)
+            if cache_query is not None:
+                answer_hook = on_answer
+        cached = answer_cache.lookup(cache_query) if cache_query is not None else None
+        if cached is not None:
+            message, similarity = cached
+            response = cached_response(message, model_name, similarity, stream, timing, caller,
+                                       lambda answer: on_answer(answer, cached=True))
+        elif stream:
+            response = await handle_stream_response(endpoints, data, model_name,
+                                                    timing, caller, answer_hook)
+        else:
+            if hedge is None:
+                hedge = CHAT_HEDGE_ENABLED
+            response = await handle_nonstream_response(endpoints, data, model_name, hedge,
+                                                       caller, answer_hook)
     except Exception as e:
+        if stream:
+            # 流式响应没有创建出来, 由这里归还admit占用的名额
+            usage_ledger.release_stream(caller)
+        if created:
+            # 客户端拿不到会话id, 不保留这个会话
+            await session_store.delete(caller.id, session_id)
         return get_error_response(f"Error processing request: {e}")
+    if session is not None:
+        response.headers["X-Session-Id"] = session_id
+    return response
+
+
+SUMMARY_PROMPT = ("请用简洁的中文总结以下对话, 保留其中的事实, 数字, 结论和用户提出的要求, "
+                  "供之后的对话参考。只输出摘要。")
+
+
+def _record_session_turn(session: Session, new_messages: List[Dict], answer: Dict,
+                         dropped: List[Dict], spec: ModelSpec, endpoints: List[Endpoint],
+                         caller: Optional[Caller]) -> None:
+    """把本轮的新消息和回答写入会话, 移出窗口的消息足够多时在后台总结"""
+    content = answer.get("content")
+    session_store.record_turn(session, new_messages + [
+        {"role": "assistant", "content": content if isinstance(content, str) else ""}])
+    if not SESSION_SUMMARY_ENABLED or len(dropped) < SESSION_SUMMARY_MIN_MESSAGES:
+        return
+
+    async def summarise(text: str) -> str:
+        data = {
+            "model": spec.upstream_model,
+            "messages": [{"role": "system", "content": SUMMARY_PROMPT},
+                         {"role": "user", "content": text}],
+            "stream": False,
+            "thinking": {"type": "disabled"} if spec.thinking else None,
+            "max_tokens": SESSION_SUMMARY_MAX_TOKENS
+        }
+        message = await nonstream_generator(endpoints, data, spec.name, caller=caller)
+        return message.get("content") or ""
+
+    session_store.summarise_later(session, dropped, summarise)
+
+
+def upstream_urls() -> List[str]:
+    """所有模型配置的上游地址, 启动时用于预热连接"""
+    urls = []
+    for spec in model_registry.snapshot.models.values():
+        endpoints = provider_registry.select(list(spec.endpoints))
+        urls.extend(endpoint.url for endpoint in endpoints)
+    return urls
+
+
+def _quota_error_response(e: QuotaExceededError) -> Response:
+    headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+    return get_error_response(str(e), status=e.status_code,
+                              status_code=e.status_code, headers=headers)
+
+
+def _sessions_unavailable() -> Optional[Response]:
+    """多worker运行时内存中的会话只在一个worker里, 下一轮可能被分到其他worker, 需要SESSION_DB"""
+    if lifecycle.workers > 1 and not SESSION_DB:
+        return get_error_response(
+            f"服务以{lifecycle.workers}个worker运行, 未配置SESSION_DB, 不能使用会话", status=503)
+    return None
+
+
+async def on_startup() -> None:
+    model_registry.start()
+    await semantic_cache_startup()
+    await session_store.start()
+    if lifecycle.workers > 1 and not SESSION_DB:
+        logging.error("SESSION_DB is not set while running %d workers, chat sessions are disabled",
+                      lifecycle.workers)
+    if lifecycle.workers > 1 and usage_ledger.enforces_limits():
+        logging.error("Quotas are counted per worker while running %d workers, "
+                      "each caller may use up to %d times its limits",
+                      lifecycle.workers, lifecycle.workers)
+
+
+async def on_shutdown() -> None:
+    model_registry.stop()
+    await session_store.stop()
 
 
 @router.get("/chat_model_list", response_model=ChatResponse) 
-async def chat_model_list() -> Response:
-    """获取模型列表"""
-    return Response(
-        json.dumps({
-            "code": 1,
-            "msg": "success",
-            "data": {section: dict(config[section])
-                     for section in config.sections()},
-            "status": 200
-        }),
-        status_code=200,
-        media_type=JSON_MEDIA_TYPE
-    )
+async def chat_model_list(
+    if_none_match: Optional[str] = Header(None)
+) -> Response:
+    """获取模型列表, 响应体在加载配置时已生成, 客户端可用ETag做条件请求"""
+    return model_registry.snapshot.model_list.response(if_none_match)
+
+
+@router.get("/sessions/{session_id}", response_model=ChatResponse)
+async def get_session(
+    session_id: str,
+    x_api_key: Optional[str] = Header(None, alias=API_KEY_HEADER)
+) -> Response:
+    """查看会话保存的消息和摘要"""
+    unavailable = _sessions_unavailable()
+    if unavailable is not None:
+        return unavailable
+    try:
+        caller = usage_ledger.caller(x_api_key)
+    except QuotaExceededError as e:
+        return _quota_error_response(e)
+    session = await session_store.get(caller.id, session_id)
+    if session is None:
+        return get_error_response(f"会话 {session_id} 不存在", status=404)
+    return envelope_response({
+        "session_id": session_id,
+        "summary": session.summary,
+        "messages": [{"role": message["role"], "content": message["content"]}
+                     for message in session.messages]
+    })
+
+
+@router.delete("/sessions/{session_id}", response_model=ChatResponse)
+async def delete_session(
+    session_id: str,
+    x_api_key: Optional[str] = Header(None, alias=API_KEY_HEADER)
+) -> Response:
+    """删除会话"""
+    unavailable = _sessions_unavailable()
+    if unavailable is not None:
+        return unavailable
+    try:
+        caller = usage_ledger.caller(x_api_key)
+    except QuotaExceededError as e:
+        return _quota_error_response(e)
+    deleted = await session_store.delete(caller.id, session_id)
+    return envelope_response({"session_id": session_id, "deleted": deleted})
@@ -0,0 +1,256 @@
+import os
+import zlib
+from typing import Dict, List, Optional, Tuple
+from . import metrics
+
+try:
+    # 可选依赖: pip install .[speed]
+    import brotli
+except ImportError:  # pragma: no cover - 取决于安装环境
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - 取决于安装环境
+    zstandard = None
+
+# 是否压缩响应
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+# 可用的编码, 同等q值时按此顺序优先; 未安装brotli/zstandard的编码会被跳过
+COMPRESSION_ENCODINGS = [
+    name.strip() for name in os.getenv("COMPRESSION_ENCODINGS", "br,zstd,gzip").split(",")
+    if name.strip()
+]
+# 小于该字节数的非流式响应不压缩
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# 不压缩的路径前缀, 静态文件另有预压缩
+COMPRESSION_EXCLUDE_PATHS = tuple(
+    path.strip() for path in os.getenv("COMPRESSION_EXCLUDE_PATHS", "/static").split(",")
+    if path.strip())
+# 压缩的Content-Type前缀, 图片和音频本身已经压缩过
+COMPRESSION_MEDIA_TYPES = tuple(
+    media_type.strip() for media_type in os.getenv(
+        "COMPRESSION_MEDIA_TYPES",
+        "application/json,application/x-ndjson,text/,application/javascript,image/svg+xml"
+    ).split(",") if media_type.strip())
+# 是否压缩SSE流; 开启时每个事件之后都会刷新压缩器, 客户端可以立即解出该事件
+COMPRESSION_SSE = os.getenv("COMPRESSION_SSE", "true").lower() == "true"
+# 各编码的压缩级别, 取偏向速度的值
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+
+
+class GzipEncoder:
+    """gzip增量压缩, flush时输出已写入的全部数据(Z_SYNC_FLUSH)"""
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        output = self._compressor.compress(data)
+        if flush:
+            output += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return output
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        output = self._compressor.process(data)
+        if flush:
+            output += self._compressor.flush()
+        return output
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        output = self._compressor.compress(data)
+        if flush:
+            output += self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return output
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+ENCODERS = {"gzip": GzipEncoder}
+if brotli is not None:
+    ENCODERS["br"] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS["zstd"] = ZstdEncoder
+AVAILABLE_ENCODINGS = [name for name in COMPRESSION_ENCODINGS if name in ENCODERS]
+
+
+def negotiate(accept_encoding: str, available: List[str] = AVAILABLE_ENCODINGS) -> Optional[str]:
+    """按Accept-Encoding的q值选择编码, q值相同时按available的顺序"""
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+    best: Optional[Tuple[float, int]] = None
+    choice = None
+    for rank, name in enumerate(available):
+        quality = weights.get(name, weights.get("*", 0.0))
+        if quality <= 0:
+            continue
+        if best is None or (quality, -rank) > best:
+            best = (quality, -rank)
+            choice = name
+    return choice
+
+
+def _compressible(headers: Dict[bytes, bytes]) -> bool:
+    if b"content-encoding" in headers:
+        return False
+    media_type = headers.get(b"content-type", b"").decode("latin-1").split(";")[0].strip()
+    if media_type == "text/event-stream":
+        return COMPRESSION_SSE
+    return media_type.startswith(COMPRESSION_MEDIA_TYPES)
+
+
+class CompressionMiddleware:
+    """按Accept-Encoding压缩响应
+
+    非流式响应整体压缩, 小于COMPRESSION_MIN_SIZE的不压缩; 流式响应(SSE, ndjson,
+    b64图片流)逐块压缩并在每块之后刷新, 每个事件仍然立即送达, 不影响首字延迟。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (not COMPRESSION_ENABLED or scope["type"] != "http" or scope["method"] == "HEAD"
+                or scope["path"].startswith(COMPRESSION_EXCLUDE_PATHS)):
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for key, value in scope.get("headers", []):
+            if key == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = negotiate(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressingResponder(send, encoding).run(self.app, scope, receive)
+
+
+class _CompressingResponder:
+    def __init__(self, send, encoding: str):
+        self.send = send
+        self.encoding = encoding
+        self.start_message: Optional[Dict] = None
+        # None: 尚未决定; False: 原样发送; True: 压缩
+        self.compressing: Optional[bool] = None
+        self.encoder = None
+        self.original_bytes = 0
+        self.compressed_bytes = 0
+
+    async def run(self, app, scope, receive) -> None:
+        try:
+            await app(scope, receive, self.send_wrapper)
+        finally:
+            if self.compressing:
+                metrics.http_compressed_bytes_total.inc(
+                    self.encoding, "original", amount=self.original_bytes)
+                metrics.http_compressed_bytes_total.inc(
+                    self.encoding, "compressed", amount=self.compressed_bytes)
+
+    async def send_wrapper(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if self.compressing is None:
+            if message["type"] != "http.response.body":
+                await self._pass_through(message)
+                return
+            await self._start(message)
+            return
+        if not self.compressing:
+            await self.send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        output = self.encoder.compress(body, flush=more_body)
+        if not more_body:
+            output += self.encoder.finish()
+        self.original_bytes += len(body)
+        self.compressed_bytes += len(output)
+        if output or not more_body:
+            await self.send({"type": "http.response.body", "body": output,
+                             "more_body": more_body})
+
+    async def _pass_through(self, message) -> None:
+        self.compressing = False
+        if self.start_message is not None:
+            await self.send(self.start_message)
+        await self.send(message)
+
+    async def _start(self, message) -> None:
+        """收到第一个响应体时决定是否压缩"""
+        start = self.start_message
+        headers = dict(start.get("headers", [])) if start else {}
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        status = start["status"] if start else 200
+        declared_length = headers.get(b"content-length")
+        too_small = (len(body) < COMPRESSION_MIN_SIZE if not more_body
+                     else declared_length is not None
+                     and int(declared_length) < COMPRESSION_MIN_SIZE)
+        if (start is None or status < 200 or status in (204, 304)
+                or not _compressible(headers) or too_small):
+            await self._pass_through(message)
+            return
+        self.compressing = True
+        self.encoder = ENCODERS[self.encoding]()
+        output = self.encoder.compress(body, flush=more_body)
+        if not more_body:
+            output += self.encoder.finish()
+        self.original_bytes += len(body)
+        self.compressed_bytes += len(output)
+        start["headers"] = self._compressed_headers(
+            start.get("headers", []), None if more_body else len(output))
+        await self.send(start)
+        await self.send({"type": "http.response.body", "body": output,
+                         "more_body": more_body})
+
+    def _compressed_headers(self, raw_headers, content_length: Optional[int]) -> List:
+        headers = []
+        vary = None
+        for key, value in raw_headers:
+            if key == b"content-length":
+                continue
+            if key == b"vary":
+                vary = value
+                continue
+            if key == b"etag" and value.startswith(b'"'):
+                # 压缩后的字节不同, 强ETag改为弱ETag
+                value = b"W/" + value
+            headers.append((key, value))
+        headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+        if vary is None:
+            vary = b"Accept-Encoding"
+        elif b"accept-encoding" not in vary.lower():
+            vary += b", Accept-Encoding"
+        headers.append((b"vary", vary))
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode("latin-1")))
+        return headers
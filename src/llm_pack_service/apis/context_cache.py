@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from . import metrics, resilience
+from .cache import make_cache_key
+from .providers import Endpoint
+from .sessions import message_tokens
+from .utils import get_http_client
+
+# 是否把长的固定前缀(系统提示, 文档)缓存在上游, 之后的请求只引用上下文id
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+# 缓存方式: ark使用方舟的上下文缓存接口; local在本地保存前缀, 请求时再展开, 用于测试和不支持的上游
+CONTEXT_CACHE_BACKEND = os.getenv("CONTEXT_CACHE_BACKEND", "ark").lower()
+# 前缀估算的token数不少于该值时才缓存
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))
+# 上游保留上下文的秒数; 本地提前CONTEXT_CACHE_REFRESH_MARGIN秒视为过期并重新创建
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_REFRESH_MARGIN = float(os.getenv("CONTEXT_CACHE_REFRESH_MARGIN", "60"))
+# 本地记录的上下文数
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "1000"))
+# 创建上下文失败后, 同一前缀在该秒数内不再尝试
+CONTEXT_CACHE_FAILURE_BACKOFF = float(os.getenv("CONTEXT_CACHE_FAILURE_BACKOFF", "60"))
+
+CHAT_PATH = "/chat/completions"
+ARK_CREATE_PATH = "/context/create"
+ARK_CHAT_PATH = "/context/chat/completions"
+
+
+class CachedContext(NamedTuple):
+    """上游保存的一个前缀"""
+    key: Tuple[str, str]
+    context_id: str
+    expires_at: float
+    # 前缀估算的token数, 每次引用省去重复发送这么多token
+    prefix_tokens: int
+    # 前缀消息, local方式每次请求时展开, ark方式在上游拒绝引用时用来重发
+    prefix: Tuple[Dict, ...] = ()
+
+
+class UpstreamRequest(NamedTuple):
+    """发给端点的实际请求"""
+    url: str
+    body: Dict
+    context: Optional[CachedContext] = None
+    # 上下文是否为本次请求新建的
+    created: bool = False
+
+
+def split_prefix(messages: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """把消息分成开头连续的system消息(固定前缀)和其余消息"""
+    index = 0
+    while (index < len(messages) and messages[index].get("role") == "system"
+           and isinstance(messages[index].get("content"), str)):
+        index += 1
+    return messages[:index], messages[index:]
+
+
+def ark_urls(chat_url: str) -> Optional[Tuple[str, str]]:
+    """由对话接口地址推出方舟上下文的创建和对话地址, 不是标准地址时返回None"""
+    base = chat_url.rstrip("/")
+    if not base.endswith(CHAT_PATH):
+        return None
+    base = base[:-len(CHAT_PATH)]
+    return base + ARK_CREATE_PATH, base + ARK_CHAT_PATH
+
+
+class ContextCache:
+    """上游前缀缓存
+
+    文档问答和带长系统提示的对话每轮都发送同样的前缀。前缀足够长时先在上游
+    创建上下文, 之后同一端点, 同一模型和同一前缀的请求只发送上下文id和后面的
+    消息。上下文在过期前重新创建; 上游拒绝引用(例如已被清理)时作废并按普通
+    请求重发。
+    """
+
+    def __init__(self, backend: str, max_entries: int):
+        self.backend = backend
+        self.max_entries = max_entries
+        self._contexts: "OrderedDict[Tuple[str, str], CachedContext]" = OrderedDict()
+        # 正在创建的上下文, 同一前缀的并发请求等待同一次创建
+        self._creating: Dict[Tuple[str, str], asyncio.Future] = {}
+        # 创建失败的前缀 -> 可以再次尝试的时间
+        self._failed: Dict[Tuple[str, str], float] = {}
+
+    async def prepare(self, endpoint: Endpoint, data: Dict, model_name: str) -> UpstreamRequest:
+        """返回发给endpoint的请求, 可以使用上下文时改为引用上下文"""
+        plain = UpstreamRequest(endpoint.url, data)
+        if not CONTEXT_CACHE_ENABLED:
+            return plain
+        prefix, rest = split_prefix(data["messages"])
+        if not rest:
+            return plain
+        prefix_tokens = sum(message_tokens(message) for message in prefix)
+        if prefix_tokens < CONTEXT_CACHE_MIN_TOKENS:
+            return plain
+        urls = ark_urls(endpoint.url) if self.backend == "ark" else None
+        if self.backend == "ark" and urls is None:
+            return plain
+        key = (endpoint.name, make_cache_key(data["model"], prefix))
+        context, created = await self._context(key, endpoint, data["model"], prefix,
+                                               prefix_tokens, model_name, urls)
+        if context is None:
+            return plain
+        body = {name: value for name, value in data.items() if name != "messages"}
+        if self.backend == "ark":
+            body["context_id"] = context.context_id
+            body["messages"] = rest
+            return UpstreamRequest(urls[1], body, context, created)
+        body["messages"] = list(context.prefix) + rest
+        return UpstreamRequest(endpoint.url, body, context, created)
+
+    def record_success(self, request: UpstreamRequest, model_name: str) -> None:
+        """引用上下文的请求成功后记录是否命中; ark方式命中时前缀没有再次发送, 计入省去的token"""
+        if request.context is None:
+            return
+        if request.created:
+            metrics.context_cache_requests_total.inc(model_name, "miss")
+            return
+        if self.backend != "ark":
+            # local方式每次仍发送完整前缀, 没有省去token
+            metrics.context_cache_requests_total.inc(model_name, "local_hit")
+            return
+        metrics.context_cache_requests_total.inc(model_name, "hit")
+        metrics.context_cache_saved_tokens_total.inc(
+            model_name, amount=request.context.prefix_tokens)
+
+    def invalidate(self, request: UpstreamRequest, model_name: str) -> UpstreamRequest:
+        """上游拒绝了上下文, 作废后返回不使用上下文的原请求"""
+        context = request.context
+        if self._contexts.get(context.key) is context:
+            del self._contexts[context.key]
+        metrics.context_cache_requests_total.inc(model_name, "rejected")
+        logging.warning("Upstream rejected context %s, resending the full prompt",
+                        context.context_id)
+        body = {name: value for name, value in request.body.items() if name != "context_id"}
+        if self.backend == "ark":
+            body["messages"] = list(context.prefix) + body["messages"]
+        return UpstreamRequest(self._plain_url(request), body)
+
+    @staticmethod
+    def _plain_url(request: UpstreamRequest) -> str:
+        if request.url.endswith(ARK_CHAT_PATH):
+            return request.url[:-len(ARK_CHAT_PATH)] + CHAT_PATH
+        return request.url
+
+    async def _context(self, key: Tuple[str, str], endpoint: Endpoint, model: str,
+                       prefix: List[Dict], prefix_tokens: int, model_name: str,
+                       urls: Optional[Tuple[str, str]]
+                       ) -> Tuple[Optional[CachedContext], bool]:
+        """返回可用的上下文及其是否为本次新建, 没有可用的上下文时返回(None, False)"""
+        now = time.time()
+        context = self._contexts.get(key)
+        if context is not None and context.expires_at > now:
+            self._contexts.move_to_end(key)
+            return context, False
+        if self._failed.get(key, 0) > now:
+            return None, False
+        creating = self._creating.get(key)
+        if creating is not None:
+            return await asyncio.shield(creating), False
+        future = asyncio.get_running_loop().create_future()
+        self._creating[key] = future
+        try:
+            context = await self._create(key, endpoint, model, prefix, prefix_tokens, urls)
+        except asyncio.CancelledError:
+            future.set_result(None)
+            raise
+        except Exception as e:
+            metrics.context_cache_requests_total.inc(model_name, "create_failed")
+            logging.warning("Failed to create upstream context on %s: %s", endpoint.name, e)
+            self._failed = {failed: until for failed, until in self._failed.items()
+                            if until > now}
+            self._failed[key] = now + CONTEXT_CACHE_FAILURE_BACKOFF
+            context = None
+        else:
+            self._failed.pop(key, None)
+            self._contexts[key] = context
+            while len(self._contexts) > self.max_entries:
+                self._contexts.popitem(last=False)
+        finally:
+            del self._creating[key]
+        future.set_result(context)
+        return context, context is not None
+
+    async def _create(self, key: Tuple[str, str], endpoint: Endpoint, model: str,
+                      prefix: List[Dict], prefix_tokens: int,
+                      urls: Optional[Tuple[str, str]]) -> CachedContext:
+        expires_at = time.time() + CONTEXT_CACHE_TTL - CONTEXT_CACHE_REFRESH_MARGIN
+        if self.backend != "ark":
+            return CachedContext(key, f"local-{key[1][:16]}", expires_at, prefix_tokens,
+                                 tuple(prefix))
+        client = get_http_client()
+        response = await resilience.call(
+            f"{endpoint.label}_context",
+            lambda: client.post(urls[0], headers=endpoint.headers(), json={
+                "model": model,
+                "messages": prefix,
+                "mode": "common_prefix",
+                "ttl": CONTEXT_CACHE_TTL
+            }))
+        response.raise_for_status()
+        return CachedContext(key, response.json()["id"], expires_at, prefix_tokens, tuple(prefix))
+
+
+context_cache = ContextCache(CONTEXT_CACHE_BACKEND, CONTEXT_CACHE_MAX_ENTRIES)
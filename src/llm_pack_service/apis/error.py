@@ -1,5 +1,6 @@
 from fastapi.responses import Response
-import json
+from typing import Dict, Optional
+from .responses import envelope_response
 
 class TaskSubmissionError(Exception):
     """Custom exception for task submission failures"""
@@ -9,16 +10,32 @@ class TaskQueryError(Exception):
     """Custom exception for task query failures"""
     pass
 
-def get_error_response(message: str) -> Response:
-    """生成错误响应"""
-    json_data = {
-        "code": 0,
-        "msg": message,
-        "data": {},
-        "status": 500
-    }
-    return Response(
-        json.dumps(json_data),
-        status_code=200,
-        media_type="application/json"
-    )
\ No newline at end of file
+class ImageGenerationError(Exception):
+    """Custom exception for image generation failures"""
+    pass
+
+class CircuitOpenError(Exception):
+    """Raised without calling the upstream while its circuit breaker is open"""
+    pass
+
+class QuotaExceededError(Exception):
+    """Raised when a caller is over its quota; status_code is 401 or 429"""
+
+    def __init__(self, message: str, status_code: int = 429,
+                 retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def get_error_response(message: str, status: int = 500, status_code: int = 200,
+                       headers: Optional[Dict[str, str]] = None) -> Response:
+    """生成错误响应
+
+    Args:
+        message str: 错误信息
+        status int: 响应体中的状态码
+        status_code int: HTTP状态码, 默认为200, 需要客户端退避时可使用429/503
+        headers Optional[Dict[str, str]]: 额外的响应头, 例如Retry-After
+    """
+    return envelope_response({}, msg=message, code=0, status=status,
+                             status_code=status_code, headers=headers)
\ No newline at end of file
@@ -1,19 +1,17 @@
-import os
-import json
 import logging
 from fastapi import APIRouter
 from fastapi.responses import Response
 from pydantic import BaseModel, Field, field_validator
 from dotenv import load_dotenv
-from .utils import ImageResponse
+from .utils import ImageResponse, cv_process
 from .error import get_error_response
-from volcengine.visual.VisualService import VisualService # type: ignore
+from .responses import envelope_response
+from .logs import log_payload, truncate
 
 # load env
 load_dotenv()
 
 router = APIRouter(prefix="/api/v1", tags=["智能图像"])
-JSON_MEDIA_TYPE = "application/json"
 
 
 class ControlnetArgs(BaseModel):
@@ -43,8 +41,8 @@ class RequestJson(BaseModel):
     
     @field_validator('binary_data_base64', 'image_urls')
     def validate_image_sources(cls, v, info):
-        logging.debug(f"{info = }")
-        logging.debug(f"{v = }")
+        logging.debug("info = %s", info)
+        logging.debug("v = %s", truncate(v))
         if isinstance(v, list) and not v:  # Skip validation if field is empty
             return v
         # Get the other field value from context
@@ -63,22 +61,10 @@ async def image2image(req_json: RequestJson) -> Response:
     try:
         # Pass context to validators
         req_dict = req_json.model_dump()
-        logging.debug(f"{req_dict = }")
+        log_payload("req_dict = %s", req_dict)
         
-        visual_service = VisualService()
-        visual_service.set_ak(os.getenv("VOLCEENGINE_ACCESS_KEY"))
-        visual_service.set_sk(os.getenv("VOLCEENGINE_SECRET_KEY"))
+        resp = await cv_process(req_dict)
         
-        resp = visual_service.cv_process(req_dict)
-        
-        return Response(
-            json.dumps({
-                "code": 1,
-                "msg": "success",
-                "data": resp,
-                "status": 200
-            }),
-            media_type="application/json"
-        )
+        return envelope_response(resp)
     except Exception as e:
         return get_error_response(str(e))
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import ipaddress
+import httpx
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Set, Union
+from urllib.parse import urlsplit
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse, Response
+from dotenv import load_dotenv
+from .utils import get_http_client
+from .error import get_error_response
+from .responses import dumps_str, envelope_response
+from .lifecycle import lifecycle
+from .records import RecordStore
+from . import metrics, text2image, image2image, out_painting
+
+# load env
+load_dotenv()
+
+router = APIRouter(prefix="/api/v1", tags=["图像任务"])
+
+JOB_KINDS = ("txt2img", "img2img", "out_painting", "img_enhance")
+FINISHED = ("succeeded", "failed")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))
+# 多worker时任务状态写在该目录中, 查询被分到其他worker时也能返回
+JOB_STATE_DIR = os.getenv("JOB_STATE_DIR", "./data/jobs")
+# 在其他worker中运行的任务, 推送SSE时轮询状态的间隔秒数
+JOB_POLL_INTERVAL = 1.0
+JOB_RETRY_AFTER = os.getenv("JOB_RETRY_AFTER", "5")
+# 允许回调的内网主机名, 逗号分隔; 其他主机必须解析到公网地址
+JOB_CALLBACK_ALLOWED_HOSTS = {
+    host.strip().lower() for host in os.getenv("JOB_CALLBACK_ALLOWED_HOSTS", "").split(",")
+    if host.strip()
+}
+
+
+class Job:
+    """图像任务的状态"""
+
+    def __init__(self, kind: str, runner: Callable[[], Awaitable[Response]],
+                 callback_url: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.runner = runner
+        self.callback_url = callback_url
+        self.status = "queued"
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+    def set_status(self, status: str) -> None:
+        self.status = status
+        # 唤醒正在等待状态变化的SSE连接
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class JobManager:
+    """每种任务一个队列, 由该类型自己的worker处理
+
+    每种任务的worker数等于其并发上限(JOB_CONCURRENCY_<KIND>), 一种任务积压时
+    不会占住其他类型的worker; JOB_WORKERS限制所有类型同时运行的任务总数,
+    JOB_QUEUE_SIZE限制所有队列中等待的任务总数。回调在单独的任务中发送,
+    不占用worker。多worker进程运行时, 任务状态每次变化都写入JOB_STATE_DIR。
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.jobs: Dict[str, Job] = {}
+        self.concurrency = {
+            kind: int(os.getenv(f"JOB_CONCURRENCY_{kind.upper()}", "2"))
+            for kind in JOB_KINDS
+        }
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._running: Optional[asyncio.Semaphore] = None
+        self._tasks: List[asyncio.Task] = []
+        self._callbacks: Set[asyncio.Task] = set()
+
+    def _ensure_started(self) -> None:
+        """在第一次提交任务时启动worker"""
+        if self._queues:
+            return
+        self._running = asyncio.Semaphore(self.workers)
+        for kind in JOB_KINDS:
+            queue: asyncio.Queue = asyncio.Queue()
+            self._queues[kind] = queue
+            self._tasks.extend(asyncio.create_task(self._worker(queue))
+                               for _ in range(self.concurrency[kind]))
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def submit(self, job: Job) -> bool:
+        """提交任务, 队列已满时返回False"""
+        self._purge()
+        self._ensure_started()
+        if self.queue_depth() >= self.queue_size:
+            return False
+        self._queues[job.kind].put_nowait(job)
+        self.jobs[job.id] = job
+        return True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    async def publish(self, job: Job) -> None:
+        """多worker时把任务状态写入共享目录"""
+        if lifecycle.workers <= 1:
+            return
+        try:
+            await job_records.put(job.id, job.to_dict())
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to save state of job %s: %s", job.id, e)
+
+    def _purge(self) -> None:
+        """清理过期的已完成任务"""
+        deadline = time.time() - JOB_RESULT_TTL
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.done and (job.finished_at or 0) < deadline]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        assert self._running is not None
+        while True:
+            job = await queue.get()
+            try:
+                async with self._running:
+                    await self._run(job)
+            except Exception as e:
+                logging.error("Job %s crashed: %s", job.id, e)
+            finally:
+                queue.task_done()
+            if job.callback_url:
+                task = asyncio.create_task(self._callback(job))
+                self._callbacks.add(task)
+                task.add_done_callback(self._callbacks.discard)
+
+    async def _run(self, job: Job) -> None:
+        job.started_at = time.time()
+        job.set_status("running")
+        await self.publish(job)
+        try:
+            response = await job.runner()
+            body = json.loads(bytes(response.body))
+            # 图像接口出错时返回code为0的错误响应
+            if isinstance(body, dict) and body.get("code") == 0:
+                job.error = body.get("msg", "")
+                status = "failed"
+            else:
+                job.result = body
+                status = "succeeded"
+            if response.background is not None:
+                await response.background()
+        except Exception as e:
+            job.error = str(e)
+            status = "failed"
+        job.finished_at = time.time()
+        job.set_status(status)
+        await self.publish(job)
+        logging.debug("Job %s (%s) %s in %.2fs", job.id, job.kind, status,
+                      job.finished_at - job.started_at)
+
+    async def _callback(self, job: Job) -> None:
+        try:
+            # 提交后域名可能被改为解析到内网, 发送前再检查一次
+            address = await check_callback_url(job.callback_url)
+            url = httpx.URL(job.callback_url)
+            headers: Dict[str, str] = {}
+            extensions: Dict[str, str] = {}
+            if address is not None:
+                # 直接连接检查过的地址, 否则httpx会再解析一次域名, 期间可能被换成内网地址;
+                # Host和TLS的SNI仍用原域名, 证书也按原域名校验
+                headers["Host"] = url.netloc.decode("ascii")
+                extensions["sni_hostname"] = url.host
+                url = url.copy_with(host=address)
+            response = await get_http_client().post(
+                url, json=job.to_dict(), headers=headers, extensions=extensions,
+                timeout=10.0, follow_redirects=False)
+            response.raise_for_status()
+        except Exception as e:
+            logging.warning("Callback for job %s to %s failed: %s", job.id, job.callback_url, e)
+
+
+async def check_callback_url(url: str) -> Optional[str]:
+    """检查回调地址: 只允许http(s), 主机须解析到公网地址, JOB_CALLBACK_ALLOWED_HOSTS中的主机除外
+
+    Returns:
+        Optional[str]: 检查过的地址, 回调时直接连接该地址; 允许的主机不检查, 返回None
+
+    Raises:
+        ValueError: 地址不合法, 或指向内网, 本机等非公网地址
+    """
+    parsed = urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("callback_url must be an http or https URL")
+    host = parsed.hostname.lower()
+    if host in JOB_CALLBACK_ALLOWED_HOSTS:
+        return None
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM)
+    except (ValueError, OSError) as e:
+        raise ValueError(f"callback_url host {host} cannot be resolved: {e}")
+    addresses = [ipaddress.ip_address(info[4][0].split("%", 1)[0]) for info in infos]
+    for address in addresses:
+        if not address.is_global:
+            raise ValueError(f"callback_url host {host} resolves to non-public address {address}")
+    if not addresses:
+        raise ValueError(f"callback_url host {host} cannot be resolved")
+    return str(addresses[0])
+
+
+job_records = RecordStore(JOB_STATE_DIR, JOB_RESULT_TTL)
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_SIZE)
+metrics.queue_depth.set_function(job_manager.queue_depth, "image_jobs")
+
+
+async def _submit(kind: str, runner: Callable[[], Awaitable[Response]],
+                  callback_url: Optional[str]) -> Response:
+    if callback_url:
+        try:
+            await check_callback_url(callback_url)
+        except ValueError as e:
+            return get_error_response(str(e), status=400)
+    job = Job(kind, runner, callback_url)
+    if not job_manager.submit(job):
+        return get_error_response(
+            "Job queue is full, please retry later", status=429, status_code=429,
+            headers={"Retry-After": JOB_RETRY_AFTER})
+    await job_manager.publish(job)
+    return envelope_response({"job_id": job.id, "status": job.status})
+
+
+@router.post("/jobs/txt2img", response_model=None)
+async def submit_txt2img(
+    req_json: text2image.ReqJson,
+    size: text2image.T2iImageSizes, # type: ignore
+    response_format: text2image.ResponseFormat, # type: ignore
+    guidance_scale: float = 2.5,
+    watermark: bool = False,
+    seed: int = 123,
+    callback_url: Optional[str] = None
+) -> Response:
+    """提交文本生成图像任务, 参数与/txt2img相同"""
+    return await _submit("txt2img", lambda: text2image.text_gen_image(
+        req_json, size, response_format, guidance_scale=guidance_scale,
+        watermark=watermark, seed=seed, stream=False), callback_url)
+
+
+@router.post("/jobs/img2img", response_model=None)
+async def submit_img2img(req_json: image2image.RequestJson,
+                         callback_url: Optional[str] = None) -> Response:
+    """提交图像到图像任务, 请求体与/img2img相同"""
+    return await _submit("img2img", lambda: image2image.image2image(req_json),
+                   callback_url)
+
+
+@router.post("/jobs/out_painting", response_model=None)
+async def submit_out_painting(req_json: out_painting.OutPaintingRequestJson,
+                              callback_url: Optional[str] = None) -> Response:
+    """提交智能扩图任务, 请求体与/out_painting相同"""
+    return await _submit("out_painting",
+                   lambda: out_painting.handle_out_painting(req_json),
+                   callback_url)
+
+
+@router.post("/jobs/img_enhance", response_model=None)
+async def submit_img_enhance(req_json: out_painting.ImgEnhanceRequestJson,
+                             callback_url: Optional[str] = None) -> Response:
+    """提交智能增图任务, 请求体与/img_enhance相同"""
+    return await _submit("img_enhance",
+                   lambda: out_painting.handle_img_enhace(req_json),
+                   callback_url)
+
+
+@router.get("/jobs/{job_id}", response_model=None)
+async def get_job(job_id: str) -> Response:
+    """查询任务状态和结果"""
+    job = job_manager.get(job_id)
+    if job is not None:
+        return envelope_response(job.to_dict())
+    record = await job_records.get(job_id) if lifecycle.workers > 1 else None
+    if record is None:
+        return get_error_response(f"Job {job_id} not found", status=404)
+    return envelope_response(record)
+
+
+async def job_event_generator(job: Job) -> AsyncGenerator[str, None]:
+    """任务状态变化时推送SSE事件, 任务结束后关闭"""
+    last_status = None
+    while True:
+        changed = job.changed
+        if job.status != last_status:
+            last_status = job.status
+            yield "data: " + dumps_str(job.to_dict()) + "\n\n"
+        if job.done:
+            return
+        try:
+            await asyncio.wait_for(changed.wait(), timeout=15.0)
+        except asyncio.TimeoutError:
+            # 心跳, 防止代理断开空闲连接
+            yield ": keep-alive\n\n"
+
+
+async def shared_job_event_generator(job_id: str, record: Dict) -> AsyncGenerator[str, None]:
+    """任务在其他worker中运行时, 轮询共享目录中的状态并推送变化"""
+    last_status = None
+    idle = 0.0
+    while True:
+        if record["status"] != last_status:
+            last_status = record["status"]
+            idle = 0.0
+            yield "data: " + dumps_str(record) + "\n\n"
+        if record["status"] in FINISHED:
+            return
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        idle += JOB_POLL_INTERVAL
+        if idle >= 15.0:
+            idle = 0.0
+            yield ": keep-alive\n\n"
+        record = await job_records.get(job_id)
+        if record is None:
+            return
+
+
+@router.get("/jobs/{job_id}/events", response_model=None)
+async def job_events(job_id: str) -> Union[StreamingResponse, Response]:
+    """以SSE的方式推送任务状态"""
+    job = job_manager.get(job_id)
+    if job is not None:
+        events = job_event_generator(job)
+    else:
+        record = await job_records.get(job_id) if lifecycle.workers > 1 else None
+        if record is None:
+            return get_error_response(f"Job {job_id} not found", status=404)
+        events = shared_job_event_generator(job_id, record)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
@@ -0,0 +1,69 @@
+import os
+import time
+import logging
+from typing import Dict, Optional
+
+# 收到退出信号后等待进行中请求的最长秒数, 超时后剩余请求被取消
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+# 距离排空期限不足该秒数时, 长轮询类请求(AUC)把任务交给下次启动继续处理
+SHUTDOWN_HANDOFF_MARGIN = float(os.getenv("SHUTDOWN_HANDOFF_MARGIN", "5"))
+
+# server启动时把worker进程数写入该环境变量, fork或spawn出的worker都能读到
+WORKERS_ENV = "LLM_PACK_WORKERS"
+
+
+class Lifecycle:
+    """进程的排空状态和进行中的长请求数
+
+    收到退出信号后进入draining: 不再接受新的任务, 已有的流式对话继续输出,
+    AUC轮询在期限前交接, /health返回排空进度。
+    """
+
+    def __init__(self):
+        self.drain_started: Optional[float] = None
+        self.in_flight: Dict[str, int] = {}
+        # 监听同一端口的worker进程数, 大于1时进程内的状态需要共享才能被所有worker查到
+        self.workers = int(os.getenv(WORKERS_ENV, "1"))
+
+    @property
+    def draining(self) -> bool:
+        return self.drain_started is not None
+
+    def begin_drain(self) -> None:
+        if self.drain_started is None:
+            self.drain_started = time.monotonic()
+            logging.info("Draining: %s in flight, deadline in %.0fs",
+                         self.in_flight, SHUTDOWN_DRAIN_TIMEOUT)
+
+    def remaining(self) -> Optional[float]:
+        """距离排空期限的秒数, 未在排空时返回None"""
+        if self.drain_started is None:
+            return None
+        return max(0.0, SHUTDOWN_DRAIN_TIMEOUT - (time.monotonic() - self.drain_started))
+
+    def handoff_due(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= SHUTDOWN_HANDOFF_MARGIN
+
+    def enter(self, kind: str) -> None:
+        self.in_flight[kind] = self.in_flight.get(kind, 0) + 1
+
+    def leave(self, kind: str) -> None:
+        self.in_flight[kind] = self.in_flight.get(kind, 1) - 1
+
+    def health(self) -> Dict:
+        """排空进度, 用于/health"""
+        if self.drain_started is None:
+            return {"status": "ok"}
+        remaining = self.remaining() or 0.0
+        return {
+            "status": "draining",
+            "drain": {
+                "elapsed_seconds": round(SHUTDOWN_DRAIN_TIMEOUT - remaining, 1),
+                "remaining_seconds": round(remaining, 1),
+                "in_flight": {kind: count for kind, count in self.in_flight.items() if count}
+            }
+        }
+
+
+lifecycle = Lifecycle()
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+from typing import Any, Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s - %(funcName)s] - %(message)s'
+# 单条日志中载荷的最大字符数, 超出部分只记录长度
+LOG_PAYLOAD_LIMIT = int(os.getenv("LOG_PAYLOAD_LIMIT", "2000"))
+# 载荷类DEBUG日志的采样率, 1表示全部记录
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1"))
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _shorten(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(+{len(text) - limit} chars)"
+
+
+class Truncated:
+    """日志参数的惰性包装: 只有日志真正输出时才格式化, 并截断过长的内容"""
+
+    __slots__ = ("value", "limit", "as_json")
+
+    def __init__(self, value: Any, limit: Optional[int] = None, as_json: bool = False):
+        self.value = value
+        self.limit = LOG_PAYLOAD_LIMIT if limit is None else limit
+        self.as_json = as_json
+
+    def __str__(self) -> str:
+        value = self.value() if callable(self.value) else self.value
+        if self.as_json:
+            try:
+                text = json.dumps(value, ensure_ascii=False, default=str)
+            except (TypeError, ValueError):
+                text = str(value)
+        else:
+            text = str(value)
+        return _shorten(text, self.limit)
+
+    __repr__ = __str__
+
+
+def truncate(value: Any, limit: Optional[int] = None) -> Truncated:
+    """惰性截断, 用法: logging.debug("data: %s", truncate(data))"""
+    return Truncated(value, limit)
+
+
+def lazy_json(value: Any, limit: Optional[int] = None) -> Truncated:
+    """惰性JSON序列化, value可以是返回数据的函数"""
+    return Truncated(value, limit, as_json=True)
+
+
+def log_payload(message: str, payload: Any,
+                logger: Optional[logging.Logger] = None) -> None:
+    """记录请求/响应载荷: DEBUG未开启时零开销, 开启时按采样率记录并截断"""
+    logger = logger or logging.getLogger()
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if LOG_PAYLOAD_SAMPLE_RATE < 1 and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    logger.debug(message, lazy_json(payload), stacklevel=2)
+
+
+def setup_logging(level: str) -> None:
+    """配置根日志: 业务线程只把记录放入队列, 由后台线程负责格式化和输出"""
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if os.getenv("LOG_ASYNC", "true").lower() != "true":
+        logging.basicConfig(level=level, handlers=[stream_handler])
+        return
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(
+        maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    queue_handler = _DroppingQueueHandler(log_queue)
+    # 入队前只格式化消息本身(含异常堆栈), 其余字段由后台线程按LOG_FORMAT输出
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+    _listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """停止后台日志线程并输出剩余日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_after_fork() -> None:
+    """fork出的worker中没有后台日志线程, 换一个新队列(旧队列的锁可能处于加锁状态)并重新启动"""
+    global _listener
+    if _listener is None:
+        return
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=_listener.queue.maxsize)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _DroppingQueueHandler):
+            handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(
+        log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志而不是阻塞事件循环"""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
@@ -0,0 +1,451 @@
+import os
+import json
+import time
+import bisect
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from fastapi import APIRouter
+from fastapi.responses import Response
+
+router = APIRouter(tags=["监控"])
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# 多worker运行时各worker把指标快照写入该目录, /metrics返回所有worker的合计;
+# 由多进程启动器设置, 为空时只返回本进程的指标
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR") or None
+# worker写出指标快照的间隔秒数
+METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", "5"))
+
+# 所有指标只在事件循环线程中更新, 单线程下的dict/float操作不需要加锁,
+# 热路径上的开销只有一次dict查找和一次加法。
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """指标基类"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """单调递增计数器"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [("", _format_labels(self.labelnames, labels), value)
+                for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """可增可减的瞬时值, 也可以由回调函数在采集时计算"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) - amount
+
+    def set(self, *labels, value: float) -> None:
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], float], *labels) -> None:
+        self._functions[labels] = function
+
+    def get(self, *labels) -> float:
+        if labels in self._functions:
+            return self._functions[labels]()
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        values = dict(self._values)
+        for labels, function in self._functions.items():
+            values[labels] = function()
+        return [("", _format_labels(self.labelnames, labels), value)
+                for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    """分桶直方图"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [各桶计数..., 总和, 总数]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        for labels, state in self._values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                samples.append(("_bucket", _format_labels(
+                    self.labelnames, labels, f'le="{_format_value(bound)}"'), cumulative))
+            samples.append(("_bucket", _format_labels(
+                self.labelnames, labels, 'le="+Inf"'), state[-1]))
+            samples.append(("_sum", _format_labels(self.labelnames, labels), state[-2]))
+            samples.append(("_count", _format_labels(self.labelnames, labels), state[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str,
+                labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames)) # type: ignore
+
+    def gauge(self, name: str, documentation: str,
+              labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames)) # type: ignore
+
+    def histogram(self, name: str, documentation: str,
+                  labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets)) # type: ignore
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> List[Dict]:
+        """可序列化的全部样本, 供多worker汇总"""
+        return [{"name": metric.name, "kind": metric.kind,
+                 "help": metric.documentation, "samples": metric.samples()}
+                for metric in self.metrics.values()]
+
+
+registry = MetricsRegistry()
+
+http_requests_total = registry.counter(
+    "http_requests_total", "HTTP requests by route, method and status code",
+    ("route", "method", "status"))
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency until the response body is complete",
+    ("route", "method"))
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being served")
+static_responses_total = registry.counter(
+    "static_responses_total",
+    "Static files served by source: memory, precompressed, disk, not_modified, "
+    "or inline for self /static URLs read in-process", ("source",))
+http_compressed_bytes_total = registry.counter(
+    "http_compressed_bytes_total",
+    "Response bytes before and after compression", ("encoding", "stage"))
+
+chat_duration_seconds = registry.histogram(
+    "llm_chat_duration_seconds", "Chat completion duration by model",
+    ("model", "stream"))
+chat_ttft_seconds = registry.histogram(
+    "llm_chat_time_to_first_token_seconds",
+    "Time from upstream request start to the first content delta", ("model",))
+chat_first_byte_seconds = registry.histogram(
+    "llm_chat_first_byte_seconds",
+    "Time from upstream request start to the first streamed line", ("model",))
+chat_inter_chunk_seconds = registry.histogram(
+    "llm_chat_inter_chunk_seconds", "Gap between consecutive streamed content deltas",
+    ("model",), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+chat_tokens_per_second = registry.histogram(
+    "llm_chat_tokens_per_second",
+    "Completion tokens per second after the first token of streamed chats", ("model",),
+    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500))
+chat_tokens_total = registry.counter(
+    "llm_chat_tokens_total", "Tokens reported by upstream usage", ("model", "type"))
+chat_streams_in_flight = registry.gauge(
+    "llm_chat_streams_in_flight", "Streamed chat responses currently open", ("model",))
+
+upstream_connect_seconds = registry.histogram(
+    "upstream_connect_seconds", "Upstream TCP/TLS connect time", ("upstream",))
+upstream_ttfb_seconds = registry.histogram(
+    "upstream_ttfb_seconds",
+    "Time from sending the upstream request to receiving response headers", ("upstream",))
+upstream_requests_total = registry.counter(
+    "upstream_requests_total", "Upstream requests by outcome", ("upstream", "outcome"))
+upstream_retries_total = registry.counter(
+    "upstream_retries_total", "Upstream requests retried after a transient failure",
+    ("upstream",))
+circuit_state = registry.gauge(
+    "upstream_circuit_state", "Circuit breaker state: 0 closed, 1 half open, 2 open",
+    ("upstream",))
+
+provider_latency_seconds = registry.gauge(
+    "provider_latency_seconds", "EWMA upstream latency used for endpoint selection",
+    ("endpoint",))
+provider_error_rate = registry.gauge(
+    "provider_error_rate", "Rolling upstream error rate used for endpoint selection",
+    ("endpoint",))
+chat_failovers_total = registry.counter(
+    "llm_chat_failovers_total", "Chat requests moved to another endpoint before the first byte",
+    ("model", "from_endpoint"))
+chat_hedges_total = registry.counter(
+    "llm_chat_hedges_total",
+    "Non-streaming chats that reached the hedge delay, by whether a hedge was sent",
+    ("model", "result"))
+chat_hedge_wins_total = registry.counter(
+    "llm_chat_hedge_wins_total", "Hedged chats by which request answered first",
+    ("model", "winner"))
+semantic_cache_lookups_total = registry.counter(
+    "llm_semantic_cache_lookups_total",
+    "Semantic chat cache lookups by result: hit, miss or expired", ("model", "result"))
+semantic_cache_stores_total = registry.counter(
+    "llm_semantic_cache_stores_total", "Answers stored in the semantic chat cache", ("model",))
+semantic_cache_evictions_total = registry.counter(
+    "llm_semantic_cache_evictions_total",
+    "Semantic chat cache entries removed by reason: lru, bytes, expired or replaced",
+    ("reason",))
+semantic_cache_size = registry.gauge(
+    "llm_semantic_cache_size", "Semantic chat cache size by unit: entries or bytes", ("unit",))
+chat_sessions = registry.gauge(
+    "llm_chat_sessions", "Chat sessions held in memory")
+chat_session_messages_total = registry.counter(
+    "llm_chat_session_messages_total",
+    "Messages of session chats by source: client (sent in the request), history "
+    "(added from the session) or dropped (outside the context window)", ("source",))
+chat_session_summaries_total = registry.counter(
+    "llm_chat_session_summaries_total", "Session history summaries by result", ("result",))
+context_cache_requests_total = registry.counter(
+    "llm_context_cache_requests_total",
+    "Chats with a cacheable prompt prefix by result: hit (reused an upstream context), "
+    "local_hit (reused a local prefix, still sent in full), miss (created one), "
+    "create_failed or rejected (resent in full)", ("model", "result"))
+context_cache_saved_tokens_total = registry.counter(
+    "llm_context_cache_saved_tokens_total",
+    "Estimated prompt prefix tokens not resent thanks to a reused upstream context", ("model",))
+admission_in_use = registry.gauge(
+    "admission_in_use", "Requests holding an admission slot", ("pool",))
+admission_wait_seconds = registry.histogram(
+    "admission_wait_seconds", "Time admitted requests waited for a slot", ("pool",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0))
+admission_rejected_total = registry.counter(
+    "admission_rejected_total", "Requests rejected by admission control", ("pool", "reason"))
+quota_rejected_total = registry.counter(
+    "quota_rejected_total", "Chat requests rejected by per-key quotas", ("reason",))
+
+model_config_reloads_total = registry.counter(
+    "model_config_reloads_total", "Model config reloads by result", ("result",))
+
+queue_depth = registry.gauge(
+    "queue_depth", "Items waiting in internal queues", ("queue",))
+
+
+def _add_label(labels: str, extra: str) -> str:
+    return labels[:-1] + "," + extra + "}" if labels else "{" + extra + "}"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_snapshot(directory: str) -> None:
+    """把本进程的指标快照原子地写入directory/<pid>.json"""
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def render_multiprocess(directory: str) -> str:
+    """合并所有worker的快照
+
+    计数器和直方图按相同标签求和, 已退出worker的计数仍然计入, 保证单调递增;
+    瞬时值加上worker标签分别输出, 已退出worker的瞬时值不再输出。
+    """
+    merged: Dict[str, Dict] = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".json"):
+            continue
+        pid = file_name[:-len(".json")]
+        try:
+            with open(os.path.join(directory, file_name), "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            alive = _pid_alive(int(pid))
+        except (OSError, ValueError):
+            continue
+        for metric in snapshot:
+            entry = merged.setdefault(metric["name"], {
+                "kind": metric["kind"], "help": metric["help"], "samples": {}})
+            samples = entry["samples"]
+            for suffix, labels, value in metric["samples"]:
+                if metric["kind"] == "gauge":
+                    if not alive:
+                        continue
+                    labels = _add_label(labels, f'worker="{pid}"')
+                samples[(suffix, labels)] = samples.get((suffix, labels), 0.0) + value
+    lines: List[str] = []
+    for name, entry in merged.items():
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['kind']}")
+        for (suffix, labels), value in entry["samples"].items():
+            lines.append(f"{name}{suffix}{labels} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+async def export_loop() -> None:
+    """多worker运行时定期写出本进程的指标快照"""
+    while METRICS_MULTIPROC_DIR:
+        try:
+            write_snapshot(METRICS_MULTIPROC_DIR)
+        except OSError as e:
+            logging.error("Failed to export metrics to %s: %s", METRICS_MULTIPROC_DIR, e)
+        await asyncio.sleep(METRICS_EXPORT_INTERVAL)
+
+
+class UpstreamTrace:
+    """httpx的trace回调, 记录上游连接耗时和首字节耗时"""
+
+    def __init__(self, upstream: str):
+        self.upstream = upstream
+        self._connect_started: Optional[float] = None
+        self._request_started: Optional[float] = None
+        self.ttfb: Optional[float] = None
+
+    async def __call__(self, event: str, info: Dict) -> None:
+        now = time.perf_counter()
+        if event.endswith("connect_tcp.started"):
+            self._connect_started = now
+        elif event.endswith("send_request_headers.started"):
+            # 复用连接时没有connect事件; 新建连接的耗时包含TLS握手
+            if self._connect_started is not None:
+                upstream_connect_seconds.observe(now - self._connect_started, self.upstream)
+                self._connect_started = None
+            self._request_started = now
+        elif event.endswith("receive_response_headers.complete"):
+            if self._request_started is not None:
+                self.ttfb = now - self._request_started
+                upstream_ttfb_seconds.observe(self.ttfb, self.upstream)
+
+    def extensions(self) -> Dict:
+        return {"trace": self}
+
+
+def trace_upstream(upstream: str) -> Dict:
+    """生成传给httpx请求的extensions参数"""
+    return UpstreamTrace(upstream).extensions()
+
+
+class MetricsMiddleware:
+    """记录每个路由的请求数和耗时(包含流式响应的完整耗时)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec()
+            route_path = getattr(scope.get("route"), "path", None)
+            if route_path is None:
+                # 静态文件等挂载的应用没有路由模板, 用挂载前缀避免标签基数膨胀
+                route_path = "/static" if scope["path"].startswith("/static") else "unmatched"
+            http_requests_total.inc(route_path, scope["method"], str(status["code"]))
+            http_request_duration_seconds.observe(
+                time.perf_counter() - start, route_path, scope["method"])
+
+
+@router.get("/metrics", response_model=None)
+async def metrics() -> Response:
+    """Prometheus格式的指标, 多worker运行时返回所有worker的合计"""
+    if not METRICS_MULTIPROC_DIR:
+        return Response(registry.render(), media_type=PROMETHEUS_MEDIA_TYPE)
+    # 先写出本进程的最新快照, 其余worker的快照最多滞后METRICS_EXPORT_INTERVAL秒
+    write_snapshot(METRICS_MULTIPROC_DIR)
+    body = await asyncio.to_thread(render_multiprocess, METRICS_MULTIPROC_DIR)
+    return Response(body, media_type=PROMETHEUS_MEDIA_TYPE)
@@ -0,0 +1,185 @@
+import os
+import io
+import json
+import uuid
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple, Union
+import aiofiles
+from fastapi import APIRouter
+from fastapi.responses import FileResponse, RedirectResponse, Response
+from starlette.background import BackgroundTask
+from dotenv import load_dotenv
+from .utils import get_http_client
+from .error import get_error_response
+
+# load env
+load_dotenv()
+
+router = APIRouter(prefix="/api/v1", tags=["图像镜像"])
+
+MIRROR_ENABLED = os.getenv("IMAGE_MIRROR_ENABLED", "false").lower() == "true"
+MIRROR_DIR = os.getenv("IMAGE_MIRROR_DIR", "./data/mirror")
+MIRROR_THUMB_SIZES = [
+    int(size) for size in os.getenv("IMAGE_MIRROR_THUMB_SIZES", "256,512").split(",")
+    if size.strip()
+]
+MIRROR_PREFIX = "/api/v1/mirror"
+# 内容按摘要寻址, 同一路径的内容永远不变, 可以长期缓存
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+MIRROR_WORKERS = int(os.getenv("IMAGE_MIRROR_WORKERS", "2"))
+
+# 生成缩略图的线程池, 第一次镜像时创建
+_thumb_executor: Optional[ThreadPoolExecutor] = None
+_in_progress: Set[str] = set()
+
+
+def _get_thumb_executor() -> ThreadPoolExecutor:
+    global _thumb_executor
+    if _thumb_executor is None:
+        _thumb_executor = ThreadPoolExecutor(max_workers=MIRROR_WORKERS,
+                                             thread_name_prefix="mirror-thumb")
+    return _thumb_executor
+
+
+def url_key(url: str) -> str:
+    """原始图片URL对应的镜像键"""
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+
+
+def _index_path(key: str) -> str:
+    return os.path.join(MIRROR_DIR, "index", f"{key}.json")
+
+
+def _object_path(digest: str, size: Optional[int] = None) -> str:
+    name = digest if size is None else f"{digest}_{size}"
+    return os.path.join(MIRROR_DIR, "objects", digest[:2], name)
+
+
+def _tmp_path(path: str) -> str:
+    """写入path前使用的临时文件, 同一文件的并发写入(包括其他worker)互不干扰"""
+    return f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+
+async def _read_index(key: str) -> Optional[Dict]:
+    try:
+        async with aiofiles.open(_index_path(key), "r", encoding="utf-8") as f:
+            return json.loads(await f.read())
+    except (OSError, ValueError):
+        return None
+
+
+async def _write_index(key: str, entry: Dict) -> None:
+    path = _index_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = _tmp_path(path)
+    async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+        await f.write(json.dumps(entry))
+    os.replace(tmp_path, path)
+
+
+def _make_thumbnails(digest: str, sizes: List[int]) -> Dict[str, str]:
+    """在线程池中生成缩略图, 返回尺寸到媒体类型的映射"""
+    from PIL import Image
+    created = {}
+    with Image.open(_object_path(digest)) as original:
+        original.load()
+        for size in sizes:
+            thumb = original.copy()
+            thumb.thumbnail((size, size))
+            if thumb.mode in ("RGBA", "LA", "P"):
+                fmt, media_type = "PNG", "image/png"
+            else:
+                fmt, media_type = "JPEG", "image/jpeg"
+            buffered = io.BytesIO()
+            thumb.save(buffered, format=fmt)
+            path = _object_path(digest, size)
+            tmp_path = _tmp_path(path)
+            with open(tmp_path, "wb") as f:
+                f.write(buffered.getvalue())
+            os.replace(tmp_path, path)
+            created[str(size)] = media_type
+    return created
+
+
+async def mirror_image(url: str) -> None:
+    """下载图片到本地内容寻址存储并生成缩略图"""
+    key = url_key(url)
+    if key in _in_progress:
+        return
+    _in_progress.add(key)
+    try:
+        entry = await _read_index(key) or {"url": url}
+        if entry.get("digest"):
+            return
+        response = await get_http_client().get(url)
+        response.raise_for_status()
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        path = _object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = _tmp_path(path)
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(content)
+            os.replace(tmp_path, path)
+        entry.update({
+            "digest": digest,
+            "content_type": response.headers.get("Content-Type", "image/jpeg")
+        })
+        if MIRROR_THUMB_SIZES:
+            loop = asyncio.get_running_loop()
+            entry["thumbnails"] = await loop.run_in_executor(
+                _get_thumb_executor(), _make_thumbnails, digest, MIRROR_THUMB_SIZES)
+        await _write_index(key, entry)
+        logging.debug("Mirrored image %s -> %s", url, digest)
+    except Exception as e:
+        logging.warning("Failed to mirror image %s: %s", url, e)
+    finally:
+        _in_progress.discard(key)
+
+
+async def _mirror_all(urls: List[str]) -> None:
+    await asyncio.gather(*(mirror_image(url) for url in urls))
+
+
+async def schedule_mirror(urls: List[str]) -> Tuple[List[str], Optional[BackgroundTask]]:
+    """登记待镜像的图片, 返回镜像地址和在响应发送后执行的后台任务
+
+    未开启镜像时返回空列表和None。
+    """
+    if not MIRROR_ENABLED or not urls:
+        return [], None
+    for url in urls:
+        key = url_key(url)
+        if await _read_index(key) is None:
+            await _write_index(key, {"url": url})
+    mirror_urls = [f"{MIRROR_PREFIX}/{url_key(url)}" for url in urls]
+    return mirror_urls, BackgroundTask(_mirror_all, urls)
+
+
+@router.get("/mirror/{key}", response_model=None)
+async def get_mirror_image(key: str, size: Optional[int] = None) -> Union[FileResponse, Response]:
+    """返回镜像的图片或缩略图, 尚未镜像完成时重定向到原始URL"""
+    entry = await _read_index(key) if len(key) == 32 and key.isalnum() else None
+    if entry is None:
+        return get_error_response(f"Mirror entry {key} not found")
+    digest = entry.get("digest")
+    if not digest:
+        return RedirectResponse(entry["url"], status_code=307,
+                                headers={"Cache-Control": "no-store"})
+    media_type = entry.get("content_type", "image/jpeg")
+    if size is not None:
+        thumbnails = entry.get("thumbnails", {})
+        if str(size) not in thumbnails:
+            return get_error_response(
+                f"Unsupported thumbnail size: {size}, available: {list(thumbnails)}")
+        media_type = thumbnails[str(size)]
+    return FileResponse(
+        _object_path(digest, size),
+        media_type=media_type,
+        headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": f'"{digest}-{size or 0}"'}
+    )
@@ -0,0 +1,152 @@
+import os
+import signal
+import asyncio
+import logging
+import configparser
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+from . import metrics
+from .providers import parse_endpoint_names
+from .responses import CachedJSON
+
+# 模型配置文件
+MODEL_CONFIG_FILE = os.getenv("MODEL_CONFIG_FILE", "model_config.ini")
+# 检查模型配置文件是否修改的间隔秒数, 0表示只在收到SIGHUP时重新加载
+MODEL_CONFIG_RELOAD_INTERVAL = float(os.getenv("MODEL_CONFIG_RELOAD_INTERVAL", "5"))
+
+REQUIRED_OPTIONS = ("version", "thinking")
+
+
+class ModelSpec(NamedTuple):
+    """单个模型的配置"""
+    name: str
+    version: str
+    thinking: bool
+    # 发给上游的模型名, 即"<name>-<version>"
+    upstream_model: str
+    endpoints: Tuple[str, ...]
+    # model_config.ini中该节的原始配置, 用于/chat_model_list
+    options: Mapping[str, str]
+
+
+class ModelSnapshot:
+    """某一时刻的全部模型配置
+
+    构造后不再修改, 重新加载时整体替换; 请求开始时取一次ModelSpec,
+    之后即使配置被替换也继续使用原来的配置。
+    """
+
+    def __init__(self, models: Dict[str, ModelSpec], file_state: Optional[Tuple] = None):
+        self.models: Mapping[str, ModelSpec] = MappingProxyType(models)
+        self.names = tuple(models)
+        self.file_state = file_state
+        # /chat_model_list的响应体和ETag在加载时就生成好
+        self.model_list = CachedJSON({
+            "code": 1,
+            "msg": "success",
+            "data": {name: dict(spec.options) for name, spec in models.items()},
+            "status": 200
+        })
+
+    def get(self, name: str) -> Optional[ModelSpec]:
+        return self.models.get(name.lower())
+
+
+def _file_state(path: str) -> Optional[Tuple]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_snapshot(path: str) -> ModelSnapshot:
+    """解析模型配置文件, 配置有误时抛出ValueError"""
+    file_state = _file_state(path)
+    parser = configparser.ConfigParser()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            parser.read_file(f)
+    except FileNotFoundError:
+        logging.warning("Model config %s not found, no chat models are available", path)
+        return ModelSnapshot({}, file_state)
+    except configparser.Error as e:
+        raise ValueError(f"Invalid model config {path}: {e}") from e
+    models = {}
+    for section in parser.sections():
+        options = parser[section]
+        missing = [option for option in REQUIRED_OPTIONS if option not in options]
+        if missing:
+            raise ValueError(f"Model {section} in {path} is missing {', '.join(missing)}")
+        name = section.lower()
+        models[name] = ModelSpec(
+            name=name,
+            version=options["version"],
+            thinking=options["thinking"] == "true",
+            upstream_model="-".join([name, options["version"]]),
+            endpoints=tuple(parse_endpoint_names(options.get("endpoints"))),
+            options=MappingProxyType(dict(options))
+        )
+    return ModelSnapshot(models, file_state)
+
+
+class ModelRegistry:
+    """可热加载的模型配置
+
+    文件修改(按修改时间和大小判断)或收到SIGHUP时重新解析, 解析成功才替换快照,
+    失败时记录日志并继续使用旧配置。替换只是一次赋值, 不影响进行中的请求。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.snapshot = load_snapshot(path)
+        # 解析失败的文件状态, 文件再次修改之前不重复尝试
+        self._failed_state: Optional[Tuple] = None
+        self._watch_task: Optional[asyncio.Task] = None
+
+    def reload(self) -> bool:
+        """重新加载配置, 返回是否成功"""
+        try:
+            snapshot = load_snapshot(self.path)
+        except (OSError, ValueError) as e:
+            metrics.model_config_reloads_total.inc("failed")
+            logging.error("Keeping previous model config: %s", e)
+            return False
+        if snapshot.model_list.etag != self.snapshot.model_list.etag:
+            logging.info("Reloaded model config %s: %s", self.path, ", ".join(snapshot.names))
+        self.snapshot = snapshot
+        metrics.model_config_reloads_total.inc("success")
+        return True
+
+    def check(self) -> None:
+        """文件发生变化时重新加载"""
+        state = _file_state(self.path)
+        if state in (self.snapshot.file_state, self._failed_state):
+            return
+        if not self.reload():
+            self._failed_state = state
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(MODEL_CONFIG_RELOAD_INTERVAL)
+            self.check()
+
+    def start(self) -> None:
+        """开始监视配置文件, 并在收到SIGHUP时重新加载"""
+        loop = asyncio.get_running_loop()
+        if MODEL_CONFIG_RELOAD_INTERVAL > 0 and self._watch_task is None:
+            self._watch_task = loop.create_task(self._watch())
+        if hasattr(signal, "SIGHUP"):
+            try:
+                loop.add_signal_handler(signal.SIGHUP, self.reload)
+            except (NotImplementedError, RuntimeError):
+                # 不在主线程(例如测试中)或平台不支持时只依靠文件监视
+                pass
+
+    def stop(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+
+model_registry = ModelRegistry(MODEL_CONFIG_FILE)
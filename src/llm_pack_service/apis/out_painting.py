@@ -1,29 +1,20 @@
-import os
 import io
-import json
 import base64
 import logging
-from PIL import Image
 from fastapi import APIRouter
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from typing import List
-from .utils import ImageResponse
+from .utils import ImageResponse, cv_process
 from .error import get_error_response
+from .responses import envelope_response
+from .mirror import schedule_mirror
 from fastapi.responses import Response
-from volcengine.visual.VisualService import VisualService
-from volcengine.Credentials import Credentials
 
 # load env
 load_dotenv()
 
 router = APIRouter(prefix="/api/v1", tags=["智能图像"])
-JSON_MEDIA_TYPE = "application/json"
-
-visual_service = VisualService()
-visual_service.set_ak(os.getenv("VOLCEENGINE_ACCESS_KEY"))
-visual_service.set_sk(os.getenv("VOLCEENGINE_SECRET_KEY"))
-
 
 def expand_image_with_mask(image_path, top, bottom, left, right):
     """
@@ -35,6 +26,7 @@ def expand_image_with_mask(image_path, top, bottom, left, right):
     :param right: 右侧扩展像素数
     :return: (扩展后图像base64, 对应mask base64)
     """
+    from PIL import Image
     # 打开原始图像
     original_img = Image.open(image_path)
     width, height = original_img.size
@@ -87,7 +79,7 @@ async def handle_out_painting(req_json: OutPaintingRequestJson) -> Response:
     try:
         # Pass context to validators
         # req_json = req_json.model_dump()
-        logging.debug(f"{req_json = }")
+        logging.debug("req_json = %s", req_json)
         
         req_dict = {
             "req_key": "i2i_outpainting",
@@ -99,34 +91,20 @@ async def handle_out_painting(req_json: OutPaintingRequestJson) -> Response:
             "steps": 30             
         }
         req_dict.update(req_json.out_painting_ratio.model_dump())
-        logging.debug(f"{req_dict = }")
+        logging.debug("req_dict = %s", req_dict)
         
-        resp = visual_service.cv_process(req_dict)
+        resp = await cv_process(req_dict)
+        image_urls = resp["data"]["image_urls"]
+        mirror_urls, background = await schedule_mirror(image_urls)
+        resp_data = {"image_urls": image_urls}
+        if mirror_urls:
+            resp_data["mirror_urls"] = mirror_urls
         
-        return Response(
-            json.dumps({
-                "code": 1,
-                "msg": "success",
-                "data": {
-                        "image_urls":resp["data"]["image_urls"]
-                    },
-                "status": 200
-            }),
-            media_type="application/json"
-        )
+        return envelope_response(resp_data, background=background)
     except Exception as e:
         return get_error_response(str(e))
     
 
-cred = Credentials(
-    ak=os.getenv("VOLCEENGINE_ACCESS_KEY"),
-    sk=os.getenv("VOLCEENGINE_SECRET_KEY"),
-    service="visual",
-    region=os.getenv("VOLCEENGINE_REGION", "cn-north-1"),
-    session_token=os.getenv("VOLCEENGINE_SESSION_TOKEN", "")
-)
-
-
 class ImgEnhanceRequestJson(BaseModel):
     """智能增图的请求体"""
     image_urls: List[str] = Field([
@@ -140,27 +118,22 @@ async def handle_img_enhace(req_json: ImgEnhanceRequestJson) -> Response:
     try:
         # Pass context to validators
         # req_json = req_json.model_dump()
-        logging.debug(f"{req_json = }")
+        logging.debug("req_json = %s", req_json)
         
         req_dict = {
             "req_key": "lens_lqir",
             "image_urls": req_json.image_urls,
             "return_url": True,
         }
-        logging.debug(f"{req_dict = }")
+        logging.debug("req_dict = %s", req_dict)
         
-        resp = visual_service.cv_process(req_dict)
+        resp = await cv_process(req_dict)
+        image_urls = resp["data"]["image_urls"]
+        mirror_urls, background = await schedule_mirror(image_urls)
+        resp_data = {"image_urls": image_urls}
+        if mirror_urls:
+            resp_data["mirror_urls"] = mirror_urls
         
-        return Response(
-            json.dumps({
-                "code": 1,
-                "msg": "success",
-                "data": {
-                        "image_urls":resp["data"]["image_urls"]
-                    },
-                "status": 200
-            }),
-            media_type="application/json"
-        )
+        return envelope_response(resp_data, background=background)
     except Exception as e:
         return get_error_response(str(e))
\ No newline at end of file
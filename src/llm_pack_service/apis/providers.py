@@ -0,0 +1,146 @@
+import os
+import math
+import time
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from . import metrics
+from .responses import JSON_MEDIA_TYPE
+
+# 统计最近多少次请求的成功率
+PROVIDER_WINDOW = int(os.getenv("PROVIDER_WINDOW", "50"))
+# 延迟的指数加权系数, 越大越偏向最近的请求
+PROVIDER_EWMA_ALPHA = float(os.getenv("PROVIDER_EWMA_ALPHA", "0.2"))
+# 错误率超过该值的端点排到健康端点之后
+PROVIDER_UNHEALTHY_ERROR_RATE = float(os.getenv("PROVIDER_UNHEALTHY_ERROR_RATE", "0.5"))
+# 超过该秒数的结果不再计入错误率, 被降级的端点之后会重新参与排序
+PROVIDER_OUTCOME_TTL = float(os.getenv("PROVIDER_OUTCOME_TTL", "60"))
+
+
+class Endpoint:
+    """一个上游端点及其滚动的延迟和错误统计
+
+    端点由环境变量前缀确定, 例如前缀DOUBAO对应DOUBAO_API_URL和DOUBAO_API_KEY。
+    """
+
+    def __init__(self, name: str, url: str, token: str):
+        self.name = name
+        self.url = url
+        self.token = token
+        self.ewma_latency: Optional[float] = None
+        self.outcomes: Deque[Tuple[float, bool]] = deque(maxlen=PROVIDER_WINDOW)
+        self.latencies: Deque[float] = deque(maxlen=PROVIDER_WINDOW)
+
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Accept": JSON_MEDIA_TYPE,
+            "Content-Type": JSON_MEDIA_TYPE,
+            "Authorization": f"Bearer {self.token}"
+        }
+
+    def error_rate(self) -> float:
+        cutoff = time.time() - PROVIDER_OUTCOME_TTL
+        while self.outcomes and self.outcomes[0][0] < cutoff:
+            self.outcomes.popleft()
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+    def record(self, latency: Optional[float], ok: bool) -> None:
+        """记录一次请求结果, latency为到首字节(流式)或完整响应(非流式)的秒数"""
+        self.outcomes.append((time.time(), ok))
+        if ok and latency is not None:
+            self.observe_latency(latency)
+
+    def observe_latency(self, latency: float) -> None:
+        """只更新延迟统计, 例如被取消的慢请求已经等待的时间(实际延迟的下限)"""
+        self.latencies.append(latency)
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency += PROVIDER_EWMA_ALPHA * (latency - self.ewma_latency)
+
+    def latency_percentile(self, percentile: float, min_samples: int = 1) -> Optional[float]:
+        """最近成功请求延迟的分位数, 样本不足时返回None"""
+        if len(self.latencies) < max(1, min_samples):
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1)
+        return ordered[max(0, index)]
+
+    def score(self) -> Tuple[bool, float]:
+        """排序键: 先按是否健康, 再按按错误率惩罚后的延迟; 没有数据的端点优先探测"""
+        error_rate = self.error_rate()
+        latency = self.ewma_latency or 0.0
+        return (error_rate > PROVIDER_UNHEALTHY_ERROR_RATE,
+                latency / max(0.05, 1.0 - error_rate))
+
+
+class ProviderRegistry:
+    """模型到上游端点的映射, 按健康度为每次请求排序端点"""
+
+    def __init__(self):
+        self._endpoints: Dict[str, Endpoint] = {}
+
+    def endpoint(self, name: str) -> Optional[Endpoint]:
+        """按环境变量前缀获取端点, 未配置URL或KEY时返回None"""
+        name = name.strip().upper()
+        url = os.getenv(f"{name}_API_URL")
+        token = os.getenv(f"{name}_API_KEY")
+        if not url or not token:
+            return None
+        endpoint = self._endpoints.get(name)
+        if endpoint is None or endpoint.url != url or endpoint.token != token:
+            endpoint = Endpoint(name, url, token)
+            self._endpoints[name] = endpoint
+            metrics.provider_latency_seconds.set_function(
+                lambda e=endpoint: e.ewma_latency or 0.0, endpoint.label)
+            metrics.provider_error_rate.set_function(endpoint.error_rate, endpoint.label)
+        return endpoint
+
+    def select(self, names: List[str]) -> List[Endpoint]:
+        """返回按健康度排序的可用端点, 第一个是首选, 其余用于故障转移"""
+        endpoints = []
+        for name in names:
+            endpoint = self.endpoint(name)
+            if endpoint is None:
+                logging.warning("Endpoint %s is not configured (missing %s_API_URL/%s_API_KEY)",
+                                name, name, name)
+                continue
+            endpoints.append(endpoint)
+        return sorted(endpoints, key=Endpoint.score)
+
+
+provider_registry = ProviderRegistry()
+
+
+class RequestBudget:
+    """额外请求(对冲, 重试)的预算
+
+    每个正常请求存入ratio个额度, 每个额外请求消耗1个, 余额不超过burst,
+    因此额外请求量长期不会超过正常请求量的ratio倍。
+    """
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = burst
+
+    def deposit(self) -> None:
+        self.balance = min(self.burst, self.balance + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+def parse_endpoint_names(value: Optional[str]) -> List[str]:
+    """解析model_config.ini中的endpoints配置, 默认使用DOUBAO"""
+    names = [name.strip() for name in (value or "DOUBAO").split(",") if name.strip()]
+    return names or ["DOUBAO"]
@@ -0,0 +1,82 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Dict, Optional
+
+# 记录键只允许这些字符, 键直接作为文件名
+RECORD_KEY = re.compile(r"[0-9A-Za-z_-]{1,64}")
+# 两次清理过期记录之间的最少秒数
+PURGE_INTERVAL = 60
+
+
+class RecordStore:
+    """每条记录一个JSON文件的共享存储
+
+    多worker运行时, 任务状态只在处理它的worker内存中, 而查询请求会被内核分给
+    任意一个worker。状态写到同一目录后, 哪个worker收到查询都能返回。
+    写入先写临时文件再原子替换, 读到的总是完整的记录; 文件操作都在线程中进行。
+    """
+
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self._next_purge = 0.0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    async def put(self, key: str, record: Dict) -> None:
+        if not RECORD_KEY.fullmatch(key):
+            raise ValueError(f"Invalid record key: {key}")
+        purge = time.time() >= self._next_purge
+        if purge:
+            self._next_purge = time.time() + PURGE_INTERVAL
+        await asyncio.to_thread(self._put, key, json.dumps(record), purge)
+
+    async def get(self, key: str) -> Optional[Dict]:
+        """读取记录, 不存在, 已过期或键不合法时返回None"""
+        if not RECORD_KEY.fullmatch(key):
+            return None
+        return await asyncio.to_thread(self._get, key)
+
+    def _put(self, key: str, payload: str, purge: bool) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        if purge:
+            self._purge()
+
+    def _get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= time.time():
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to read record %s: %s", path, e)
+            return None
+
+    def _purge(self) -> None:
+        """删除过期的记录和残留的临时文件"""
+        deadline = time.time() - self.ttl
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.stat().st_mtime <= deadline:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+        except OSError as e:
+            logging.warning("Failed to purge records in %s: %s", self.directory, e)
@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+import httpx
+from . import metrics
+from .error import CircuitOpenError
+from .providers import RequestBudget
+
+T = TypeVar("T")
+
+# 连续失败多少次后断开熔断器
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# 熔断器断开多少秒后放行一个探测请求
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# 每个请求最多尝试的次数(含第一次)
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+# 指数退避的基础和最大等待秒数, 实际等待在[0, 上限]之间随机(full jitter)
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "2"))
+# 重试请求最多占正常请求量的比例, 以及允许的突发数量
+RETRY_BUDGET = float(os.getenv("RETRY_BUDGET", "0.2"))
+RETRY_BURST = float(os.getenv("RETRY_BURST", "10"))
+
+# 上游确认没有处理请求的状态码, 非幂等请求也可以安全重试
+SAFE_RETRY_STATUSES = (429, 503)
+# 幂等请求额外重试的状态码
+IDEMPOTENT_RETRY_STATUSES = (502, 504)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """单个上游的熔断器
+
+    closed: 正常放行; 连续失败达到阈值后进入open, 直接拒绝请求;
+    open持续CIRCUIT_RESET_TIMEOUT秒后进入half_open, 只放行一个探测请求,
+    探测成功回到closed, 失败则重新open。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before_call(self) -> None:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < CIRCUIT_RESET_TIMEOUT:
+                raise CircuitOpenError(f"Circuit for upstream {self.name} is open")
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probing:
+                raise CircuitOpenError(f"Circuit for upstream {self.name} is half open")
+            self._probing = True
+
+    def on_success(self) -> None:
+        self._probing = False
+        self.failures = 0
+        if self.state != CLOSED:
+            logging.info("Circuit for upstream %s closed", self.name)
+            self.state = CLOSED
+
+    def on_failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if self.state != OPEN:
+                logging.warning("Circuit for upstream %s opened after %d failures",
+                                self.name, self.failures)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """请求被取消时调用, 不计成功也不计失败"""
+        self._probing = False
+
+    def is_open(self) -> bool:
+        return (self.state == OPEN
+                and time.monotonic() - self.opened_at < CIRCUIT_RESET_TIMEOUT)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_retry_budgets: Dict[str, RequestBudget] = {}
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    breaker = _breakers.get(upstream)
+    if breaker is None:
+        breaker = _breakers[upstream] = CircuitBreaker(upstream)
+        _retry_budgets[upstream] = RequestBudget(RETRY_BUDGET, RETRY_BURST)
+        metrics.circuit_state.set_function(
+            lambda b=breaker: _STATE_VALUES[b.state], upstream)
+    return breaker
+
+
+def _is_failure(error: BaseException) -> bool:
+    """是否说明上游不健康: 只有传输错误, 超时, 429和5xx计入熔断;
+    4xx和被调用函数中的业务, 参数错误是请求本身的问题, 不能让一类坏请求断开所有人的熔断器"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    # volcengine等SDK使用requests
+    requests = sys.modules.get("requests")
+    return requests is not None and isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _is_retriable(error: BaseException, idempotent: bool) -> bool:
+    """非幂等请求只在确认上游没有收到请求时重试"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return (status_code in SAFE_RETRY_STATUSES
+                or (idempotent and status_code in IDEMPOTENT_RETRY_STATUSES))
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(error, httpx.TransportError):
+        return idempotent
+    # volcengine等SDK使用requests, 连接超时说明请求没有发出
+    requests = sys.modules.get("requests")
+    if requests is not None and isinstance(error, requests.exceptions.RequestException):
+        return (isinstance(error, requests.exceptions.ConnectTimeout)
+                or (idempotent and isinstance(error, requests.exceptions.ConnectionError)))
+    return False
+
+
+def _status_error(response: httpx.Response) -> Optional[httpx.HTTPStatusError]:
+    if response.status_code == 429 or response.status_code >= 500:
+        return httpx.HTTPStatusError(
+            f"Upstream returned {response.status_code}",
+            request=response.request, response=response)
+    return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """第attempt次重试前的等待秒数(从1开始), 指数增长并加入随机抖动"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+async def call(upstream: str, send: Callable[[], Awaitable[T]],
+               idempotent: bool = False,
+               max_attempts: Optional[int] = None) -> T:
+    """经过熔断器和重试调用上游
+
+    Args:
+        upstream (str): 上游名称, 每个上游有独立的熔断器和重试预算
+        send (Callable): 无参的协程函数, 每次尝试调用一次
+        idempotent (bool): 请求是否幂等, 决定哪些错误可以重试
+        max_attempts (Optional[int]): 最多尝试次数, 默认RETRY_MAX_ATTEMPTS
+
+    Returns:
+        send的返回值。返回httpx.Response时, 429和5xx也算失败; 重试用尽后原样返回
+        最后一个响应, 由调用方按原有逻辑处理。
+
+    Raises:
+        CircuitOpenError: 熔断器断开, 没有发出请求
+    """
+    breaker = get_breaker(upstream)
+    budget = _retry_budgets[upstream]
+    budget.deposit()
+    attempts = max_attempts or RETRY_MAX_ATTEMPTS
+    attempt = 1
+    while True:
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            metrics.upstream_requests_total.inc(upstream, "circuit_open")
+            raise
+        result: Any = None
+        try:
+            result = await send()
+            error = _status_error(result) if isinstance(result, httpx.Response) else None
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            error = e
+        if error is None or not _is_failure(error):
+            if error is None or isinstance(error, httpx.HTTPStatusError):
+                breaker.on_success()
+            else:
+                # 业务错误说明不了上游是否健康, 不计成功也不计失败
+                breaker.release()
+            if error is not None:
+                raise error
+            return result
+        breaker.on_failure()
+        if (attempt >= attempts or not _is_retriable(error, idempotent)
+                or breaker.is_open() or not budget.try_withdraw()):
+            if result is not None:
+                return result
+            raise error
+        if isinstance(result, httpx.Response):
+            await result.aclose()
+        delay = backoff_delay(attempt)
+        metrics.upstream_retries_total.inc(upstream)
+        logging.info("Retrying upstream %s in %.2fs after attempt %d failed: %s",
+                     upstream, delay, attempt, error)
+        await asyncio.sleep(delay)
+        attempt += 1
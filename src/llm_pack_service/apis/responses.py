@@ -0,0 +1,92 @@
+import json
+import hashlib
+from typing import Any, Dict, Optional, Union
+from fastapi.responses import Response
+from starlette.background import BackgroundTask
+
+try:
+    # 可选依赖: pip install .[speed]
+    import orjson
+except ImportError:  # pragma: no cover - 取决于安装环境
+    orjson = None
+
+JSON_MEDIA_TYPE = "application/json"
+
+
+def dumps(value: Any) -> bytes:
+    """序列化为UTF-8编码的紧凑JSON, 安装了orjson时使用orjson
+
+    两种实现对普通数据输出相同, 浮点数有差异: orjson把NaN和Infinity输出为null,
+    标准库输出为NaN/Infinity; 小数的写法也可能不同, 例如orjson为1e-7, 标准库为1e-07。
+    """
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps_str(value: Any) -> str:
+    """与dumps相同, 返回str, 用于拼接SSE事件"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_response(payload: Any, status_code: int = 200,
+                  headers: Optional[Dict[str, str]] = None,
+                  background: Optional[BackgroundTask] = None) -> Response:
+    """把payload直接序列化为bytes作为响应体"""
+    return Response(dumps(payload), status_code=status_code, media_type=JSON_MEDIA_TYPE,
+                    headers=headers, background=background)
+
+
+def envelope_response(data: Any, msg: str = "success", code: int = 1, status: int = 200,
+                      status_code: int = 200, headers: Optional[Dict[str, str]] = None,
+                      background: Optional[BackgroundTask] = None) -> Response:
+    """生成{"code", "msg", "data", "status"}格式的响应
+
+    Args:
+        data Any: 响应数据
+        msg str: 响应信息
+        code int: 1表示成功, 0表示失败
+        status int: 响应体中的状态码
+        status_code int: HTTP状态码
+    """
+    return json_response({"code": code, "msg": msg, "data": data, "status": status},
+                         status_code=status_code, headers=headers, background=background)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match是否命中etag, 支持逗号分隔的多个值和*
+
+    按弱比较处理: 压缩中间件把压缩后响应的ETag改成了W/"...", 客户端带回时也算命中。
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+class CachedJSON:
+    """预先序列化好的JSON响应体及其强ETag
+
+    内容只在数据源变化时重新生成, 每次请求只需比较ETag并返回同一份bytes。
+    """
+
+    def __init__(self, payload: Any):
+        self.body = dumps(payload)
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:16] + '"'
+
+    def response(self, if_none_match: Optional[str] = None, status_code: int = 200,
+                 headers: Optional[Dict[str, str]] = None) -> Response:
+        headers = dict(headers or {}, ETag=self.etag)
+        headers.setdefault("Cache-Control", "no-cache")
+        if status_code == 200 and etag_matches(if_none_match, self.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(self.body, status_code=status_code,
+                        media_type=JSON_MEDIA_TYPE, headers=headers)
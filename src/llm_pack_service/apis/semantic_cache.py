@@ -0,0 +1,332 @@
+import os
+import re
+import time
+import zlib
+import asyncio
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+import numpy as np
+from . import metrics
+from .cache import make_cache_key
+from .responses import dumps, dumps_str
+
+try:
+    # 可选依赖: 设置SEMANTIC_CACHE_MODEL时用本地句向量模型代替哈希向量
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # pragma: no cover - 取决于安装环境
+    SentenceTransformer = None
+
+# 是否开启对话的语义缓存
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+# 命中所需的最小余弦相似度; 不设置时按向量的来源取MODEL_THRESHOLD或HASHING_THRESHOLD
+SEMANTIC_CACHE_THRESHOLD = (float(os.environ["SEMANTIC_CACHE_THRESHOLD"])
+                            if os.getenv("SEMANTIC_CACHE_THRESHOLD") else None)
+# 是否在不同调用方(API key)之间共用缓存的回答, 默认每个调用方只命中自己的回答
+SEMANTIC_CACHE_SHARED = os.getenv("SEMANTIC_CACHE_SHARED", "false").lower() == "true"
+# 最多缓存的回答数, 以及向量加回答占用的总字节数
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_MAX_BYTES = int(os.getenv("SEMANTIC_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 回答的缓存秒数, 0表示只按容量淘汰
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+# 哈希向量的维度
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "1024"))
+# 本地句向量模型的名称或路径(sentence-transformers, 在CPU上运行), 为空时使用哈希向量
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "")
+# 最后一条用户消息超过该字符数时不使用缓存
+SEMANTIC_CACHE_MAX_QUERY_CHARS = int(os.getenv("SEMANTIC_CACHE_MAX_QUERY_CHARS", "2000"))
+# 以流式返回缓存的回答时每个事件包含的字符数
+SEMANTIC_CACHE_REPLAY_CHUNK = int(os.getenv("SEMANTIC_CACHE_REPLAY_CHUNK", "32"))
+
+# 英文单词和数字整体作为一个词, 其余文字(中文等)每个字作为一个词
+TOKEN = re.compile(r"[a-z0-9]+|[^\W\da-z_]")
+NUMBER = re.compile(r"\d+(?:\.\d+)?")
+# 否定词, 只差一个"不"的两个问题字面很接近, 意思却相反
+NEGATION = re.compile(r"\b(?:not|no|never|none|nothing|nobody|neither|nor|without|cannot)\b"
+                      r"|n't|[不没别未勿]")
+# 句向量模型能区分意思, 阈值可以宽一些; 哈希向量加一个词的相似度就在0.9左右,
+# 只应命中大小写, 标点, 全半角之类的差别
+MODEL_THRESHOLD = 0.9
+HASHING_THRESHOLD = 0.98
+# 缓存回答中保留的字段
+ANSWER_FIELDS = ("role", "reasoning_content", "content")
+# 缓存命中不消耗上游token
+ZERO_USAGE = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def _features(text: str) -> Iterator[Tuple[str, float]]:
+    """文本的特征及权重: 词, 相邻两个词, 以及英文单词内的三字母片段"""
+    tokens = TOKEN.findall(unicodedata.normalize("NFKC", text).lower())
+    for index, token in enumerate(tokens):
+        yield token, 1.0
+        if index:
+            yield tokens[index - 1] + " " + token, 1.0
+        if len(token) > 3 and token.isascii():
+            padded = f"#{token}#"
+            for start in range(len(padded) - 2):
+                yield padded[start:start + 3], 0.5
+
+
+class HashingEncoder:
+    """把文本特征哈希到固定维度的单位向量, 不需要模型, 只能识别字面相近的问法"""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def encode_sync(self, text: str) -> Optional[np.ndarray]:
+        weights: Dict[int, float] = {}
+        for feature, weight in _features(text):
+            digest = zlib.crc32(feature.encode("utf-8"))
+            # 低位决定维度, 最高位决定符号, 减小哈希冲突带来的偏差
+            index = digest % self.dim
+            weights[index] = weights.get(index, 0.0) + (weight if digest & 0x80000000 else -weight)
+        if not weights:
+            return None
+        vector = np.zeros(self.dim, dtype=np.float32)
+        vector[list(weights)] = list(weights.values())
+        # 次线性词频, 避免重复的词主导相似度
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = float(np.linalg.norm(vector))
+        if norm == 0:
+            return None
+        return vector / norm
+
+    async def encode(self, text: str) -> Optional[np.ndarray]:
+        # 短文本哈希很快, 直接在事件循环中计算
+        return self.encode_sync(text)
+
+
+class ModelEncoder:
+    """本地句向量模型, 可以识别换了说法的相同问题; 推理在线程池中进行"""
+
+    def __init__(self, name: str):
+        self.model = SentenceTransformer(name, device="cpu")
+        self.dim = int(self.model.get_sentence_embedding_dimension())
+
+    async def encode(self, text: str) -> Optional[np.ndarray]:
+        vector = await asyncio.to_thread(self.model.encode, text, normalize_embeddings=True)
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector if np.any(vector) else None
+
+
+class VectorIndex:
+    """矩阵按行存放单位向量, 一次矩阵乘法算出与所有行的余弦相似度
+
+    每行带一个分区号, 只在同一分区(模型, 调用方, 参数和之前的对话相同)内查找;
+    分区号0表示空行, 删除的行留给之后的写入复用。
+    """
+
+    def __init__(self, dim: int, capacity: int = 256):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.partitions = np.zeros(capacity, dtype=np.int64)
+        # 用过的最大行号加一
+        self.size = 0
+        self._free: List[int] = []
+
+    def add(self, vector: np.ndarray, partition: int) -> int:
+        if self._free:
+            row = self._free.pop()
+        else:
+            if self.size == len(self.vectors):
+                self._grow()
+            row = self.size
+            self.size += 1
+        self.vectors[row] = vector
+        self.partitions[row] = partition
+        return row
+
+    def remove(self, row: int) -> None:
+        self.partitions[row] = 0
+        self._free.append(row)
+
+    def search(self, vector: np.ndarray, partition: int) -> Tuple[int, float]:
+        """返回分区内最相似的行及相似度, 分区为空时返回(-1, 0.0)"""
+        if self.size == 0:
+            return -1, 0.0
+        scores = self.vectors[:self.size] @ vector
+        scores[self.partitions[:self.size] != partition] = -np.inf
+        row = int(np.argmax(scores))
+        score = float(scores[row])
+        if score == -np.inf:
+            return -1, 0.0
+        return row, score
+
+    def _grow(self) -> None:
+        capacity = len(self.vectors) * 2
+        vectors = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        partitions = np.zeros(capacity, dtype=np.int64)
+        partitions[:self.size] = self.partitions[:self.size]
+        self.vectors = vectors
+        self.partitions = partitions
+
+
+class SemanticQuery(NamedTuple):
+    """一次可以使用缓存的请求"""
+    model: str
+    partition: int
+    vector: np.ndarray
+
+
+class CacheEntry(NamedTuple):
+    model: str
+    message: Dict
+    created: float
+    nbytes: int
+
+
+def _partition(*parts) -> int:
+    """由模型, 调用方, 参数和之前的对话生成的非零64位分区号"""
+    partition = int(make_cache_key(*parts)[:16], 16) - (1 << 63)
+    return partition or 1
+
+
+class AnswerBuilder:
+    """把流式返回的增量拼成完整回答"""
+
+    def __init__(self):
+        self.parts: Dict[str, List[str]] = {"reasoning_content": [], "content": []}
+
+    def add(self, delta: Dict) -> None:
+        for field, parts in self.parts.items():
+            value = delta.get(field)
+            if isinstance(value, str) and value:
+                parts.append(value)
+
+    def message(self) -> Dict:
+        message = {"role": "assistant"}
+        for field, parts in self.parts.items():
+            if parts:
+                message[field] = "".join(parts)
+        return message
+
+
+class SemanticCache:
+    """对话回答的语义缓存
+
+    以最后一条用户消息的向量查找同一分区内最相似的已缓存问题, 相似度不低于
+    SEMANTIC_CACHE_THRESHOLD时直接返回其回答。按最近使用淘汰, 同时限制条数和
+    字节数; 每个worker各有一份缓存。
+    """
+
+    def __init__(self, threshold: Optional[float], max_entries: int, max_bytes: int,
+                 ttl: float):
+        self.configured_threshold = threshold
+        self.threshold = threshold if threshold is not None else MODEL_THRESHOLD
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.encoder = None
+        self.index: Optional[VectorIndex] = None
+        self.nbytes = 0
+        # 行号 -> 缓存的回答, 按最近使用排序
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        metrics.semantic_cache_size.set_function(lambda: len(self._entries), "entries")
+        metrics.semantic_cache_size.set_function(lambda: self.nbytes, "bytes")
+
+    def load_encoder(self) -> None:
+        if SEMANTIC_CACHE_MODEL and SentenceTransformer is not None:
+            self.encoder = ModelEncoder(SEMANTIC_CACHE_MODEL)
+        else:
+            if SEMANTIC_CACHE_MODEL:
+                logging.warning("sentence-transformers is not installed, "
+                                "semantic cache falls back to hashing vectors")
+            self.encoder = HashingEncoder(SEMANTIC_CACHE_DIM)
+        if self.configured_threshold is None:
+            self.threshold = (HASHING_THRESHOLD if isinstance(self.encoder, HashingEncoder)
+                              else MODEL_THRESHOLD)
+        self.index = VectorIndex(self.encoder.dim)
+        self._entries.clear()
+        self.nbytes = 0
+
+    async def query(self, messages: List[Dict], files: List[str],
+                    model: str, caller: str, *options) -> Optional[SemanticQuery]:
+        """请求可以使用缓存时返回查询, 否则返回None
+
+        带文件的请求和最后一条不是用户消息的请求不缓存; 调用方, 之前的消息(系统提示,
+        多轮对话)和options一起决定分区, 只有它们完全相同时才比较最后一条消息。
+        消息中的数字和否定词也计入分区, "1+1等于几"和"1+2等于几", "能不能"和"能"
+        字面相近但不能共用回答。开启SEMANTIC_CACHE_SHARED时不同调用方共用分区。
+        """
+        if self.encoder is None or files or not messages or messages[-1].get("role") != "user":
+            return None
+        text = messages[-1].get("content") or ""
+        if not text.strip() or len(text) > SEMANTIC_CACHE_MAX_QUERY_CHARS:
+            return None
+        vector = await self.encoder.encode(text)
+        if vector is None:
+            return None
+        history = [(message.get("role"), message.get("content")) for message in messages[:-1]]
+        normalized = unicodedata.normalize("NFKC", text).lower()
+        numbers = NUMBER.findall(normalized)
+        negations = NEGATION.findall(normalized)
+        scope = "" if SEMANTIC_CACHE_SHARED else caller
+        return SemanticQuery(
+            model, _partition(model, scope, options, history, numbers, negations), vector)
+
+    def lookup(self, query: SemanticQuery) -> Optional[Tuple[Dict, float]]:
+        """返回缓存的回答及相似度, 未命中返回None"""
+        row, score = self.index.search(query.vector, query.partition)
+        if row < 0 or score < self.threshold:
+            metrics.semantic_cache_lookups_total.inc(query.model, "miss")
+            return None
+        entry = self._entries[row]
+        if self.ttl and entry.created + self.ttl <= time.time():
+            self._remove(row, "expired")
+            metrics.semantic_cache_lookups_total.inc(query.model, "expired")
+            return None
+        self._entries.move_to_end(row)
+        metrics.semantic_cache_lookups_total.inc(query.model, "hit")
+        return entry.message, score
+
+    def store(self, query: SemanticQuery, message: Dict) -> None:
+        """缓存一次成功的回答, 替换同一问题的旧回答"""
+        if not isinstance(message.get("content"), str) or not message["content"]:
+            # 工具调用等没有文本内容的回答不缓存
+            return
+        message = {field: message[field] for field in ANSWER_FIELDS if message.get(field)}
+        nbytes = query.vector.nbytes + len(dumps(message))
+        if nbytes > self.max_bytes:
+            return
+        row, score = self.index.search(query.vector, query.partition)
+        if row >= 0 and score >= self.threshold:
+            self._remove(row, "replaced")
+        row = self.index.add(query.vector, query.partition)
+        self._entries[row] = CacheEntry(query.model, message, time.time(), nbytes)
+        self.nbytes += nbytes
+        metrics.semantic_cache_stores_total.inc(query.model)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)), "lru")
+        while self.nbytes > self.max_bytes:
+            self._remove(next(iter(self._entries)), "bytes")
+
+    def _remove(self, row: int, reason: str) -> None:
+        entry = self._entries.pop(row)
+        self.nbytes -= entry.nbytes
+        self.index.remove(row)
+        metrics.semantic_cache_evictions_total.inc(reason)
+
+
+def replay_events(message: Dict) -> Iterator[str]:
+    """把缓存的回答按上游流式输出的格式重新切成SSE事件"""
+    step = max(1, SEMANTIC_CACHE_REPLAY_CHUNK)
+    for field in ("reasoning_content", "content"):
+        text = message.get(field) or ""
+        for start in range(0, len(text), step):
+            yield "data: " + dumps_str({field: text[start:start + step], "usage": ZERO_USAGE,
+                                        "role": "assistant"}) + "\n\n"
+    yield "data: " + dumps_str({"isDone": "True", "role": "assistant"}) + "\n\n"
+
+
+answer_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES,
+                             SEMANTIC_CACHE_MAX_BYTES, SEMANTIC_CACHE_TTL)
+
+
+async def on_startup() -> None:
+    """开启缓存时加载向量模型, 模型较大时在线程中加载"""
+    if not SEMANTIC_CACHE_ENABLED or answer_cache.encoder is not None:
+        return
+    await asyncio.to_thread(answer_cache.load_encoder)
+    logging.info("Semantic chat cache enabled (%s, threshold %.2f)",
+                 type(answer_cache.encoder).__name__, answer_cache.threshold)
@@ -0,0 +1,407 @@
+import os
+import time
+import sqlite3
+import secrets
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from . import metrics
+
+# 内存中最多保留的会话数, 超出时淘汰最久未用的会话
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+# 每个会话保留的消息数, 超出时丢弃最早的非system消息
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "200"))
+# 会话闲置超过该秒数后删除
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))
+# 每轮转发给上游的消息(历史加新消息)的token预算, 按字符数估算
+SESSION_CONTEXT_TOKENS = int(os.getenv("SESSION_CONTEXT_TOKENS", "8000"))
+# SQLite数据库文件, 设置后会话持久化并在worker之间共享; 为空时只保存在内存中
+SESSION_DB = os.getenv("SESSION_DB", "")
+# 是否让模型总结移出窗口的历史, 移出的消息达到SESSION_SUMMARY_MIN_MESSAGES条时总结一次
+SESSION_SUMMARY_ENABLED = os.getenv("SESSION_SUMMARY_ENABLED", "false").lower() == "true"
+SESSION_SUMMARY_MIN_MESSAGES = int(os.getenv("SESSION_SUMMARY_MIN_MESSAGES", "6"))
+# 摘要的最大token数
+SESSION_SUMMARY_MAX_TOKENS = int(os.getenv("SESSION_SUMMARY_MAX_TOKENS", "512"))
+
+SESSION_ID_MAX_LENGTH = 128
+SESSION_SWEEP_INTERVAL = 60
+# 摘要以system消息的形式放在历史窗口之前
+SUMMARY_PREFIX = "之前对话的摘要: "
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS chat_sessions (
+        caller TEXT NOT NULL, session_id TEXT NOT NULL,
+        next_seq INTEGER NOT NULL, summary TEXT NOT NULL, summary_upto INTEGER NOT NULL,
+        updated REAL NOT NULL, PRIMARY KEY (caller, session_id))""",
+    """CREATE TABLE IF NOT EXISTS chat_messages (
+        caller TEXT NOT NULL, session_id TEXT NOT NULL, seq INTEGER NOT NULL,
+        role TEXT NOT NULL, content TEXT NOT NULL, PRIMARY KEY (caller, session_id, seq))""",
+    "CREATE INDEX IF NOT EXISTS chat_sessions_updated ON chat_sessions (updated)",
+)
+
+SessionKey = Tuple[str, str]
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数: 非ASCII字符(中文等)每个算一个, ASCII字符每4个算一个"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return len(text) - ascii_chars + ascii_chars // 4 + 1
+
+
+def message_tokens(message: Dict) -> int:
+    content = message.get("content")
+    # 每条消息另有角色等几个token的开销
+    return 4 + (estimate_tokens(content) if isinstance(content, str) else 0)
+
+
+class Session:
+    """一个会话的历史消息
+
+    messages中每条是{"seq", "role", "content"}; next_seq是累计追加过的消息数,
+    同时作为版本号, 与SQLite中的不一致说明其他worker追加过消息, 需要重新加载。
+    system消息只保存最新的一份, 始终保留在窗口中。
+    """
+
+    def __init__(self, key: SessionKey, messages: Optional[List[Dict]] = None,
+                 next_seq: int = 0, summary: str = "", summary_upto: int = 0):
+        self.key = key
+        self.messages: List[Dict] = messages or []
+        self.next_seq = next_seq
+        self.summary = summary
+        # 摘要覆盖了序号小于summary_upto的消息
+        self.summary_upto = summary_upto
+        self.touched = time.time()
+        self.summarising = False
+
+    @property
+    def state(self) -> Tuple[int, int]:
+        return self.next_seq, self.summary_upto
+
+    def window(self, budget: int, pin_system: bool = True) -> Tuple[List[Dict], List[Dict]]:
+        """预算内的历史消息, 以及移出窗口且尚未总结的消息
+
+        从最近的消息往前取, 直到超出预算或遇到已被摘要覆盖的消息; 窗口总是从
+        用户消息开始。本轮带了新的system消息时pin_system为False, 不再放入保存的system消息。
+        """
+        pinned = [message for message in self.messages
+                  if pin_system and message["role"] == "system"]
+        budget -= sum(message_tokens(message) for message in pinned)
+        if self.summary:
+            budget -= estimate_tokens(self.summary)
+        recent: List[Dict] = []
+        for message in reversed(self.messages):
+            if message["role"] == "system":
+                continue
+            cost = message_tokens(message)
+            if message["seq"] < self.summary_upto or cost > budget:
+                break
+            budget -= cost
+            recent.append(message)
+        recent.reverse()
+        while recent and recent[0]["role"] != "user":
+            recent.pop(0)
+        start = recent[0]["seq"] if recent else self.next_seq
+        dropped = [message for message in self.messages
+                   if message["role"] != "system" and self.summary_upto <= message["seq"] < start]
+        history = [{"role": message["role"], "content": message["content"]} for message in pinned]
+        if self.summary:
+            history.append({"role": "system", "content": SUMMARY_PREFIX + self.summary})
+        history.extend({"role": message["role"], "content": message["content"]}
+                       for message in recent)
+        return history, dropped
+
+    def append(self, messages: List[Dict]) -> List[Dict]:
+        """追加消息并编号, 超出SESSION_MAX_MESSAGES时丢弃最早的非system消息
+
+        客户端每轮都可能重发system消息: 与保存的相同时不再追加, 不同时替换保存的。
+        """
+        system = [message["content"] for message in messages if message["role"] == "system"]
+        if system:
+            if system == [message["content"] for message in self.messages
+                          if message["role"] == "system"]:
+                messages = [message for message in messages if message["role"] != "system"]
+            else:
+                self.messages = [message for message in self.messages
+                                 if message["role"] != "system"]
+        added = []
+        for message in messages:
+            added.append({"seq": self.next_seq, "role": message["role"],
+                          "content": message["content"]})
+            self.next_seq += 1
+        self.messages.extend(added)
+        overflow = len(self.messages) - SESSION_MAX_MESSAGES
+        if overflow > 0:
+            kept = []
+            for message in self.messages:
+                if overflow and message["role"] != "system":
+                    overflow -= 1
+                    continue
+                kept.append(message)
+            self.messages = kept
+        self.touched = time.time()
+        return added
+
+
+class SessionStore:
+    """服务端保存的对话历史
+
+    客户端每轮只发送session_id和新消息, 历史从这里取出并按预算截取窗口。
+    会话按最近使用保存在内存中; 配置SESSION_DB时同时写入SQLite, 内存中的
+    会话只作为缓存, 每次使用前比较版本号, 多个worker之间保持一致。
+    数据库操作都在单独的一个线程中执行。
+    """
+
+    def __init__(self, max_sessions: int, db_path: str):
+        self.max_sessions = max_sessions
+        self.db_path = db_path
+        self._sessions: "OrderedDict[SessionKey, Session]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 会话 -> 尚未完成的数据库写入, 读取该会话前先等待
+        self._writes: Dict[SessionKey, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._sweep_task: Optional[asyncio.Task] = None
+        metrics.chat_sessions.set_function(lambda: len(self._sessions))
+
+    async def start(self) -> None:
+        if self.db_path:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="session-db")
+            await self._run(self._open)
+            logging.info("Chat sessions are stored in %s", self.db_path)
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.get_running_loop().create_task(self._sweep())
+
+    async def stop(self) -> None:
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._writes.values(), return_exceptions=True)
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _run(self, function: Callable, *args) -> Awaitable:
+        return asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def create(self, caller: str) -> Session:
+        """新建会话; id由服务端随机生成, 客户端无法猜到其他调用方的会话"""
+        key = (caller, secrets.token_urlsafe(24))
+        session = Session(key)
+        if self._db is not None:
+            await self._run(self._db_create, key)
+        self._remember(session)
+        return session
+
+    async def get(self, caller: str, session_id: str) -> Optional[Session]:
+        """取出会话, 不存在时返回None"""
+        key = (caller, session_id)
+        pending = self._writes.get(key)
+        if pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+        session = self._sessions.get(key)
+        if self._db is not None:
+            state = await self._run(self._db_state, key)
+            if state is None:
+                session = None
+            elif session is None or session.state != state:
+                session = await self._run(self._db_load, key)
+        if session is None:
+            self._sessions.pop(key, None)
+            return None
+        self._remember(session)
+        return session
+
+    def _remember(self, session: Session) -> None:
+        self._sessions[session.key] = session
+        self._sessions.move_to_end(session.key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        session.touched = time.time()
+
+    def record_turn(self, session: Session, messages: List[Dict]) -> None:
+        """追加一轮对话; 内存立即更新, 数据库在后台写入"""
+        added = session.append(messages)
+        if self._db is not None:
+            self._write(session.key, self._db_append, session.key, added)
+
+    def set_summary(self, session: Session, summary: str, upto: int) -> None:
+        session.summary = summary
+        session.summary_upto = upto
+        if self._db is not None:
+            self._write(session.key, self._db_set_summary, session.key, summary, upto)
+
+    async def delete(self, caller: str, session_id: str) -> bool:
+        key = (caller, session_id)
+        deleted = self._sessions.pop(key, None) is not None
+        if self._db is not None:
+            deleted = await self._run(self._db_delete, key) or deleted
+        return deleted
+
+    def summarise_later(self, session: Session, dropped: List[Dict],
+                        summarise: Callable[[str], Awaitable[str]]) -> None:
+        """在后台把已有摘要和移出窗口的消息总结成新的摘要"""
+        if session.summarising or not dropped:
+            return
+        session.summarising = True
+        lines = [f"{message['role']}: {message['content']}" for message in dropped]
+        if session.summary:
+            lines.insert(0, SUMMARY_PREFIX + session.summary)
+        upto = dropped[-1]["seq"] + 1
+
+        async def run() -> None:
+            try:
+                summary = await summarise("\n".join(lines))
+                if summary and upto > session.summary_upto:
+                    self.set_summary(session, summary, upto)
+                    metrics.chat_session_summaries_total.inc("success")
+            except Exception as e:
+                metrics.chat_session_summaries_total.inc("error")
+                logging.warning("Failed to summarise chat session: %s", e)
+            finally:
+                session.summarising = False
+
+        task = asyncio.get_running_loop().create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _write(self, key: SessionKey, function: Callable, *args) -> None:
+        """按顺序提交写入, 失败只记录日志; 内存中的会话照常使用"""
+        future = self._run(function, *args)
+        self._writes[key] = future
+
+        def done(finished: asyncio.Future) -> None:
+            if self._writes.get(key) is finished:
+                del self._writes[key]
+            if not finished.cancelled() and finished.exception() is not None:
+                logging.error("Failed to write chat session: %s", finished.exception())
+
+        future.add_done_callback(done)
+
+    async def _sweep(self) -> None:
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            deadline = time.time() - SESSION_TTL
+            for key in [key for key, session in self._sessions.items()
+                        if session.touched < deadline]:
+                del self._sessions[key]
+            if self._db is not None:
+                try:
+                    await self._run(self._db_expire, deadline)
+                except sqlite3.Error as e:
+                    logging.error("Failed to expire chat sessions: %s", e)
+
+    # 以下方法在数据库线程中执行
+
+    def _open(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                             timeout=5)
+        # WAL允许多个worker同时读, 写入互相等待
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            db.execute(statement)
+        self._db = db
+
+    def _db_state(self, key: SessionKey) -> Optional[Tuple[int, int]]:
+        row = self._db.execute(
+            "SELECT next_seq, summary_upto FROM chat_sessions WHERE caller = ? AND session_id = ?",
+            key).fetchone()
+        return tuple(row) if row else None
+
+    def _db_load(self, key: SessionKey) -> Optional[Session]:
+        row = self._db.execute(
+            "SELECT next_seq, summary, summary_upto FROM chat_sessions "
+            "WHERE caller = ? AND session_id = ?", key).fetchone()
+        if row is None:
+            return None
+        next_seq, summary, summary_upto = row
+        messages = [
+            {"seq": seq, "role": role, "content": content}
+            for seq, role, content in self._db.execute(
+                "SELECT seq, role, content FROM chat_messages "
+                "WHERE caller = ? AND session_id = ? ORDER BY seq", key)
+        ]
+        return Session(key, messages, next_seq, summary, summary_upto)
+
+    def _db_create(self, key: SessionKey) -> None:
+        self._db.execute(
+            "INSERT OR IGNORE INTO chat_sessions (caller, session_id, next_seq, summary, "
+            "summary_upto, updated) VALUES (?, ?, 0, '', 0, ?)", (*key, time.time()))
+
+    def _db_append(self, key: SessionKey, messages: List[Dict]) -> None:
+        """在事务中按数据库里的next_seq编号, 其他worker同时追加也不会冲突"""
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT next_seq FROM chat_sessions WHERE caller = ? AND session_id = ?",
+                key).fetchone()
+            next_seq = row[0] if row else 0
+            if any(message["role"] == "system" for message in messages):
+                # 只有system消息变化时才会追加, 替换保存的system消息
+                db.execute(
+                    "DELETE FROM chat_messages WHERE caller = ? AND session_id = ? "
+                    "AND role = 'system'", key)
+            db.executemany(
+                "INSERT INTO chat_messages (caller, session_id, seq, role, content) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(*key, next_seq + index, message["role"], message["content"])
+                 for index, message in enumerate(messages)])
+            next_seq += len(messages)
+            db.execute(
+                "INSERT INTO chat_sessions (caller, session_id, next_seq, summary, summary_upto, "
+                "updated) VALUES (?, ?, ?, '', 0, ?) ON CONFLICT (caller, session_id) "
+                "DO UPDATE SET next_seq = excluded.next_seq, updated = excluded.updated",
+                (*key, next_seq, time.time()))
+            db.execute(
+                "DELETE FROM chat_messages WHERE caller = ? AND session_id = ? "
+                "AND role != 'system' AND seq < ?",
+                (*key, next_seq - SESSION_MAX_MESSAGES))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _db_set_summary(self, key: SessionKey, summary: str, upto: int) -> None:
+        self._db.execute(
+            "UPDATE chat_sessions SET summary = ?, summary_upto = ? "
+            "WHERE caller = ? AND session_id = ? AND summary_upto < ?",
+            (summary, upto, *key, upto))
+
+    def _db_delete(self, key: SessionKey) -> bool:
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM chat_messages WHERE caller = ? AND session_id = ?", key)
+            deleted = db.execute(
+                "DELETE FROM chat_sessions WHERE caller = ? AND session_id = ?", key).rowcount
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return deleted > 0
+
+    def _db_expire(self, deadline: float) -> None:
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "DELETE FROM chat_messages WHERE (caller, session_id) IN "
+                "(SELECT caller, session_id FROM chat_sessions WHERE updated < ?)", (deadline,))
+            db.execute("DELETE FROM chat_sessions WHERE updated < ?", (deadline,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+
+session_store = SessionStore(SESSION_MAX_SESSIONS, SESSION_DB)
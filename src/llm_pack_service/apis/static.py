@@ -0,0 +1,267 @@
+import os
+import re
+import base64
+import asyncio
+import hashlib
+import logging
+import mimetypes
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from . import metrics
+from .compression import (AVAILABLE_ENCODINGS, COMPRESSION_MEDIA_TYPES,
+                          COMPRESSION_MIN_SIZE, ENCODERS, negotiate)
+
+# 静态文件目录
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+# 内存缓存的总字节数和单个文件的上限, 超过上限的文件每次从磁盘读取
+STATIC_MEMORY_CACHE_BYTES = int(os.getenv("STATIC_MEMORY_CACHE_BYTES", str(32 * 1024 * 1024)))
+STATIC_MEMORY_CACHE_MAX_FILE = int(os.getenv("STATIC_MEMORY_CACHE_MAX_FILE", str(256 * 1024)))
+# 文件名不带内容摘要时的缓存秒数
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "3600"))
+# 指向本服务/static的URL前缀, 视觉接口收到这些URL时直接读取本地文件
+WEB_PORT = os.getenv("WEB_PORT", "8808")
+STATIC_SELF_URLS = tuple(
+    prefix.strip() for prefix in os.getenv(
+        "STATIC_SELF_URLS",
+        f"http://localhost:{WEB_PORT}/static/,http://127.0.0.1:{WEB_PORT}/static/"
+    ).split(",") if prefix.strip())
+
+# 文件名中带内容摘要(如app.3f2a9c1b.js, logo-3f2a9c1b5d.png)时内容永不改变, 可以长期缓存
+HASHED_NAME = re.compile(r"[.-][0-9a-fA-F]{8,}\.[^./]+$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 磁盘上预压缩文件的扩展名, 例如由部署脚本`gzip -k`/`brotli -k`生成
+PRECOMPRESSED_SUFFIXES = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+
+
+def cache_control(path: str) -> str:
+    if HASHED_NAME.search(path):
+        return IMMUTABLE_CACHE_CONTROL
+    return f"public, max-age={STATIC_MAX_AGE}"
+
+
+def _media_type(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def _compressible(media_type: str) -> bool:
+    return media_type.startswith(COMPRESSION_MEDIA_TYPES)
+
+
+class CachedFile:
+    """内存中的小文件及其压缩版本"""
+
+    def __init__(self, path: str, stat_result: os.stat_result, body: bytes):
+        self.mtime_ns = stat_result.st_mtime_ns
+        self.size = stat_result.st_size
+        self.body = body
+        self.media_type = _media_type(path)
+        self.compressible = _compressible(self.media_type)
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        self.last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+        self.cache_control = cache_control(path)
+        # 编码 -> 压缩后的内容, 只保留比原文件小的
+        self.variants: Dict[str, bytes] = {}
+        if self.compressible and len(body) >= COMPRESSION_MIN_SIZE:
+            for encoding in AVAILABLE_ENCODINGS:
+                encoder = ENCODERS[encoding]()
+                compressed = encoder.compress(body) + encoder.finish()
+                if len(compressed) < len(body):
+                    self.variants[encoding] = compressed
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.body) + sum(len(variant) for variant in self.variants.values())
+
+    def fresh(self, stat_result: os.stat_result) -> bool:
+        return self.mtime_ns == stat_result.st_mtime_ns and self.size == stat_result.st_size
+
+
+class StaticFileCache:
+    """按最近使用淘汰的小文件缓存, 总大小不超过STATIC_MEMORY_CACHE_BYTES"""
+
+    def __init__(self, max_bytes: int, max_file: int):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.nbytes = 0
+        self._files: "OrderedDict[str, CachedFile]" = OrderedDict()
+
+    def get(self, path: str, stat_result: os.stat_result) -> Optional[CachedFile]:
+        """返回缓存的文件, 未缓存或已修改时重新读取; 大文件返回None"""
+        if stat_result.st_size > self.max_file:
+            return None
+        cached = self._files.get(path)
+        if cached is not None and cached.fresh(stat_result):
+            self._files.move_to_end(path)
+            return cached
+        # 小文件读取很快, 直接在事件循环中读; 启动时会预先加载整个目录
+        with open(path, "rb") as f:
+            body = f.read()
+        self._store(path, CachedFile(path, stat_result, body))
+        return self._files.get(path)
+
+    def _store(self, path: str, cached: CachedFile) -> None:
+        old = self._files.pop(path, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        if cached.nbytes > self.max_bytes:
+            return
+        self._files[path] = cached
+        self.nbytes += cached.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._files.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def preload(self, directory: str) -> int:
+        """加载目录下的小文件, 返回加载的文件数"""
+        count = 0
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if name.endswith(tuple(PRECOMPRESSED_SUFFIXES.values())):
+                    continue
+                path = os.path.realpath(os.path.join(root, name))
+                try:
+                    if self.get(path, os.stat(path)) is not None:
+                        count += 1
+                except OSError:
+                    continue
+        return count
+
+
+file_cache = StaticFileCache(STATIC_MEMORY_CACHE_BYTES, STATIC_MEMORY_CACHE_MAX_FILE)
+
+
+class CachedStaticFiles(StaticFiles):
+    """/static的文件服务
+
+    小文件从内存返回, 可压缩的类型同时缓存压缩后的内容; 大文件优先使用磁盘上的
+    预压缩文件(.br/.zst/.gz)。响应都带ETag/Last-Modified, 文件名带内容摘要的
+    返回immutable长期缓存头。
+    """
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope,
+                      status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        cached = file_cache.get(full_path, stat_result)
+        if cached is not None:
+            return self._memory_response(cached, request_headers, status_code)
+        media_type = _media_type(full_path)
+        headers = {"Cache-Control": cache_control(full_path)}
+        encoding = None
+        if _compressible(media_type):
+            headers["Vary"] = "Accept-Encoding"
+            encoding, variant = self._precompressed(full_path, stat_result, request_headers)
+            if encoding is not None:
+                full_path, stat_result = variant
+                headers["Content-Encoding"] = encoding
+        response = FileResponse(full_path, status_code=status_code, headers=headers,
+                                media_type=media_type, stat_result=stat_result)
+        if self.is_not_modified(response.headers, request_headers):
+            metrics.static_responses_total.inc("not_modified")
+            return NotModifiedResponse(response.headers)
+        metrics.static_responses_total.inc("precompressed" if encoding else "disk")
+        return response
+
+    def _memory_response(self, cached: CachedFile, request_headers: Headers,
+                         status_code: int) -> Response:
+        headers = {"Cache-Control": cached.cache_control, "Last-Modified": cached.last_modified}
+        body = cached.body
+        etag = cached.etag
+        if cached.compressible:
+            headers["Vary"] = "Accept-Encoding"
+            encoding = negotiate(request_headers.get("accept-encoding", ""),
+                                 list(cached.variants))
+            if encoding is not None:
+                body = cached.variants[encoding]
+                # 不同编码的内容不同, ETag也要不同
+                etag = f'{etag[:-1]}-{encoding}"'
+                headers["Content-Encoding"] = encoding
+        headers["ETag"] = etag
+        response = Response(body, status_code=status_code, headers=headers,
+                            media_type=cached.media_type)
+        if self.is_not_modified(response.headers, request_headers):
+            metrics.static_responses_total.inc("not_modified")
+            return NotModifiedResponse(response.headers)
+        metrics.static_responses_total.inc("memory")
+        return response
+
+    @staticmethod
+    def _precompressed(full_path: str, stat_result: os.stat_result, request_headers: Headers
+                       ) -> Tuple[Optional[str], Optional[Tuple[str, os.stat_result]]]:
+        """查找客户端接受、且不比原文件旧的预压缩文件"""
+        candidates: Dict[str, Tuple[str, os.stat_result]] = {}
+        for encoding, suffix in PRECOMPRESSED_SUFFIXES.items():
+            try:
+                variant_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            if variant_stat.st_mtime >= stat_result.st_mtime:
+                candidates[encoding] = (full_path + suffix, variant_stat)
+        if not candidates:
+            return None, None
+        encoding = negotiate(request_headers.get("accept-encoding", ""),
+                             [name for name in PRECOMPRESSED_SUFFIXES if name in candidates])
+        if encoding is None:
+            return None, None
+        return encoding, candidates[encoding]
+
+
+def self_static_path(url: str) -> Optional[str]:
+    """url指向本服务的/static时返回本地文件路径, 否则返回None"""
+    if not url.startswith(STATIC_SELF_URLS):
+        return None
+    relative = unquote(urlsplit(url).path).split("/static/", 1)[1]
+    directory = os.path.realpath(STATIC_DIR)
+    path = os.path.realpath(os.path.join(directory, relative))
+    if os.path.commonpath([path, directory]) != directory or not os.path.isfile(path):
+        return None
+    return path
+
+
+async def read_self_static(url: str) -> Optional[bytes]:
+    """读取指向本服务/static的URL, 小文件来自内存缓存"""
+    path = self_static_path(url)
+    if path is None:
+        return None
+    stat_result = os.stat(path)
+    cached = file_cache.get(path, stat_result)
+    if cached is not None:
+        return cached.body
+
+    def read() -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    return await asyncio.to_thread(read)
+
+
+async def inline_self_urls(req_dict: Dict) -> Dict:
+    """把视觉接口请求中指向本服务/static的image_urls换成binary_data_base64
+
+    上游无法访问localhost, 而且同一进程内读文件不需要走网络; 只有全部URL都
+    指向本服务时才替换, 因为image_urls和binary_data_base64不能同时使用。
+    """
+    urls: List[str] = req_dict.get("image_urls") or []
+    if not urls or req_dict.get("binary_data_base64"):
+        return req_dict
+    contents = []
+    for url in urls:
+        content = await read_self_static(url)
+        if content is None:
+            return req_dict
+        contents.append(base64.b64encode(content).decode("ascii"))
+    metrics.static_responses_total.inc("inline", amount=len(contents))
+    logging.debug("Inlined %d self /static image(s)", len(contents))
+    inlined = {key: value for key, value in req_dict.items() if key != "image_urls"}
+    inlined["binary_data_base64"] = contents
+    return inlined
+
+
+async def on_startup() -> None:
+    count = await asyncio.to_thread(file_cache.preload, STATIC_DIR)
+    logging.info("Preloaded %d static file(s), %d bytes", count, file_cache.nbytes)
@@ -1,20 +1,45 @@
 from enum import Enum
-from typing import Union
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Dict, List, Optional, Tuple, Union
 from fastapi import APIRouter
 from fastapi.responses import StreamingResponse, Response
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+import asyncio
+import base64
 import httpx
 import json
 import os
+import re
 import logging
+import aiofiles
 from dotenv import load_dotenv
-from .error import get_error_response
+from .error import get_error_response, ImageGenerationError, CircuitOpenError
+from .cache import ResultCache, make_cache_key
+from .utils import get_http_client
+from .mirror import schedule_mirror
+from . import metrics, resilience
+from .logs import log_payload
+from .responses import JSON_MEDIA_TYPE, dumps_str, json_response
 
 # load env
 load_dotenv()
 
 router = APIRouter(prefix="/api/v1", tags=["文字生成图像"])
-JSON_MEDIA_TYPE = "application/json"
+
+# 上游返回的图片URL有效期为24小时, 缓存略短于该时间以免返回已过期的URL
+txt2img_cache = ResultCache(
+    ttl=float(os.getenv("TXT2IMG_CACHE_TTL", "82800")),
+    max_entries=int(os.getenv("TXT2IMG_CACHE_MAX_ENTRIES", "1024")),
+    disk_dir=os.getenv("TXT2IMG_CACHE_DIR"),
+    disk_ttl=float(os.getenv("TXT2IMG_CACHE_DISK_TTL", "604800")),
+    disk_max_bytes=int(os.getenv("TXT2IMG_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+)
+
+# 所有批量请求共享的上游并发上限
+batch_semaphore = asyncio.Semaphore(int(os.getenv("TXT2IMG_BATCH_CONCURRENCY", "4")))
+TXT2IMG_BATCH_MAX_IMAGES = int(os.getenv("TXT2IMG_BATCH_MAX_IMAGES", "64"))
+
+B64_JSON_START = re.compile(rb'"b64_json"\s*:\s*"')
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class ReqJson(BaseModel):
@@ -25,6 +50,12 @@ class ReqJson(BaseModel):
         extra = "allow"
 
 
+class BatchReqJson(BaseModel):
+    """批量文本到图像的请求体"""
+    prompts: List[str] = Field(..., min_length=1, description="提示词列表")
+    n: int = Field(1, ge=1, le=8, description="每个提示词生成的图片数量")
+
+
 T2iImageSizes = Enum("T2iImageSizes", {
     tis: tis for tis in [
         '1024x1024', '864x1152', '1152x864',
@@ -33,16 +64,329 @@ T2iImageSizes = Enum("T2iImageSizes", {
     ]
 })
 ResponseFormat = Enum("ResponseFormat", {rf: rf for rf in ['url', 'b64_json']})
+BatchOutput = Enum("BatchOutput", {bo: bo for bo in ['ndjson', 'sse']})
 # WaterMark = Enum("WaterMark", {wm:wm for wm in ['true','false']})
 
 
+def _build_image_request(prompt: str, size: str, response_format: str,
+                         guidance_scale: float, watermark: bool,
+                         seed: int) -> Tuple[str, Dict, Dict]:
+    """构造上游请求的url, 请求头和请求体"""
+    url = os.getenv("DOUBAO_TEXT_GENERATE_IMAGE_API_URL", "")
+    token = os.getenv("DOUBAO_TEXT_GENERATE_IMAGE_API_KEY")
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token}"
+    }
+    data = {
+        "model": os.getenv("DOUBAO_TEXT_GENERATE_IMAGE_MODEL",
+                           "doubao-seedream-3-0-t2i-250415"),
+        "size": size,
+        "response_format": response_format,
+        "watermark": watermark,
+        "guidance_scale": guidance_scale,
+        "seed": seed,
+        "prompt": prompt
+    }
+    return url, headers, data
+
+
+def _image_cache_key(data: Dict) -> Optional[str]:
+    """固定seed时相同参数的生成结果是确定的, 可直接复用缓存; seed为-1时返回None"""
+    if data["seed"] == -1:
+        return None
+    return make_cache_key(
+        data["model"], data["prompt"], data["size"], data["guidance_scale"],
+        data["seed"], data["watermark"], data["response_format"])
+
+
+async def generate_image(prompt: str, size: str, response_format: str,
+                         guidance_scale: float, watermark: bool,
+                         seed: int) -> Dict:
+    """调用上游生成一张图片
+
+    Args:
+        prompt str: 提示词
+        size str: 图片大小
+        response_format str: 返回格式
+        guidance_scale float: 自由度
+        watermark bool: 是否水印
+        seed int: 随机种子, -1表示随机(此时不使用缓存)
+
+    Returns:
+        Dict: 包含image_url或b64_json以及usage的结果
+
+    Raises:
+        ImageGenerationError: 上游请求失败或返回格式异常
+    """
+    url, headers, data = _build_image_request(
+        prompt, size, response_format, guidance_scale, watermark, seed)
+
+    cache_key = _image_cache_key(data)
+    if cache_key:
+        cached = await txt2img_cache.get(cache_key)
+        if cached is not None:
+            logging.debug("txt2img cache hit: %s", cache_key)
+            return cached
+    logging.debug("Request url: %s", url)
+    log_payload("Request data: %s", data)
+    timeout = httpx.Timeout(60.0, connect=30.0)
+    client = get_http_client()
+    try:
+        response = await resilience.call(
+            "doubao_txt2img",
+            lambda: client.post(
+                url, headers=headers, json=data, timeout=timeout,
+                extensions=metrics.trace_upstream("doubao_txt2img")))
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise ImageGenerationError(
+            f"HTTP error occurred: {e.response.status_code} - url: {url} - data: {data}")
+    except httpx.ConnectTimeout:
+        raise ImageGenerationError(
+            "Connection to image generation service timed out")
+    except httpx.ReadTimeout:
+        raise ImageGenerationError("Image generation service response timed out")
+    except httpx.RequestError as e:
+        raise ImageGenerationError(f"Request to image generation service failed: {str(e)}")
+    except CircuitOpenError as e:
+        raise ImageGenerationError(str(e))
+    data = response.json()
+    log_payload("Response data: %s", data)
+    if response_format == ResponseFormat.url.value:
+        try:
+            resp_data = {
+                "image_url": data["data"][0]["url"],
+                "usage": data["usage"]
+            }
+        except Exception:
+            raise ImageGenerationError(f"image_url not found in {data}")
+        if cache_key:
+            await txt2img_cache.set(cache_key, resp_data)
+        return resp_data
+    elif response_format == ResponseFormat.b64_json.value:
+        try:
+            resp_data = {
+                "b64_json": data["data"][0]["b64_json"],
+                "usage": data["usage"]
+            }
+        except Exception:
+            raise ImageGenerationError(f"image_url not found in {data}")
+        if cache_key:
+            await txt2img_cache.set(cache_key, resp_data, disk=True)
+        return resp_data
+    raise ImageGenerationError(f"Unsupported response format: {response_format}")
+
+
+async def _open_b64_stream(url: str, headers: Dict,
+                           data: Dict) -> Tuple[httpx.Response, AsyncIterator[bytes], bytes, bytes]:
+    """发起上游请求并读到b64_json字段开头为止
+
+    Returns:
+        Tuple: (上游响应, 剩余内容的迭代器, b64_json字段之前的内容, 已读到的b64数据)
+    """
+    client = get_http_client()
+
+    def send() -> Awaitable[httpx.Response]:
+        request = client.build_request(
+            "POST", url, headers=headers, json=data,
+            timeout=httpx.Timeout(60.0, connect=30.0),
+            extensions=metrics.trace_upstream("doubao_txt2img"))
+        return client.send(request, stream=True)
+
+    try:
+        response = await resilience.call("doubao_txt2img", send)
+    except CircuitOpenError as e:
+        raise ImageGenerationError(str(e))
+    except httpx.ConnectTimeout:
+        raise ImageGenerationError(
+            "Connection to image generation service timed out")
+    except httpx.ReadTimeout:
+        raise ImageGenerationError("Image generation service response timed out")
+    except httpx.RequestError as e:
+        raise ImageGenerationError(f"Request to image generation service failed: {str(e)}")
+    try:
+        if response.is_error:
+            raise ImageGenerationError(
+                f"HTTP error occurred: {response.status_code} - url: {url} - data: {data}")
+        buffer = b""
+        chunks = response.aiter_bytes()
+        async for chunk in chunks:
+            buffer += chunk
+            match = B64_JSON_START.search(buffer)
+            if match:
+                return response, chunks, buffer[:match.start()], buffer[match.end():]
+        raise ImageGenerationError(f"b64_json not found in {buffer[:1024]!r}")
+    except BaseException:
+        await response.aclose()
+        raise
+
+
+async def _iter_b64_payload(first: bytes, rest: AsyncIterator[bytes],
+                            suffix: List[bytes]) -> AsyncGenerator[bytes, None]:
+    """逐块产出b64_json字符串的内容, 字符串之后的剩余内容写入suffix"""
+    pending = first
+    while True:
+        end = pending.find(b'"')
+        if end >= 0:
+            # base64中唯一可能出现的转义是"\/"
+            if end:
+                yield pending[:end].replace(b"\\", b"")
+            suffix.append(pending[end + 1:])
+            async for chunk in rest:
+                suffix.append(chunk)
+            return
+        if pending:
+            yield pending.replace(b"\\", b"")
+        try:
+            pending = await rest.__anext__()
+        except StopAsyncIteration:
+            raise ImageGenerationError("Unterminated b64_json in upstream response")
+
+
+async def b64_stream_generator(response: httpx.Response,
+                               chunks: AsyncIterator[bytes], prefix: bytes,
+                               first: bytes, binary: bool,
+                               cache_key: Optional[str]) -> AsyncGenerator[bytes, None]:
+    """把上游的b64_json边读边转发, 不在内存中完整保存图片
+
+    Args:
+        response httpx.Response: 已读到b64_json字段开头的上游响应
+        chunks AsyncIterator[bytes]: 上游响应剩余内容的迭代器
+        prefix bytes: b64_json字段之前的内容
+        first bytes: 已读到的b64数据
+        binary bool: 是否解码为图片二进制
+        cache_key Optional[str]: 缓存键, 为None时不写缓存
+
+    Yields:
+        bytes: JSON或图片二进制分块
+    """
+    writer = txt2img_cache.disk_writer(cache_key) if cache_key else None
+    suffix: List[bytes] = []
+    remainder = b""
+    try:
+        head = b'{"b64_json": "'
+        if writer:
+            await writer.write(head)
+        if not binary:
+            yield head
+        async for payload in _iter_b64_payload(first, chunks, suffix):
+            if writer:
+                await writer.write(payload)
+            if binary:
+                payload = remainder + payload
+                aligned = len(payload) - len(payload) % 4
+                remainder = payload[aligned:]
+                if aligned:
+                    yield base64.b64decode(payload[:aligned])
+            else:
+                yield payload
+        try:
+            usage = json.loads(prefix + b'"b64_json": ""' + b"".join(suffix))["usage"]
+        except (ValueError, KeyError):
+            usage = {}
+        tail = b'", "usage": ' + json.dumps(usage).encode("utf-8") + b"}"
+        if writer:
+            await writer.write(tail)
+            await writer.commit()
+            writer = None
+        if not binary:
+            yield tail
+    finally:
+        if writer:
+            await writer.abort()
+        await response.aclose()
+
+
+async def cached_b64_generator(path: str, binary: bool) -> AsyncGenerator[bytes, None]:
+    """流式返回磁盘缓存中的b64_json结果, 解码时也按块读取文件, 不把整张图片读进内存"""
+    async with aiofiles.open(path, "rb") as f:
+        async def chunks() -> AsyncGenerator[bytes, None]:
+            while chunk := await f.read(STREAM_CHUNK_SIZE):
+                yield chunk
+
+        if not binary:
+            async for chunk in chunks():
+                yield chunk
+            return
+        rest = chunks()
+        buffer = b""
+        async for chunk in rest:
+            buffer += chunk
+            match = B64_JSON_START.search(buffer)
+            if match:
+                break
+        else:
+            raise ImageGenerationError(f"b64_json not found in cache file {path}")
+        remainder = b""
+        async for payload in _iter_b64_payload(buffer[match.end():], rest, []):
+            # 文件分块的边界不一定对齐到4字节, 余下的部分和下一块一起解码
+            payload = remainder + payload
+            aligned = len(payload) - len(payload) % 4
+            remainder = payload[aligned:]
+            if aligned:
+                yield base64.b64decode(payload[:aligned])
+
+
+def _image_media_type(head: bytes) -> str:
+    """根据文件头识别图片类型"""
+    if head.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+async def stream_b64_image(prompt: str, size: str, guidance_scale: float,
+                           watermark: bool, seed: int,
+                           binary: bool) -> Union[StreamingResponse, Response]:
+    """以流的方式返回b64_json格式的图像生成结果"""
+    url, headers, data = _build_image_request(
+        prompt, size, ResponseFormat.b64_json.value,
+        guidance_scale, watermark, seed)
+    cache_key = _image_cache_key(data)
+    cached_path = await txt2img_cache.disk_file(cache_key) if cache_key else None
+    if cached_path:
+        logging.debug("txt2img cache hit: %s", cache_key)
+        body = cached_b64_generator(cached_path, binary)
+    else:
+        logging.debug("Request url: %s", url)
+        try:
+            response, chunks, prefix, first = await _open_b64_stream(
+                url, headers, data)
+        except ImageGenerationError as e:
+            return get_error_response(str(e))
+        body = b64_stream_generator(
+            response, chunks, prefix, first, binary, cache_key)
+
+    if not binary:
+        return StreamingResponse(body, media_type=JSON_MEDIA_TYPE)
+    # 先取出第一块用于识别图片类型
+    try:
+        first_chunk = await body.__anext__()
+    except StopAsyncIteration:
+        first_chunk = b""
+    except ImageGenerationError as e:
+        return get_error_response(str(e))
+
+    async def chained() -> AsyncGenerator[bytes, None]:
+        yield first_chunk
+        async for chunk in body:
+            yield chunk
+
+    return StreamingResponse(chained(), media_type=_image_media_type(first_chunk))
+
+
 @router.post("/txt2img", response_model=None)
 async def text_gen_image(
     req_json: ReqJson,
     size: T2iImageSizes, # type: ignore
     response_format: ResponseFormat, # type: ignore
     guidance_scale: float = 2.5,
-    watermark: bool = False
+    watermark: bool = False,
+    seed: int = 123,
+    stream: bool = True,
+    binary: bool = False
 ) -> Union[StreamingResponse, Response]:
     """文本生成图像
     Args:
@@ -51,6 +395,9 @@ async def text_gen_image(
         response_format ResponseFormat: 返回格式
         guidance_scale: float: 自由度
         watermark bool: 是否水印
+        seed int: 随机种子, -1表示随机(此时不使用缓存)
+        stream bool: b64_json格式时是否边读边转发, 默认为True
+        binary bool: b64_json格式时是否直接返回解码后的图片
     Returns:
         Union[StreamingResponse, Response]: 图像生成结果
     """
@@ -59,68 +406,113 @@ async def text_gen_image(
         prompt = req_dict['prompt']
     except Exception as e:
         return get_error_response(f"请求格式错误，请检查输入数据：{e}")
-    url = os.getenv("DOUBAO_TEXT_GENERATE_IMAGE_API_URL")
-    token = os.getenv("DOUBAO_TEXT_GENERATE_IMAGE_API_KEY")
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}"
-    }
-    data = {
-        "model": os.getenv("DOUBAO_TEXT_GENERATE_IMAGE_MODEL",
-                           "doubao-seedream-3-0-t2i-250415"),
-        "size": size.value,
-        "response_format": response_format.value,
-        "watermark": True,
-        "guidance_scale": guidance_scale,
-        "seed": 123,
-        "prompt": prompt
-    }
-    logging.debug(f"Request url: {url}")
-    logging.debug(f"Request data: {json.dumps(data)}")
-    timeout = httpx.Timeout(60.0, connect=30.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
+    if response_format == ResponseFormat.b64_json and (stream or binary):
+        return await stream_b64_image(
+            prompt, size.value, guidance_scale, watermark, seed, binary)
+    try:
+        resp_data = await generate_image(
+            prompt, size.value, response_format.value,
+            guidance_scale, watermark, seed)
+    except ImageGenerationError as e:
+        return get_error_response(str(e))
+    background = None
+    if "image_url" in resp_data:
+        mirror_urls, background = await schedule_mirror([resp_data["image_url"]])
+        if mirror_urls:
+            resp_data = {**resp_data, "mirror_url": mirror_urls[0]}
+    return json_response(resp_data, background=background)
+
+
+async def _generate_batch_item(index: int, prompt: str, variant: int,
+                               seed: int, **kwargs) -> Dict:
+    """在并发上限内生成批量任务中的一张图片"""
+    async with batch_semaphore:
         try:
-            response = await client.post(url, headers=headers, json=data)
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            return get_error_response(
-                f"HTTP error occurred: {e.response.status_code} - url: {url} - data: {data}")
-        except httpx.ConnectTimeout:
-            return get_error_response(
-                "Connection to image generation service timed out")
-        except httpx.ReadTimeout:
-            return get_error_response("Image generation service response timed out")
-        except httpx.RequestError as e:
-            return get_error_response(f"Request to image generation service failed: {str(e)}")
-        data = response.json()
-        logging.debug(f"Response data: {data}")
-        logging.debug(f"{response_format}, {ResponseFormat.url.value}")
-        if response_format == ResponseFormat.url:
-            try:
-                resp_data = {
-                    "image_url": data["data"][0]["url"],
-                    "usage": data["usage"]
-                }
-            except Exception:
-                return get_error_response(f"image_url not found in {data}")
-            return Response(
-                json.dumps(resp_data),
-                status_code=200,
-                media_type=JSON_MEDIA_TYPE
-            )
-        elif response_format == ResponseFormat.b64_json:
-            try:
-                resp_data = {
-                    "b64_json": data["data"][0]["b64_json"],
-                    "usage": data["usage"]
-                }
-            except Exception:
-                return get_error_response(f"image_url not found in {data}")
-            return Response(
-                json.dumps(resp_data),
-                status_code=200,
-                media_type=JSON_MEDIA_TYPE
-            )
-        else:
-            return get_error_response(
-                f"Unsupported response format: {response_format}")
+            resp_data = await generate_image(prompt, seed=seed, **kwargs)
+        except ImageGenerationError as e:
+            return {"index": index, "prompt": prompt, "variant": variant,
+                    "seed": seed, "code": 0, "msg": str(e), "data": {}}
+    return {"index": index, "prompt": prompt, "variant": variant,
+            "seed": seed, "code": 1, "msg": "success", "data": resp_data}
+
+
+async def batch_generator(jobs: List[Dict], output: str,
+                          **kwargs) -> AsyncGenerator[str, None]:
+    """并发生成图片, 按完成顺序逐条返回结果
+
+    Args:
+        jobs List[Dict]: 每个元素包含index, prompt, variant, seed
+        output str: ndjson或sse
+
+    Yields:
+        str: 单张图片的结果
+    """
+    tasks = [asyncio.create_task(_generate_batch_item(**job, **kwargs))
+             for job in jobs]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            item = await finished
+            line = dumps_str(item)
+            if output == BatchOutput.sse.value:
+                yield "data: " + line + "\n\n"
+            else:
+                yield line + "\n"
+        if output == BatchOutput.sse.value:
+            yield "data: [DONE]\n\n"
+    finally:
+        # 客户端断开时取消尚未完成的上游请求
+        for task in tasks:
+            task.cancel()
+
+
+@router.post("/txt2img/batch", response_model=None)
+async def text_gen_image_batch(
+    req_json: BatchReqJson,
+    size: T2iImageSizes, # type: ignore
+    response_format: ResponseFormat, # type: ignore
+    guidance_scale: float = 2.5,
+    watermark: bool = False,
+    seed: int = 123,
+    output: BatchOutput = BatchOutput.ndjson # type: ignore
+) -> Union[StreamingResponse, Response]:
+    """批量文本生成图像
+    Args:
+        req_json BatchReqJson: 请求体，包含提示词列表和每个提示词的图片数量
+        size T2iImageSizes: 图片大小
+        response_format ResponseFormat: 返回格式
+        guidance_scale: float: 自由度
+        watermark bool: 是否水印
+        seed int: 起始随机种子, 同一提示词的第i张图片使用seed+i, -1表示随机
+        output BatchOutput: 结果流格式, ndjson或sse
+    Returns:
+        Union[StreamingResponse, Response]: 按完成顺序返回的图像生成结果流
+    """
+    total = len(req_json.prompts) * req_json.n
+    if total > TXT2IMG_BATCH_MAX_IMAGES:
+        return get_error_response(
+            f"单次批量生成的图片数量 {total} 超过上限 {TXT2IMG_BATCH_MAX_IMAGES}")
+    jobs = [
+        {"index": index, "prompt": prompt, "variant": variant,
+         "seed": seed if seed == -1 else seed + variant}
+        for index, prompt in enumerate(req_json.prompts)
+        for variant in range(req_json.n)
+    ]
+    if output == BatchOutput.sse:
+        media_type = "text/event-stream"
+    else:
+        media_type = "application/x-ndjson"
+    return StreamingResponse(
+        batch_generator(jobs, output.value, size=size.value,
+                        response_format=response_format.value,
+                        guidance_scale=guidance_scale, watermark=watermark),
+        media_type=media_type,
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+def upstream_urls() -> List[str]:
+    """启动时用于预热连接的上游地址"""
+    return [os.getenv("DOUBAO_TEXT_GENERATE_IMAGE_API_URL", "")]
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+from . import metrics
+from .error import QuotaExceededError
+
+# 调用方通过该请求头传入API key, 没有时记为anonymous
+API_KEY_HEADER = "X-API-Key"
+# 每个key的默认限额, 0表示不限制
+QUOTA_REQUESTS_PER_MINUTE = int(os.getenv("QUOTA_REQUESTS_PER_MINUTE", "0"))
+QUOTA_TOKENS_PER_DAY = int(os.getenv("QUOTA_TOKENS_PER_DAY", "0"))
+QUOTA_MAX_STREAMS = int(os.getenv("QUOTA_MAX_STREAMS", "0"))
+# 按key覆盖默认限额的JSON文件: {"<key>": {"requests_per_minute": 60, ...}}
+QUOTA_KEYS_FILE = os.getenv("QUOTA_KEYS_FILE")
+# 为true时只接受QUOTA_KEYS_FILE中列出的key
+QUOTA_REQUIRE_KEY = os.getenv("QUOTA_REQUIRE_KEY", "false").lower() == "true"
+# 用量明细的落盘文件(JSON Lines)和落盘间隔秒数
+USAGE_LEDGER_FILE = os.getenv("USAGE_LEDGER_FILE", "./data/usage.jsonl")
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "60"))
+
+ANONYMOUS = "anonymous"
+
+
+class Quota:
+    """单个key的限额"""
+
+    def __init__(self, requests_per_minute: int = QUOTA_REQUESTS_PER_MINUTE,
+                 tokens_per_day: int = QUOTA_TOKENS_PER_DAY,
+                 max_streams: int = QUOTA_MAX_STREAMS):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_day = tokens_per_day
+        self.max_streams = max_streams
+
+
+def _load_quotas() -> Dict[str, Quota]:
+    if not QUOTA_KEYS_FILE:
+        return {}
+    with open(QUOTA_KEYS_FILE, "r", encoding="utf-8") as f:
+        return {key: Quota(**limits) for key, limits in json.load(f).items()}
+
+
+def caller_id(api_key: Optional[str]) -> str:
+    """账本中记录key的摘要而不是key本身"""
+    if not api_key:
+        return ANONYMOUS
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class Caller:
+    """一次请求的调用方身份及其限额"""
+
+    def __init__(self, api_key: Optional[str], quota: Quota):
+        self.id = caller_id(api_key)
+        self.quota = quota
+
+
+class UsageLedger:
+    """按调用方和模型累计请求数与token数, 并执行限额
+
+    所有计数都在事件循环线程中更新, 热路径上只有几次dict操作, 不需要锁;
+    待落盘的增量单独存放, 落盘时整体换成新的dict, 写文件在线程中进行。
+    计数只在当前进程内, 多worker运行时每个worker各自执行一份限额。
+    """
+
+    def __init__(self, quotas: Dict[str, Quota]):
+        self.quotas = quotas
+        self.default_quota = Quota()
+        # (调用方, 模型) -> [请求数, prompt_tokens, completion_tokens]
+        self._pending: Dict[Tuple[str, str], List[int]] = {}
+        # 调用方 -> (分钟编号, 请求数)
+        self._minute_requests: Dict[str, Tuple[int, int]] = {}
+        # 调用方 -> (UTC日期, token数)
+        self._day_tokens: Dict[str, Tuple[str, int]] = {}
+        self._streams: Dict[str, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def enforces_limits(self) -> bool:
+        """是否配置了任何限额(默认限额或按key的限额)"""
+        return any(quota.requests_per_minute or quota.tokens_per_day or quota.max_streams
+                   for quota in (self.default_quota, *self.quotas.values()))
+
+    def caller(self, api_key: Optional[str]) -> Caller:
+        """识别调用方, QUOTA_REQUIRE_KEY开启时未登记的key会被拒绝"""
+        quota = self.quotas.get(api_key or "")
+        if quota is None:
+            if QUOTA_REQUIRE_KEY:
+                metrics.quota_rejected_total.inc("unknown_key")
+                raise QuotaExceededError("Missing or unknown API key", 401)
+            quota = self.default_quota
+        return Caller(api_key, quota)
+
+    def tokens_today(self, caller: str) -> int:
+        day, tokens = self._day_tokens.get(caller, ("", 0))
+        return tokens if day == time.strftime("%Y-%m-%d", time.gmtime()) else 0
+
+    def admit(self, caller: Caller, stream: bool = False) -> None:
+        """在请求上游之前检查限额并计入一次请求; 流式请求同时占用一个并发名额"""
+        quota = caller.quota
+        if quota.tokens_per_day and self.tokens_today(caller.id) >= quota.tokens_per_day:
+            metrics.quota_rejected_total.inc("tokens_per_day")
+            raise QuotaExceededError("Daily token quota exhausted", 429,
+                                     retry_after=_seconds_until_utc_midnight())
+        minute = int(time.time() // 60)
+        window, requests = self._minute_requests.get(caller.id, (minute, 0))
+        if window != minute:
+            requests = 0
+        if quota.requests_per_minute and requests >= quota.requests_per_minute:
+            metrics.quota_rejected_total.inc("requests_per_minute")
+            raise QuotaExceededError("Request quota exceeded", 429,
+                                     retry_after=60 - int(time.time() % 60))
+        if stream:
+            streams = self._streams.get(caller.id, 0)
+            if quota.max_streams and streams >= quota.max_streams:
+                metrics.quota_rejected_total.inc("max_streams")
+                raise QuotaExceededError("Too many concurrent streams", 429, retry_after=1)
+            self._streams[caller.id] = streams + 1
+        self._minute_requests[caller.id] = (minute, requests + 1)
+
+    def release_stream(self, caller: Caller) -> None:
+        streams = self._streams.get(caller.id, 0) - 1
+        if streams > 0:
+            self._streams[caller.id] = streams
+        else:
+            self._streams.pop(caller.id, None)
+
+    def record(self, caller: Caller, model: str, usage: Optional[Dict]) -> None:
+        """记录一次已完成的请求及上游返回的usage"""
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        completion_tokens = usage.get("completion_tokens") or 0
+        entry = self._pending.get((caller.id, model))
+        if entry is None:
+            entry = self._pending[(caller.id, model)] = [0, 0, 0]
+        entry[0] += 1
+        entry[1] += prompt_tokens
+        entry[2] += completion_tokens
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        self._day_tokens[caller.id] = (
+            today, self.tokens_today(caller.id) + prompt_tokens + completion_tokens)
+        self._ensure_flushing()
+
+    def _ensure_flushing(self) -> None:
+        """在第一次记录用量时启动定时落盘"""
+        if self._flush_task is None and USAGE_LEDGER_FILE:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            try:
+                await asyncio.to_thread(self._write, self._swap())
+            except Exception as e:
+                logging.error("Failed to flush usage ledger: %s", e)
+
+    def _swap(self) -> Dict[Tuple[str, str], List[int]]:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def _write(self, pending: Dict[Tuple[str, str], List[int]]) -> None:
+        if not pending or not USAGE_LEDGER_FILE:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(USAGE_LEDGER_FILE)), exist_ok=True)
+        timestamp = int(time.time())
+        with open(USAGE_LEDGER_FILE, "a", encoding="utf-8") as f:
+            for (caller, model), (requests, prompt_tokens, completion_tokens) in pending.items():
+                f.write(json.dumps({
+                    "ts": timestamp, "caller": caller, "model": model,
+                    "requests": requests, "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens
+                }) + "\n")
+
+    def flush(self) -> None:
+        """同步写出尚未落盘的用量, 进程退出时调用"""
+        try:
+            self._write(self._swap())
+        except Exception as e:
+            logging.error("Failed to flush usage ledger: %s", e)
+
+
+def _seconds_until_utc_midnight() -> int:
+    return 86400 - int(time.time() % 86400)
+
+
+usage_ledger = UsageLedger(_load_quotas())
+atexit.register(usage_ledger.flush)
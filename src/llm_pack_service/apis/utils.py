@@ -1,9 +1,13 @@
 import os
 import base64
-import requests
+import httpx
+import asyncio
+import logging
 from enum import Enum
-from typing import Dict
+from typing import Dict, Iterable, Optional
+from urllib.parse import urlsplit
 from pydantic import BaseModel, Field
+from . import resilience
 
 
 def get_env_token(key_name: str) -> str:
@@ -17,26 +21,115 @@ def get_env_token(key_name: str) -> str:
     return token
 
 
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取进程内共享的异步HTTP客户端, 复用连接池"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            # 连接阶段单独限时, 上游不可达时尽快失败并交给重试/熔断处理
+            timeout=httpx.Timeout(300.0, connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))),
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+                max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+            )
+        )
+    return _http_client
+
+
+# 启动时是否预先建立到各上游的连接, 以及预热请求的超时秒数
+WARMUP_UPSTREAMS = os.getenv("WARMUP_UPSTREAMS", "true").lower() == "true"
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "3"))
+
+
+async def warm_http_pool(urls: Iterable[str]) -> None:
+    """对每个上游源站发一个HEAD请求, 让TCP/TLS握手在接收流量之前完成
+
+    连接留在共享客户端的连接池中供第一个真实请求复用; 预热失败只记录日志,
+    不影响启动。
+    """
+    if not WARMUP_UPSTREAMS:
+        return
+    origins = set()
+    for url in urls:
+        parts = urlsplit(url or "")
+        if parts.scheme in ("http", "https") and parts.netloc:
+            origins.add(f"{parts.scheme}://{parts.netloc}/")
+    if not origins:
+        return
+    client = get_http_client()
+
+    async def warm(origin: str) -> bool:
+        try:
+            await client.head(origin, timeout=WARMUP_TIMEOUT)
+            return True
+        except httpx.HTTPError as e:
+            logging.warning("Warmup of %s failed: %r", origin, e)
+            return False
+
+    results = await asyncio.gather(*(warm(origin) for origin in sorted(origins)))
+    logging.info("Warmed %d/%d upstream connection(s)", sum(results), len(results))
+
+
 class Provider(str, Enum):
     DEEPSEEK = "deepseek"
     DOUBAO = "doubao"
 
 
-class Token(str, Enum):
-    # DEEPSEEK = get_env_token("DEEPSEEK_API_KEY")
-    DOUBAO = get_env_token("DOUBAO_API_KEY")
+def _build_env_enum(name: str) -> type:
+    """按需构造读取环境变量的枚举, 避免在导入时就要求环境变量存在"""
+    if name == "Token":
+        # DEEPSEEK = get_env_token("DEEPSEEK_API_KEY")
+        return Enum("Token", {"DOUBAO": get_env_token("DOUBAO_API_KEY")}, type=str)
+    if name == "Url":
+        # DEEPSEEK = get_env_token("DEEPSEEK_API_URL")
+        return Enum("Url", {"DOUBAO": get_env_token("DOUBAO_API_URL")}, type=str)
+    # DEEPSEEK = get_env_token("DEEPSEEK_MODEL").split(",")
+    return Enum("Model", {"DOUBAO": get_env_token("DOUBAO_MODEL").split(",")})
 
 
-class Url(str, Enum):
-    # DEEPSEEK = get_env_token("DEEPSEEK_API_URL")
-    DOUBAO = get_env_token("DOUBAO_API_URL")
+_env_enums: Dict[str, type] = {}
+
+
+def __getattr__(name: str):
+    """Token, Url, Model在第一次访问时才读取环境变量"""
+    if name in ("Token", "Url", "Model"):
+        if name not in _env_enums:
+            _env_enums[name] = _build_env_enum(name)
+        return _env_enums[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+_visual_service = None
+
+
+def get_visual_service():
+    """获取共享的火山引擎视觉服务客户端, 第一次使用时才导入volcengine"""
+    global _visual_service
+    if _visual_service is None:
+        from volcengine.visual.VisualService import VisualService # type: ignore
+        visual_service = VisualService()
+        visual_service.set_ak(os.getenv("VOLCEENGINE_ACCESS_KEY"))
+        visual_service.set_sk(os.getenv("VOLCEENGINE_SECRET_KEY"))
+        # 可以改为其他地址, 例如test/upstream_bench.py启动的本地模拟服务
+        if os.getenv("VOLCENGINE_VISUAL_HOST"):
+            visual_service.set_host(os.getenv("VOLCENGINE_VISUAL_HOST"))
+            visual_service.set_scheme(os.getenv("VOLCENGINE_VISUAL_SCHEME", "https"))
+        _visual_service = visual_service
+    return _visual_service
+
+
+async def cv_process(req_dict: Dict) -> Dict:
+    """调用视觉服务的cv_process, 在线程中执行并经过熔断和重试"""
+    from .static import inline_self_urls
+    req_dict = await inline_self_urls(req_dict)
+    visual_service = get_visual_service()
+    return await resilience.call(
+        "volc_visual", lambda: asyncio.to_thread(visual_service.cv_process, req_dict))
 
 
-class Model(str, Enum):
-    # DEEPSEEK = get_env_token("DEEPSEEK_MODEL").split(",")
-    DOUBAO = get_env_token("DOUBAO_MODEL").split(",")
-    
-    
 class ImageResponse(BaseModel):
     code: int = Field(..., description="Response status code")
     msg: str = Field(..., description="Response message")
@@ -45,6 +138,7 @@ class ImageResponse(BaseModel):
 
 
 def url_to_base64(image_url):
+    import requests
     # 下载图片数据
     response = requests.get(image_url)
     response.raise_for_status()  # 检查请求是否成功
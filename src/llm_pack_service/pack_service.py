@@ -1,24 +1,60 @@
+import asyncio
+import importlib
 import logging
 import os
-import sys
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
-from llm_pack_service.apis import chat, audio, text2image, out_painting, image2image
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Header
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
+from llm_pack_service.apis import metrics, static
+from llm_pack_service.apis.admission import AdmissionMiddleware
+from llm_pack_service.apis.compression import CompressionMiddleware
+from llm_pack_service.apis.lifecycle import lifecycle
+from llm_pack_service.apis.logs import setup_logging
+from llm_pack_service.apis.responses import CachedJSON
+from llm_pack_service.apis.utils import warm_http_pool
 
 # load env
 load_dotenv()
 
 # Configure logging for entire application
-logging.basicConfig(
-    level=os.getenv("LOG_LEVEL", "DEBUG").upper(),
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s - %(funcName)s] - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+setup_logging(os.getenv("LOG_LEVEL", "INFO").upper())
+
+# 已加载的路由模块, 模块可以定义on_startup/on_shutdown协程参与生命周期管理
+router_modules = []
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await static.on_startup()
+    for module in router_modules:
+        if hasattr(module, "on_startup"):
+            await module.on_startup()
+    # 预热在开始监听之前完成, 多worker时每个worker各自建立自己的连接池
+    await warm_http_pool(url for module in router_modules
+                         if hasattr(module, "upstream_urls")
+                         for url in module.upstream_urls())
+    export_task = asyncio.create_task(metrics.export_loop())
+    yield
+    export_task.cancel()
+    if metrics.METRICS_MULTIPROC_DIR:
+        metrics.write_snapshot(metrics.METRICS_MULTIPROC_DIR)
+    # uvicorn在进行中的请求结束(或排空超时被取消)之后才执行这里
+    for module in router_modules:
+        if hasattr(module, "on_shutdown"):
+            try:
+                await module.on_shutdown()
+            except Exception as e:
+                logging.error("Shutdown hook of %s failed: %s", module.__name__, e)
 
-app = FastAPI(title="LLM Pack Service")
 
+app = FastAPI(title="LLM Pack Service", lifespan=lifespan)
+
+# 最先添加的中间件在最内层: 准入控制的429/503响应仍会带上CORS头并计入指标
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[os.getenv("ALLOW_ORIGIN") or "*"],  # Allow all origins for development; restrict in production
@@ -26,38 +62,61 @@ app.add_middleware(
     allow_methods=["*"],  # Allow all methods for development; restrict in production
     allow_headers=["*"],  # Allow all headers for development; restrict in production
 )
+app.add_middleware(metrics.MetricsMiddleware)
+app.include_router(metrics.router)
+
+# 可通过ENABLED_ROUTERS只加载需要的路由, 未启用的模块不会被导入
+ROUTERS = ("chat", "audio", "text2image", "out_painting", "image2image",
+           "mirror", "jobs")
+ENABLED_ROUTERS = [
+    name.strip() for name in os.getenv("ENABLED_ROUTERS", ",".join(ROUTERS)).split(",")
+    if name.strip()
+]
+
+for router_name in ENABLED_ROUTERS:
+    if router_name not in ROUTERS:
+        logging.warning("Unknown router in ENABLED_ROUTERS: %s", router_name)
+        continue
+    router_module = importlib.import_module(f"llm_pack_service.apis.{router_name}")
+    app.include_router(router_module.router)
+    router_modules.append(router_module)
+
 
-app.include_router(chat.router)
-app.include_router(audio.router)
-app.include_router(text2image.router)
-app.include_router(out_painting.router)
-app.include_router(image2image.router)
+# 挂载静态文件, 小文件缓存在内存中
+app.mount('/static', static.CachedStaticFiles(directory=static.STATIC_DIR), name='static')
 
 
-# 挂载静态文件
-app.mount('/static', StaticFiles(directory='static'), name='static')
+VERSION = "0.1.4"
+# 健康检查和首页的内容不变, 预先序列化, 每次请求直接返回同一份bytes
+ROOT_PAYLOAD = CachedJSON({"message": "Hello from llm-pack-service!"})
+HEALTHY_PAYLOAD = CachedJSON(dict(lifecycle.health(), version=VERSION))
 
 
-@app.get("/")
-async def root():
-    return {"message": "Hello from llm-pack-service!"}
+@app.get("/", response_model=None)
+async def root(if_none_match: Optional[str] = Header(None)) -> Response:
+    return ROOT_PAYLOAD.response(if_none_match)
 
 
-@app.get("/health")
-async def health_check():
-    return {"status": "ok", "version": "0.1.4"}
+@app.get("/health", response_model=None)
+async def health_check(if_none_match: Optional[str] = Header(None)) -> Response:
+    if not lifecycle.draining:
+        return HEALTHY_PAYLOAD.response(if_none_match)
+    # 排空期间返回503和排空进度, 负载均衡器不再分配新请求
+    health = lifecycle.health()
+    health["version"] = VERSION
+    return JSONResponse(health, status_code=503, headers={"Cache-Control": "no-store"})
 
 
 def main():
     # Test environment variables
     logging.info("Environment Variables Test:")
-    logging.info(f"LOG_LEVEL: {os.getenv('LOG_LEVEL')}")
-    logging.info(f"ALLOW_ORIGIN: {os.getenv('ALLOW_ORIGIN')}")
-    logging.info(f"DOUBAO_API_KEY: {'*****' if os.getenv('DOUBAO_API_KEY') else 'Not Found'}")
+    logging.info("LOG_LEVEL: %s", os.getenv('LOG_LEVEL'))
+    logging.info("ALLOW_ORIGIN: %s", os.getenv('ALLOW_ORIGIN'))
+    logging.info("DOUBAO_API_KEY: %s", '*****' if os.getenv('DOUBAO_API_KEY') else 'Not Found')
     
     logging.info("Starting llm-pack-service...")
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8808, log_level="info")
+    from llm_pack_service.server import serve
+    serve(app)
 
 
 if __name__ == "__main__":
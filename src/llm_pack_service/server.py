@@ -0,0 +1,240 @@
+import os
+import sys
+import math
+import time
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import importlib.util
+from typing import Dict, Optional
+import uvicorn
+from llm_pack_service.apis import metrics
+from llm_pack_service.apis.lifecycle import lifecycle, SHUTDOWN_DRAIN_TIMEOUT, WORKERS_ENV
+
+APP_IMPORT_PATH = "llm_pack_service.pack_service:app"
+# 监听地址和端口
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8808"))
+# worker进程数, auto表示按容器可用的CPU数
+WEB_WORKERS = os.getenv("WEB_WORKERS", "1")
+# 事件循环和HTTP解析器, auto在安装了uvloop/httptools时使用它们
+WEB_LOOP = os.getenv("WEB_LOOP", "auto")
+WEB_HTTP = os.getenv("WEB_HTTP", "auto")
+# worker意外退出后重新拉起前等待的秒数
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", "1"))
+
+# uvicorn在lifespan启动失败时的退出码, 这种worker重启也没有用
+STARTUP_FAILURE = 3
+
+
+class DrainingServer(uvicorn.Server):
+    """收到退出信号时先进入排空状态, 再交给uvicorn停止接收新连接"""
+
+    def handle_exit(self, sig, frame):
+        lifecycle.begin_drain()
+        super().handle_exit(sig, frame)
+
+
+def _exit_on_sigterm(sig, frame) -> None:
+    """uvicorn排空结束后会重新发出SIGTERM, 以SystemExit退出使atexit(日志, 用量账本落盘)得以执行"""
+    sys.exit(0)
+
+
+def available_cpus() -> int:
+    """进程可用的CPU数, 同时考虑CPU亲和性和cgroup v2的cpu.max限额"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+def worker_count(value: str = WEB_WORKERS) -> int:
+    if value.strip().lower() == "auto":
+        return available_cpus()
+    return max(1, int(value))
+
+
+def _describe_runtime() -> str:
+    loop = WEB_LOOP
+    if loop == "auto":
+        loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = WEB_HTTP
+    if http == "auto":
+        http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    return f"loop={loop}, http={http}"
+
+
+def _config(app, **kwargs) -> uvicorn.Config:
+    return uvicorn.Config(app, host=WEB_HOST, port=WEB_PORT, loop=WEB_LOOP, http=WEB_HTTP,
+                          log_level="info",
+                          timeout_graceful_shutdown=int(SHUTDOWN_DRAIN_TIMEOUT), **kwargs)
+
+
+def bind_reuseport(host: str, port: int) -> socket.socket:
+    """创建带SO_REUSEPORT的监听socket, 由内核在各worker之间分配连接
+
+    这里只bind不listen: uvicorn在lifespan启动(预热)完成后才listen,
+    内核不会把连接分给还没准备好的worker。
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+class Supervisor:
+    """预先fork的多worker启动器
+
+    父进程已经导入应用和配置, fork出的worker共享这些只读内存; 每个worker
+    各自绑定SO_REUSEPORT端口, 有自己的事件循环、连接池和指标, 互不共享状态。
+    父进程不处理请求, 只负责转发退出信号和拉起意外退出的worker。
+    """
+
+    def __init__(self, app, workers: int):
+        self.app = app
+        self.workers = workers
+        self.children: Dict[int, int] = {}  # pid -> worker编号
+        self.stopping = False
+        self.metrics_dir: Optional[str] = None
+        self._owns_metrics_dir = False
+
+    def run(self) -> int:
+        self._prepare_metrics_dir()
+        signal.signal(signal.SIGTERM, self._handle_exit)
+        signal.signal(signal.SIGINT, self._handle_exit)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._forward_reload)
+        logging.info("Starting %d workers on %s:%d (%s)", self.workers, WEB_HOST, WEB_PORT,
+                     _describe_runtime())
+        for index in range(self.workers):
+            self._spawn(index)
+        exit_code = self._supervise()
+        self._stop()
+        if self._owns_metrics_dir:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+        return exit_code
+
+    def _prepare_metrics_dir(self) -> None:
+        self.metrics_dir = metrics.METRICS_MULTIPROC_DIR
+        if self.metrics_dir:
+            # 清掉上次运行留下的快照, 否则已退出进程的计数会被重复计入
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            for file_name in os.listdir(self.metrics_dir):
+                if file_name.endswith(".json"):
+                    os.remove(os.path.join(self.metrics_dir, file_name))
+        else:
+            self.metrics_dir = tempfile.mkdtemp(prefix="llm_pack_metrics_")
+            self._owns_metrics_dir = True
+        # 在fork之前设置, worker继承后由/metrics汇总所有worker
+        metrics.METRICS_MULTIPROC_DIR = self.metrics_dir
+
+    def _handle_exit(self, sig, frame) -> None:
+        self.stopping = True
+
+    def _forward_reload(self, sig, frame) -> None:
+        """SIGHUP转发给所有worker, 各自重新加载模型配置"""
+        for pid in self.children:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+        # worker进程: 不返回到父进程的调度循环中
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        exit_code = 1
+        try:
+            sock = bind_reuseport(WEB_HOST, WEB_PORT)
+            DrainingServer(_config(self.app)).run(sockets=[sock])
+            exit_code = 0
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logging.exception("Worker %d crashed", index)
+        # 以SystemExit结束进程, 调用栈上的父进程逻辑没有finally, atexit(用量账本落盘)照常执行
+        sys.exit(exit_code)
+
+    def _supervise(self) -> int:
+        while not self.stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return 1
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code == STARTUP_FAILURE:
+                logging.error("Worker %d failed to start, shutting down", index)
+                self.stopping = True
+                return STARTUP_FAILURE
+            logging.warning("Worker %d (pid %d) exited with %d, restarting",
+                            index, pid, exit_code)
+            time.sleep(WORKER_RESTART_DELAY)
+            if not self.stopping:
+                self._spawn(index)
+        return 0
+
+    def _stop(self) -> None:
+        """把退出信号转给所有worker, 等它们排空; 超过期限仍未退出的强制结束"""
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT + 5
+        while self.children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.1)
+            else:
+                self.children.pop(pid, None)
+        for pid in self.children:
+            logging.warning("Worker pid %d did not exit in time, killing it", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+def serve(app) -> None:
+    """按WEB_WORKERS启动单进程或多worker服务"""
+    workers = worker_count()
+    os.environ[WORKERS_ENV] = str(workers)
+    lifecycle.workers = workers
+    if workers == 1:
+        logging.info("Starting 1 worker on %s:%d (%s)", WEB_HOST, WEB_PORT, _describe_runtime())
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+        DrainingServer(_config(app)).run()
+        return
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        # 不支持fork/SO_REUSEPORT的平台交给uvicorn的多进程模式, 各worker共享同一个socket
+        logging.warning("SO_REUSEPORT is unavailable, falling back to uvicorn workers")
+        uvicorn.run(APP_IMPORT_PATH, host=WEB_HOST, port=WEB_PORT, workers=workers,
+                    loop=WEB_LOOP, http=WEB_HTTP, log_level="info",
+                    timeout_graceful_shutdown=int(SHUTDOWN_DRAIN_TIMEOUT))
+        return
+    sys.exit(Supervisor(app, workers).run())
@@ -0,0 +1,12 @@
+"""pytest配置: 从源码目录导入llm_pack_service
+
+导入包时会挂载static目录并读取model_config.ini, 这里指向仓库根目录下的文件,
+在任意目录运行pytest都能导入。
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+os.environ.setdefault("STATIC_DIR", os.path.join(ROOT, "static"))
+os.environ.setdefault("MODEL_CONFIG_FILE", os.path.join(ROOT, "model_config.ini"))
@@ -0,0 +1,63 @@
+"""测量 `import llm_pack_service` 的冷启动耗时
+
+用法:
+    python test/import_time_bench.py [次数] [上限毫秒]
+
+每次都在新的解释器中导入, 输出中位数耗时和自身耗时最多的模块;
+给出上限时, 中位数超过上限则以非零状态退出, 可用于CI。
+"""
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def measure_once():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(ROOT, "src")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import llm_pack_service"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    modules = []
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        modules.append((int(self_us), name))
+        if name == "llm_pack_service" and len(indent) == 1:
+            total_us = int(cumulative_us)
+    return total_us, modules
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    limit_ms = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    totals = []
+    last_modules = []
+    for _ in range(runs):
+        total_us, last_modules = measure_once()
+        totals.append(total_us / 1000)
+
+    median_ms = statistics.median(totals)
+    print(f"import llm_pack_service: median {median_ms:.1f} ms, "
+          f"min {min(totals):.1f} ms, max {max(totals):.1f} ms ({runs} runs)")
+    print("top modules by self time:")
+    for self_us, name in sorted(last_modules, reverse=True)[:15]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    if limit_ms is not None and median_ms > limit_ms:
+        print(f"FAIL: median import time {median_ms:.1f} ms exceeds {limit_ms:.1f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
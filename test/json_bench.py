@@ -0,0 +1,68 @@
+"""比较响应信封的序列化耗时: 标准库json.dumps与apis.responses.dumps
+
+用法:
+    python test/json_bench.py [次数]
+
+载荷模拟非流式对话结果(长中文回复)、b64_json图片(约1.5MB)、图片URL列表和
+错误响应; 安装orjson后responses.dumps会自动使用它, 可分别在装与不装时运行对比。
+"""
+import os
+import sys
+import json
+import base64
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from llm_pack_service.apis import responses  # noqa: E402
+
+
+def envelope(data, code=1, msg="success", status=200):
+    return {"code": code, "msg": msg, "data": data, "status": status}
+
+
+def payloads():
+    reply = "大语言模型服务把多个上游接口统一成一个API, 支持流式输出和深度思考。" * 400
+    chat = envelope({
+        "role": "assistant",
+        "content": reply,
+        "reasoning_content": reply[:4000],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": 16000, "total_tokens": 17200}
+    })
+    image = envelope({
+        "b64_json": base64.b64encode(os.urandom(1100 * 1024)).decode("ascii"),
+        "usage": {"generated_images": 1}
+    })
+    urls = envelope({
+        "image_urls": [f"https://example.com/img/{i:04d}.png?sig={'a' * 200}" for i in range(16)],
+        "mirror_urls": [f"http://localhost:8808/static/{i:04d}.png" for i in range(16)]
+    })
+    error = envelope({}, code=0, msg="模型 foo 不在 DouBao 支持的模型列表中", status=500)
+    return {"chat_16k_tokens": chat, "image_b64": image, "image_urls": urls, "error": error}
+
+
+def stdlib_dumps(value):
+    # 改造前各接口的写法: json.dumps后由Response再编码一次
+    return json.dumps(value).encode("utf-8")
+
+
+def best_of(function, value, number, repeat=5):
+    return min(timeit.repeat(lambda: function(value), number=number, repeat=repeat)) / number
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    backend = "orjson" if responses.orjson is not None else "stdlib compact"
+    print(f"responses.dumps backend: {backend}")
+    print(f"{'payload':>16} {'bytes':>10} {'json.dumps_us':>14} {'responses_us':>13} {'speedup':>8}")
+    for name, value in payloads().items():
+        baseline = best_of(stdlib_dumps, value, number)
+        fast = best_of(responses.dumps, value, number)
+        size = len(responses.dumps(value))
+        print(f"{name:>16} {size:>10} {baseline * 1e6:>14.1f} {fast * 1e6:>13.1f} "
+              f"{baseline / fast:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""准入控制的并发池: 放行, 排队顺序, 队列满, 等待超时和取消"""
+import asyncio
+import pytest
+from llm_pack_service.apis.admission import AdmissionPool, AdmissionRejected
+
+
+async def settle():
+    """让已就绪的任务都运行到下一个等待点"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_admits_up_to_limit_then_hands_slots_over():
+    async def scenario():
+        pool = AdmissionPool("test", 2, 4, 5)
+        await pool.acquire()
+        await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await settle()
+        assert not waiter.done() and pool.waiting == 1
+        pool.release()
+        await settle()
+        assert waiter.done() and pool.active == 2 and pool.waiting == 0
+        pool.release()
+        pool.release()
+        assert pool.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_short_requests_first_then_arrival_order():
+    async def scenario():
+        pool = AdmissionPool("test", 1, 4, 5)
+        await pool.acquire()
+        order = []
+
+        async def request(name, priority):
+            await pool.acquire(priority)
+            order.append(name)
+
+        tasks = []
+        for name, priority in (("long-1", 1), ("short-1", 0), ("long-2", 1), ("short-2", 0)):
+            tasks.append(asyncio.create_task(request(name, priority)))
+            await settle()
+        for _ in tasks:
+            pool.release()
+            await settle()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["short-1", "short-2", "long-1", "long-2"]
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        pool = AdmissionPool("test", 1, 1, 5)
+        await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await settle()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await pool.acquire()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return rejected.value.status_code
+
+    assert asyncio.run(scenario()) == 429
+
+
+def test_wait_timeout_is_rejected_with_503_without_leaking_slots():
+    async def scenario():
+        pool = AdmissionPool("test", 1, 4, 0.01)
+        await pool.acquire()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await pool.acquire()
+        assert rejected.value.status_code == 503 and pool.waiting == 0
+        pool.release()
+        assert pool.active == 0
+        # 超时的等待者不再占用队列, 之后的请求直接放行
+        await pool.acquire()
+        assert pool.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_passes_its_slot_on():
+    async def scenario():
+        pool = AdmissionPool("test", 1, 4, 5)
+        await pool.acquire()
+        cancelled = asyncio.create_task(pool.acquire())
+        waiter = asyncio.create_task(pool.acquire())
+        await settle()
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        pool.release()
+        await settle()
+        assert waiter.done() and pool.active == 1
+        pool.release()
+        assert pool.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiter_cancelled_after_being_admitted_keeps_no_slot():
+    async def scenario():
+        pool = AdmissionPool("test", 1, 4, 5)
+        await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await settle()
+        # 名额已交给等待者, 但它在恢复运行前被取消: 要么拿着名额正常返回, 要么把名额还回去
+        pool.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        if not waiter.cancelled():
+            pool.release()
+        assert pool.active == 0 and pool.waiting == 0
+
+    asyncio.run(scenario())
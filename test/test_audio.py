@@ -0,0 +1,53 @@
+"""语音识别接口: 上游不可用时返回错误信封并删除临时文件"""
+import glob
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import resilience, utils
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_retry_budgets", {})
+    monkeypatch.setattr(resilience, "RETRY_BASE_DELAY", 0)
+
+
+def use_upstream(monkeypatch, handler):
+    monkeypatch.setattr(utils, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+def post_audio():
+    before = set(glob.glob("/tmp/*.mp3"))
+    response = TestClient(app).post(
+        "/api/v1/auc", files={"audio": ("speech.mp3", b"ID3" + b"\0" * 64, "audio/mpeg")})
+    return response, set(glob.glob("/tmp/*.mp3")) - before
+
+
+def test_unreachable_upstream_returns_an_envelope(monkeypatch):
+    def refuse(request):
+        raise httpx.ConnectError("refused", request=request)
+
+    use_upstream(monkeypatch, refuse)
+    response, left_over = post_audio()
+    assert response.headers["content-type"].startswith("application/json")
+    assert response.json()["status"] == 500 and "refused" in response.json()["msg"]
+    assert not left_over
+
+
+def test_open_circuit_returns_an_envelope(monkeypatch):
+    calls = []
+
+    def record(request):
+        calls.append(request)
+        return httpx.Response(200)
+
+    use_upstream(monkeypatch, record)
+    breaker = resilience.get_breaker("doubao_auc")
+    for _ in range(resilience.CIRCUIT_FAILURE_THRESHOLD):
+        breaker.on_failure()
+    response, left_over = post_audio()
+    assert response.json()["status"] == 500 and "open" in response.json()["msg"]
+    assert not calls and not left_over
@@ -0,0 +1,79 @@
+"""两级结果缓存: 内存LRU和过期, 磁盘层读写, 清理过期和超出大小的文件"""
+import os
+import time
+import asyncio
+from llm_pack_service.apis.cache import DISK_TMP_MAX_AGE, ResultCache, make_cache_key
+from llm_pack_service.apis.text2image import _image_cache_key
+
+
+def test_cache_key_is_stable_and_depends_on_every_part():
+    assert make_cache_key("model", "猫", 1) == make_cache_key("model", "猫", 1)
+    assert make_cache_key("model", "猫", 1) != make_cache_key("model", "猫", 2)
+
+
+def test_random_seed_is_not_cached():
+    data = {"model": "m", "prompt": "p", "size": "1024x1024", "guidance_scale": 2.5,
+            "seed": -1, "watermark": True, "response_format": "url"}
+    assert _image_cache_key(data) is None
+    assert _image_cache_key({**data, "seed": 7}) == _image_cache_key({**data, "seed": 7})
+
+
+def test_memory_tier_evicts_least_recently_used_and_expired_entries():
+    async def scenario():
+        cache = ResultCache(ttl=60, max_entries=2)
+        await cache.set("a", {"url": "a"})
+        await cache.set("b", {"url": "b"})
+        assert await cache.get("a") == {"url": "a"}
+        await cache.set("c", {"url": "c"})
+        assert await cache.get("b") is None
+        cache._memory["a"] = (time.time() - 1, {"url": "a"})
+        return await cache.get("a"), await cache.get("c")
+
+    assert asyncio.run(scenario()) == (None, {"url": "c"})
+
+
+def test_disk_tier_round_trips_and_expires(tmp_path):
+    async def scenario():
+        cache = ResultCache(ttl=60, disk_dir=str(tmp_path), disk_ttl=60)
+        await cache.set("key", {"b64_json": "abcd"}, disk=True)
+        assert "key" not in cache._memory
+        assert await cache.get("key") == {"b64_json": "abcd"}
+        path = await cache.disk_file("key")
+        os.utime(path, (time.time() - 61, time.time() - 61))
+        return await cache.disk_file("key"), os.path.exists(path)
+
+    assert asyncio.run(scenario()) == (None, False)
+
+
+def test_disk_tier_is_skipped_without_a_directory():
+    async def scenario():
+        cache = ResultCache(ttl=60)
+        await cache.set("key", {"b64_json": "abcd"}, disk=True)
+        return await cache.get("key"), cache.disk_writer("key")
+
+    assert asyncio.run(scenario()) == (None, None)
+
+
+def test_aborted_writer_leaves_no_file(tmp_path):
+    async def scenario():
+        cache = ResultCache(ttl=60, disk_dir=str(tmp_path))
+        writer = cache.disk_writer("key")
+        await writer.write(b'{"b64_json": "ab')
+        await writer.abort()
+        return await cache.disk_file("key")
+
+    assert asyncio.run(scenario()) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_sweep_removes_stale_files_then_the_oldest_beyond_the_size_limit(tmp_path):
+    cache = ResultCache(ttl=60, disk_dir=str(tmp_path), disk_ttl=600, disk_max_bytes=250)
+    now = time.time()
+    ages = {"expired.json": 700, "oldest.json": 300, "older.json": 200, "newest.json": 100,
+            "left.tmp": DISK_TMP_MAX_AGE + 1, "writing.tmp": 1}
+    for name, age in ages.items():
+        path = tmp_path / name
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (now - age, now - age))
+    assert cache.sweep_disk() == 3
+    assert sorted(os.listdir(tmp_path)) == ["newest.json", "older.json", "writing.tmp"]
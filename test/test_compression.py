@@ -0,0 +1,89 @@
+"""响应压缩: 流式响应每个事件刷新压缩器, 小响应和不可压缩的类型原样发送"""
+import zlib
+import asyncio
+from llm_pack_service.apis.compression import CompressionMiddleware, negotiate
+
+EVENTS = [f"data: {{\"content\": \"第{index}段回答\"}}\n\n".encode("utf-8") for index in range(5)]
+
+
+def run(app, accept_encoding: str = "gzip"):
+    """经过压缩中间件调用app, 返回发出的ASGI消息"""
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/api/v1/chat",
+             "headers": [(b"accept-encoding", accept_encoding.encode("latin-1"))]}
+    asyncio.run(CompressionMiddleware(app)(scope, receive, send))
+    return sent
+
+
+def sse_app(events):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8")]})
+        for event in events:
+            await send({"type": "http.response.body", "body": event, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    return app
+
+
+def body_app(body: bytes, content_type: bytes):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", content_type),
+                                (b"content-length", str(len(body)).encode("latin-1"))]})
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def test_each_sse_event_can_be_decoded_when_it_arrives():
+    start, *bodies = run(sse_app(EVENTS))
+    headers = dict(start["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    assert headers[b"vary"] == b"Accept-Encoding"
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # 每个压缩块单独解压就能得到对应的完整事件, 客户端不用等后面的数据
+    for event, message in zip(EVENTS, bodies):
+        assert message["more_body"]
+        assert decoder.decompress(message["body"]) == event
+    assert not bodies[-1]["more_body"]
+    decoder.decompress(bodies[-1]["body"])
+    assert decoder.eof
+
+
+def test_large_json_is_compressed_in_one_piece():
+    body = b'{"content": "' + "重复的回答内容".encode("utf-8") * 200 + b'"}'
+    start, message = run(body_app(body, b"application/json"))
+    headers = dict(start["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert int(headers[b"content-length"]) == len(message["body"]) < len(body)
+    assert zlib.decompress(message["body"], 16 + zlib.MAX_WBITS) == body
+
+
+def test_small_or_incompressible_responses_are_sent_as_is():
+    for body, content_type in ((b'{"code": 1}', b"application/json"),
+                               (b"\x89PNG" * 1000, b"image/png")):
+        start, message = run(body_app(body, content_type))
+        assert b"content-encoding" not in dict(start["headers"])
+        assert message["body"] == body
+
+
+def test_without_accepted_encoding_nothing_is_compressed():
+    start, *bodies = run(sse_app(EVENTS), accept_encoding="identity")
+    assert b"content-encoding" not in dict(start["headers"])
+    assert b"".join(message["body"] for message in bodies) == b"".join(EVENTS)
+
+
+def test_negotiate_prefers_quality_then_server_order():
+    assert negotiate("gzip;q=0.5, br", ["br", "gzip"]) == "br"
+    assert negotiate("gzip, br;q=0.1", ["br", "gzip"]) == "gzip"
+    assert negotiate("br, gzip", ["br", "gzip"]) == "br"
+    assert negotiate("*;q=0, gzip;q=0", ["gzip"]) is None
@@ -0,0 +1,189 @@
+"""上游前缀缓存: 命中, 未命中, 过期重建, 并发合并, 上游拒绝后重发"""
+import json
+import time
+import asyncio
+import httpx
+import pytest
+from llm_pack_service.apis import chat, context_cache, metrics, utils
+from llm_pack_service.apis.context_cache import ContextCache
+from llm_pack_service.apis.providers import Endpoint
+from llm_pack_service.apis.sessions import message_tokens
+
+SYSTEM = {"role": "system", "content": "你是一个文档问答助手。" * 20}
+CHAT_URL = "http://upstream/api/v3/chat/completions"
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(context_cache, "CONTEXT_CACHE_ENABLED", True)
+    monkeypatch.setattr(context_cache, "CONTEXT_CACHE_MIN_TOKENS", 100)
+
+
+def request_data(question: str = "第一章讲了什么?"):
+    return {"model": "doubao-test", "messages": [SYSTEM, {"role": "user", "content": question}],
+            "stream": False}
+
+
+def use_upstream(monkeypatch, handler):
+    """把共享的HTTP客户端换成由handler应答的模拟上游, 返回收到的请求列表"""
+    requests = []
+
+    async def record(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return await handler(request)
+
+    monkeypatch.setattr(utils, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(record)))
+    return requests
+
+
+def test_local_backend_miss_then_hit():
+    async def scenario():
+        cache = ContextCache("local", 10)
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        first = await cache.prepare(endpoint, request_data(), "doubao-test")
+        second = await cache.prepare(endpoint, request_data("第二章呢?"), "doubao-test")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.created and first.context is not None
+    assert not second.created and second.context is first.context
+    # local方式在本地展开前缀, 上游收到的消息与原请求相同
+    assert second.url == CHAT_URL
+    assert second.body["messages"] == [SYSTEM, {"role": "user", "content": "第二章呢?"}]
+
+
+def test_short_prefix_and_prefix_only_requests_are_sent_as_is():
+    async def scenario():
+        cache = ContextCache("local", 10)
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        short = {"model": "m", "messages": [{"role": "system", "content": "简短"},
+                                            {"role": "user", "content": "你好"}]}
+        prefix_only = {"model": "m", "messages": [SYSTEM]}
+        return (await cache.prepare(endpoint, short, "m"),
+                await cache.prepare(endpoint, prefix_only, "m"))
+
+    for upstream in asyncio.run(scenario()):
+        assert upstream.context is None and upstream.url == CHAT_URL
+
+
+def test_expired_context_is_recreated():
+    async def scenario():
+        cache = ContextCache("local", 10)
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        first = await cache.prepare(endpoint, request_data(), "doubao-test")
+        key = first.context.key
+        cache._contexts[key] = first.context._replace(expires_at=0)
+        return first, await cache.prepare(endpoint, request_data(), "doubao-test")
+
+    first, refreshed = asyncio.run(scenario())
+    assert refreshed.created and refreshed.context is not first.context
+    assert refreshed.context.expires_at > time.time()
+
+
+def test_concurrent_requests_share_one_create(monkeypatch):
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            await release.wait()
+            return httpx.Response(200, json={"id": "ctx-1"})
+
+        requests = use_upstream(monkeypatch, handler)
+        cache = ContextCache("ark", 10)
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        tasks = [asyncio.create_task(cache.prepare(endpoint, request_data(), "doubao-test"))
+                 for _ in range(3)]
+        await asyncio.sleep(0.01)
+        release.set()
+        return requests, await asyncio.gather(*tasks)
+
+    requests, results = asyncio.run(scenario())
+    assert [request.url.path for request in requests] == ["/api/v3/context/create"]
+    assert [result.created for result in results] == [True, False, False]
+    for result in results:
+        assert result.url == "http://upstream/api/v3/context/chat/completions"
+        assert result.body["context_id"] == "ctx-1"
+        assert result.body["messages"] == [{"role": "user", "content": "第一章讲了什么?"}]
+
+
+def test_failed_create_backs_off(monkeypatch):
+    async def scenario():
+        async def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(400, json={"error": "unsupported"})
+
+        requests = use_upstream(monkeypatch, handler)
+        cache = ContextCache("ark", 10)
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        first = await cache.prepare(endpoint, request_data(), "doubao-test")
+        second = await cache.prepare(endpoint, request_data(), "doubao-test")
+        return requests, first, second
+
+    requests, first, second = asyncio.run(scenario())
+    assert len(requests) == 1
+    assert first.context is None and second.context is None
+    assert second.url == CHAT_URL
+
+
+def test_invalidate_restores_plain_request_and_forgets_context(monkeypatch):
+    async def scenario():
+        async def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json={"id": f"ctx-{len(requests)}"})
+
+        requests = use_upstream(monkeypatch, handler)
+        cache = ContextCache("ark", 10)
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        upstream = await cache.prepare(endpoint, request_data(), "doubao-test")
+        plain = cache.invalidate(upstream, "doubao-test")
+        again = await cache.prepare(endpoint, request_data(), "doubao-test")
+        return upstream, plain, again
+
+    upstream, plain, again = asyncio.run(scenario())
+    assert plain.url == CHAT_URL and plain.context is None
+    assert "context_id" not in plain.body
+    assert plain.body["messages"] == request_data()["messages"]
+    assert again.created and again.context.context_id != upstream.context.context_id
+
+
+def test_rejected_context_is_resent_in_full(monkeypatch):
+    async def scenario():
+        async def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path.endswith("/context/create"):
+                return httpx.Response(200, json={"id": "ctx-1"})
+            if request.url.path.endswith("/context/chat/completions"):
+                return httpx.Response(404, json={"error": "context not found"})
+            return httpx.Response(200, json={"choices": [{"message": {"content": "答案"}}]})
+
+        requests = use_upstream(monkeypatch, handler)
+        monkeypatch.setattr(chat, "context_cache", ContextCache("ark", 10))
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        response = await chat._post_chat(endpoint, request_data(), "doubao-test")
+        return requests, response
+
+    requests, response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert [request.url.path for request in requests] == [
+        "/api/v3/context/create", "/api/v3/context/chat/completions", "/api/v3/chat/completions"]
+    resent = json.loads(requests[-1].content)
+    assert resent["messages"] == request_data()["messages"]
+    assert "context_id" not in resent
+
+
+def test_only_ark_hits_count_saved_tokens(monkeypatch):
+    async def scenario(cache, model_name):
+        async def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json={"id": "ctx-1"})
+
+        use_upstream(monkeypatch, handler)
+        endpoint = Endpoint("TEST", CHAT_URL, "token")
+        for _ in range(2):
+            cache.record_success(await cache.prepare(endpoint, request_data(), model_name),
+                                 model_name)
+
+    saved = metrics.context_cache_saved_tokens_total
+    asyncio.run(scenario(ContextCache("local", 10), "local-model"))
+    assert metrics.context_cache_requests_total.get("local-model", "local_hit") == 1
+    assert saved.get("local-model") == 0
+    asyncio.run(scenario(ContextCache("ark", 10), "ark-model"))
+    assert metrics.context_cache_requests_total.get("ark-model", "hit") == 1
+    assert saved.get("ark-model") == message_tokens(SYSTEM)
@@ -0,0 +1,66 @@
+"""非流式对话的对冲和故障切换: 切换顺序, 不可切换的错误, 对冲过的端点不再重试"""
+import asyncio
+from collections import Counter
+import httpx
+import pytest
+from llm_pack_service.apis import chat, resilience, utils
+from llm_pack_service.apis.providers import Endpoint
+
+ANSWER = {"choices": [{"message": {"role": "assistant", "content": "answer"}}]}
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstreams(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_retry_budgets", {})
+    monkeypatch.setattr(chat, "CHAT_HEDGE_DEFAULT_DELAY", 0.01)
+
+
+def endpoints(*names):
+    return [Endpoint(name, f"http://{name.lower()}/api/v3/chat/completions", "token")
+            for name in names]
+
+
+def mock_upstreams(monkeypatch, replies):
+    """replies: 主机名 -> (延迟秒数, 状态码), 返回每个主机收到的请求数"""
+    calls = Counter()
+
+    async def handler(request):
+        calls[request.url.host] += 1
+        delay, status = replies[request.url.host]
+        await asyncio.sleep(delay)
+        return httpx.Response(status, json=ANSWER if status == 200 else {"error": "upstream"})
+
+    monkeypatch.setattr(utils, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return calls
+
+
+def generate(upstreams, hedge=False):
+    return asyncio.run(chat.nonstream_generator(upstreams, {"messages": []}, "test", hedge))
+
+
+def test_server_errors_fail_over_to_the_next_endpoint(monkeypatch):
+    calls = mock_upstreams(monkeypatch, {"a": (0, 500), "b": (0, 200)})
+    assert generate(endpoints("A", "B"))["content"] == "answer"
+    assert calls == {"a": 1, "b": 1}
+
+
+def test_client_errors_do_not_fail_over(monkeypatch):
+    calls = mock_upstreams(monkeypatch, {"a": (0, 400), "b": (0, 200)})
+    with pytest.raises(httpx.HTTPStatusError):
+        generate(endpoints("A", "B"))
+    assert calls == {"a": 1}
+
+
+def test_hedged_endpoint_is_not_tried_again_during_failover(monkeypatch):
+    # 主请求超过对冲等待时间后失败, 对冲请求也失败, 应直接切换到第三个端点
+    calls = mock_upstreams(monkeypatch, {"a": (0.05, 500), "b": (0, 500), "c": (0, 200)})
+    assert generate(endpoints("A", "B", "C"), hedge=True)["content"] == "answer"
+    assert calls == {"a": 1, "b": 1, "c": 1}
+
+
+def test_alternate_is_kept_for_failover_when_no_hedge_was_sent(monkeypatch):
+    calls = mock_upstreams(monkeypatch, {"a": (0, 500), "b": (0, 200)})
+    assert generate(endpoints("A", "B"), hedge=True)["content"] == "answer"
+    assert calls == {"a": 1, "b": 1}
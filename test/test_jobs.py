@@ -0,0 +1,178 @@
+"""图像任务: 按类型排队执行, 状态推送, 多worker共享状态, 回调地址检查和回调连接检查过的地址"""
+import json
+import asyncio
+import socket
+import httpx
+import pytest
+from llm_pack_service.apis import jobs, utils
+from llm_pack_service.apis.error import get_error_response
+from llm_pack_service.apis.jobs import Job, JobManager, check_callback_url, job_manager
+from llm_pack_service.apis.lifecycle import lifecycle
+from llm_pack_service.apis.records import RecordStore
+from llm_pack_service.apis.responses import envelope_response
+
+
+async def settle():
+    """让已就绪的任务都运行到下一个等待点"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def runner(result=None, gate: asyncio.Event = None):
+    async def run():
+        if gate is not None:
+            await gate.wait()
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return run
+
+
+def test_job_results_and_errors_are_recorded():
+    async def scenario():
+        manager = JobManager(4, 10)
+        succeeded = Job("txt2img", runner(envelope_response({"image_url": "http://images/1.png"})))
+        failed = Job("txt2img", runner(get_error_response("upstream failed")))
+        crashed = Job("img2img", runner(RuntimeError("boom")))
+        for job in (succeeded, failed, crashed):
+            assert manager.submit(job)
+        await settle()
+        return succeeded, failed, crashed
+
+    succeeded, failed, crashed = asyncio.run(scenario())
+    assert succeeded.status == "succeeded" and succeeded.result["data"] == {
+        "image_url": "http://images/1.png"}
+    assert (failed.status, failed.error) == ("failed", "upstream failed")
+    assert (crashed.status, crashed.error) == ("failed", "boom")
+
+
+def test_full_queue_rejects_new_jobs():
+    async def scenario():
+        manager = JobManager(1, 2)
+        gate = asyncio.Event()
+        accepted = [manager.submit(Job("txt2img", runner(envelope_response({}), gate)))
+                    for _ in range(3)]
+        gate.set()
+        await settle()
+        return accepted
+
+    assert asyncio.run(scenario()) == [True, True, False]
+
+
+def test_backlog_of_one_kind_does_not_block_other_kinds(monkeypatch):
+    monkeypatch.setenv("JOB_CONCURRENCY_TXT2IMG", "1")
+
+    async def scenario():
+        manager = JobManager(4, 10)
+        gate = asyncio.Event()
+        slow = [Job("txt2img", runner(envelope_response({}), gate)) for _ in range(2)]
+        other = Job("out_painting", runner(envelope_response({})))
+        for job in slow + [other]:
+            manager.submit(job)
+        await settle()
+        statuses = [job.status for job in slow] + [other.status]
+        gate.set()
+        await settle()
+        return statuses, [job.status for job in slow]
+
+    statuses, finished = asyncio.run(scenario())
+    assert statuses == ["running", "queued", "succeeded"]
+    assert finished == ["succeeded", "succeeded"]
+
+
+def test_events_follow_the_job_until_it_finishes():
+    async def scenario():
+        manager = JobManager(4, 10)
+        gate = asyncio.Event()
+        job = Job("txt2img", runner(envelope_response({}), gate))
+        events = jobs.job_event_generator(job)
+        first = await events.__anext__()
+        manager.submit(job)
+        await settle()
+        second = await events.__anext__()
+        gate.set()
+        rest = [event async for event in events]
+        return [first, second] + rest
+
+    events = asyncio.run(scenario())
+    assert [json.loads(event[len("data: "):])["status"] for event in events] == [
+        "queued", "running", "succeeded"]
+
+
+def test_job_state_is_shared_between_workers(monkeypatch, tmp_path):
+    monkeypatch.setattr(lifecycle, "workers", 2)
+    monkeypatch.setattr(jobs, "job_records", RecordStore(str(tmp_path), 60))
+
+    async def scenario():
+        manager = JobManager(4, 10)
+        job = Job("txt2img", runner(envelope_response({"image_url": "http://images/1.png"})))
+        manager.submit(job)
+        await settle()
+        for _ in range(20):
+            record = await jobs.job_records.get(job.id)
+            if record and record["status"] == "succeeded":
+                break
+            await asyncio.sleep(0.01)
+        # 查询被分到没有运行该任务的worker时从共享目录读取
+        response = await jobs.get_job(job.id)
+        missing = await jobs.get_job("0" * 32)
+        return json.loads(response.body), json.loads(missing.body)
+
+    found, missing = asyncio.run(scenario())
+    assert found["data"]["status"] == "succeeded"
+    assert found["data"]["result"]["data"] == {"image_url": "http://images/1.png"}
+    assert missing["status"] == 404
+
+
+def resolve_to(monkeypatch, *addresses):
+    """让域名依次解析到给定的地址, 模拟DNS记录在检查之后被改掉"""
+    answers = list(addresses)
+
+    async def getaddrinfo(self, host, port, *args, **kwargs):
+        address = answers.pop(0) if len(answers) > 1 else answers[0]
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        return [(family, socket.SOCK_STREAM, 6, "", (address, port))]
+
+    monkeypatch.setattr(asyncio.BaseEventLoop, "getaddrinfo", getaddrinfo)
+
+
+def check(url):
+    return asyncio.run(check_callback_url(url))
+
+
+@pytest.mark.parametrize("url", ["ftp://hooks.example.com/done", "http:///done"])
+def test_only_http_urls_with_a_host_are_accepted(url):
+    with pytest.raises(ValueError):
+        check(url)
+
+
+@pytest.mark.parametrize("address", ["127.0.0.1", "10.1.2.3", "169.254.169.254", "::1"])
+def test_hosts_resolving_to_private_addresses_are_rejected(monkeypatch, address):
+    resolve_to(monkeypatch, address)
+    with pytest.raises(ValueError):
+        check("https://hooks.example.com/done")
+
+
+def test_allowed_hosts_are_not_resolved(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_CALLBACK_ALLOWED_HOSTS", {"internal"})
+    resolve_to(monkeypatch, "10.1.2.3")
+    assert check("http://internal:8080/done") is None
+
+
+def test_callback_connects_to_the_checked_address(monkeypatch):
+    # 检查时解析到公网地址, 之后再解析会得到本机地址, 回调必须连接检查过的地址
+    resolve_to(monkeypatch, "93.184.216.34", "127.0.0.1")
+    received = []
+
+    def handler(request):
+        received.append(request)
+        return httpx.Response(200)
+
+    monkeypatch.setattr(utils, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    job = Job("txt2img", None, "https://hooks.example.com:8443/done?token=1")
+    asyncio.run(job_manager._callback(job))
+    request, = received
+    assert str(request.url) == "https://93.184.216.34:8443/done?token=1"
+    assert request.headers["Host"] == "hooks.example.com:8443"
+    assert request.extensions["sni_hostname"] == "hooks.example.com"
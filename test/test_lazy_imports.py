@@ -0,0 +1,32 @@
+"""按需加载: 未启用的路由不被导入, 启用的路由也不在导入时加载SDK和图像库"""
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_modules(enabled_routers: str):
+    """在新的解释器中导入服务, 返回已加载的模块名"""
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, "src"), ENABLED_ROUTERS=enabled_routers)
+    for name in ("DOUBAO_API_URL", "DOUBAO_API_KEY"):
+        env.pop(name, None)
+    code = ("import sys, json\nimport llm_pack_service.pack_service\n"
+            "print(json.dumps(sorted(sys.modules)))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return set(json.loads(result.stdout.splitlines()[-1]))
+
+
+@pytest.mark.parametrize("enabled,absent", [
+    ("chat", ["llm_pack_service.apis.audio", "llm_pack_service.apis.text2image",
+              "llm_pack_service.apis.jobs", "llm_pack_service.apis.mirror"]),
+    ("chat,audio,text2image,out_painting,image2image,mirror,jobs", []),
+])
+def test_provider_sdks_are_not_imported_at_startup(enabled, absent):
+    modules = loaded_modules(enabled)
+    assert "llm_pack_service.apis.chat" in modules
+    for name in absent + ["volcengine", "PIL", "requests"]:
+        assert name not in modules
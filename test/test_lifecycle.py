@@ -0,0 +1,86 @@
+"""排空: /health返回进度, 不再接受新的POST, AUC轮询在期限前交接并在重启后继续"""
+import os
+import time
+import asyncio
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import audio, lifecycle as lifecycle_module, resilience, utils
+from llm_pack_service.apis.lifecycle import Lifecycle, lifecycle
+from llm_pack_service.apis.records import RecordStore
+
+
+@pytest.fixture
+def draining(monkeypatch):
+    """进入排空且期限已到"""
+    monkeypatch.setattr(lifecycle, "drain_started", time.monotonic() - 100)
+
+
+def test_health_reports_drain_progress(monkeypatch):
+    monkeypatch.setattr(lifecycle_module, "SHUTDOWN_DRAIN_TIMEOUT", 30)
+    monkeypatch.setattr(lifecycle_module, "SHUTDOWN_HANDOFF_MARGIN", 5)
+    state = Lifecycle()
+    assert state.health() == {"status": "ok"} and not state.handoff_due()
+    state.enter("chat_stream")
+    state.enter("auc")
+    state.leave("auc")
+    state.begin_drain()
+    health = state.health()
+    assert health["status"] == "draining"
+    assert health["drain"]["in_flight"] == {"chat_stream": 1}
+    assert 29 <= health["drain"]["remaining_seconds"] <= 30 and not state.handoff_due()
+    state.drain_started -= 26
+    assert state.handoff_due()
+
+
+def test_draining_rejects_new_posts_but_answers_gets(draining):
+    client = TestClient(app)
+    health = client.get("/health")
+    assert health.status_code == 503 and health.json()["status"] == "draining"
+    response = client.post("/api/v1/chat", json={"messages": []})
+    assert response.status_code == 503
+    assert response.headers["connection"] == "close" and "retry-after" in response.headers
+    assert client.get("/").status_code == 200
+
+
+def test_auc_poll_is_handed_off_and_resumed_after_restart(monkeypatch, tmp_path):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_retry_budgets", {})
+    monkeypatch.setattr(audio, "AUC_PENDING_FILE", str(tmp_path / "pending_auc.json"))
+    monkeypatch.setattr(audio, "auc_results", RecordStore(str(tmp_path / "results"), 60))
+    monkeypatch.setattr(audio, "pending_tasks", {})
+    status = {"query": "20000001"}
+
+    def upstream(request):
+        if request.url.path.endswith("/submit"):
+            # 提交之后进程开始排空, 轮询发现期限已到
+            lifecycle.drain_started = time.monotonic() - 100
+            return httpx.Response(200, headers={"X-Api-Status-Code": "20000000",
+                                                "X-Tt-Logid": "log"})
+        return httpx.Response(200, headers={"X-Api-Status-Code": status["query"]},
+                              json={"result": {"text": "你好"}})
+
+    monkeypatch.setattr(utils, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    monkeypatch.setattr(lifecycle, "drain_started", None)
+    response = TestClient(app).post(
+        "/api/v1/auc", files={"audio": ("speech.mp3", b"ID3" + b"\0" * 64, "audio/mpeg")})
+    assert response.status_code == 503
+    task_id = response.json()["data"]["task_id"]
+    audio_path = audio.pending_tasks[task_id]["audio_path"]
+    audio.save_pending_tasks()
+
+    # 重启: 新进程读取交接的任务, 在后台继续轮询直到完成
+    lifecycle.drain_started = None
+    audio.pending_tasks.clear()
+    status["query"] = "20000000"
+
+    async def restart():
+        await audio.on_startup()
+        await asyncio.gather(*audio._resume_tasks)
+
+    asyncio.run(restart())
+    result = TestClient(app).get(f"/api/v1/auc/{task_id}").json()["data"]
+    assert result["status"] == "succeeded" and result["text"] == "你好"
+    assert not audio.pending_tasks and not os.path.exists(audio_path)
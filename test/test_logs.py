@@ -0,0 +1,49 @@
+"""日志: 参数惰性格式化并截断, 载荷日志在DEBUG关闭时不序列化, 队列满时丢弃"""
+import queue
+import logging
+from llm_pack_service.apis import logs
+from llm_pack_service.apis.logs import _DroppingQueueHandler, lazy_json, log_payload, truncate
+
+
+def test_long_values_are_truncated_with_their_length():
+    assert str(truncate("x" * 30, limit=10)) == "x" * 10 + "...(+20 chars)"
+    assert str(truncate("short", limit=10)) == "short"
+    assert str(lazy_json({"text": "中文"})) == '{"text": "中文"}'
+
+
+def test_arguments_are_only_formatted_when_the_record_is_emitted():
+    calls = []
+
+    def payload():
+        calls.append(1)
+        return {"messages": []}
+
+    logger = logging.getLogger("test_logs.lazy")
+    logger.setLevel(logging.INFO)
+    logger.debug("payload: %s", lazy_json(payload))
+    assert calls == []
+    assert logger.makeRecord("test", logging.INFO, __file__, 1, "payload: %s",
+                             (lazy_json(payload),), None).getMessage() == 'payload: {"messages": []}'
+    assert calls == [1]
+
+
+def test_payload_logs_are_skipped_without_debug_and_sampled_with_it(monkeypatch, caplog):
+    logger = logging.getLogger("test_logs.payload")
+    with caplog.at_level(logging.DEBUG, logger="test_logs.payload"):
+        logger.setLevel(logging.INFO)
+        log_payload("payload: %s", {"skipped": True}, logger)
+        logger.setLevel(logging.DEBUG)
+        monkeypatch.setattr(logs, "LOG_PAYLOAD_SAMPLE_RATE", 0)
+        log_payload("payload: %s", {"sampled": False}, logger)
+        monkeypatch.setattr(logs, "LOG_PAYLOAD_SAMPLE_RATE", 1)
+        log_payload("payload: %s", {"logged": True}, logger)
+    assert [record.getMessage() for record in caplog.records] == ['payload: {"logged": true}']
+
+
+def test_full_queue_drops_records_instead_of_blocking():
+    handler = _DroppingQueueHandler(queue.Queue(maxsize=1))
+    dropped = _DroppingQueueHandler.dropped
+    for index in range(3):
+        handler.enqueue(logging.makeLogRecord({"msg": f"record {index}"}))
+    assert handler.queue.qsize() == 1
+    assert _DroppingQueueHandler.dropped == dropped + 2
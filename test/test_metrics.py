@@ -0,0 +1,52 @@
+"""Prometheus指标: 文本格式, 直方图累计分桶, 按路由模板统计请求"""
+from fastapi.testclient import TestClient
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import metrics
+from llm_pack_service.apis.metrics import MetricsRegistry
+
+
+def test_metrics_are_rendered_in_the_text_format():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests", ("route",))
+    gauge = registry.gauge("in_flight", "In flight")
+    counter.inc('/a"b')
+    counter.inc('/a"b', amount=2)
+    gauge.set(value=1.5)
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{route="/a\\"b"} 3',
+        "# HELP in_flight In flight",
+        "# TYPE in_flight gauge",
+        "in_flight 1.5",
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", ("model",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, "m")
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{model="m",le="0.1"} 1',
+        'latency_seconds_bucket{model="m",le="1"} 3',
+        'latency_seconds_bucket{model="m",le="+Inf"} 4',
+        'latency_seconds_sum{model="m"} 4.25',
+        'latency_seconds_count{model="m"} 4',
+    ]
+
+
+def test_requests_are_counted_by_route_template():
+    client = TestClient(app)
+    before = metrics.http_requests_total.get("/api/v1/jobs/{job_id}", "GET", "200")
+    for job_id in ("first", "second"):
+        client.get(f"/api/v1/jobs/{job_id}")
+    assert metrics.http_requests_total.get("/api/v1/jobs/{job_id}", "GET", "200") == before + 2
+    unmatched = metrics.http_requests_total.get("unmatched", "GET", "404")
+    client.get("/no/such/path")
+    assert metrics.http_requests_total.get("unmatched", "GET", "404") == unmatched + 1
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"] == metrics.PROMETHEUS_MEDIA_TYPE
+    assert 'http_requests_total{route="/api/v1/jobs/{job_id}",method="GET",status="200"}' \
+        in response.text
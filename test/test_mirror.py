@@ -0,0 +1,74 @@
+"""图片镜像: 登记后先重定向到原图, 镜像完成后返回本地文件和缩略图"""
+import io
+import asyncio
+import httpx
+import pytest
+from PIL import Image
+from fastapi.testclient import TestClient
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import mirror, utils
+
+URL = "http://images.example.com/generated/cat.png"
+
+
+def png(width: int, height: int) -> bytes:
+    buffered = io.BytesIO()
+    Image.new("RGBA", (width, height), (255, 0, 0, 128)).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def mirror_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(mirror, "MIRROR_ENABLED", True)
+    monkeypatch.setattr(mirror, "MIRROR_DIR", str(tmp_path))
+    monkeypatch.setattr(mirror, "MIRROR_THUMB_SIZES", [64])
+    downloads = []
+
+    def handler(request):
+        downloads.append(str(request.url))
+        return httpx.Response(200, content=png(300, 200), headers={"Content-Type": "image/png"})
+
+    monkeypatch.setattr(utils, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return downloads
+
+
+def test_nothing_is_scheduled_when_mirroring_is_disabled(monkeypatch):
+    monkeypatch.setattr(mirror, "MIRROR_ENABLED", False)
+    assert asyncio.run(mirror.schedule_mirror([URL])) == ([], None)
+
+
+def test_mirrored_image_and_thumbnail_are_served_locally(mirror_dir):
+    client = TestClient(app)
+    urls, background = asyncio.run(mirror.schedule_mirror([URL]))
+    assert urls == [f"/api/v1/mirror/{mirror.url_key(URL)}"]
+    pending = client.get(urls[0], follow_redirects=False)
+    assert pending.status_code == 307 and pending.headers["location"] == URL
+
+    asyncio.run(background())
+    # 已镜像的图片不会重复下载
+    asyncio.run(mirror.mirror_image(URL))
+    assert mirror_dir == [URL]
+
+    original = client.get(urls[0])
+    assert original.content == png(300, 200)
+    assert original.headers["content-type"] == "image/png"
+    assert original.headers["cache-control"] == mirror.IMMUTABLE_CACHE_CONTROL
+    thumbnail = client.get(urls[0], params={"size": 64})
+    assert Image.open(io.BytesIO(thumbnail.content)).size == (64, 43)
+    assert thumbnail.headers["etag"] != original.headers["etag"]
+    assert client.get(urls[0], params={"size": 128}).json()["code"] == 0
+
+
+def test_unknown_or_malformed_keys_are_not_found():
+    client = TestClient(app)
+    assert client.get(f"/api/v1/mirror/{mirror.url_key(URL)}").json()["code"] == 0
+    assert client.get("/api/v1/mirror/" + "a" * 31 + "-").json()["code"] == 0
+
+
+def test_failed_download_leaves_the_redirect_in_place(monkeypatch):
+    monkeypatch.setattr(utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(404))))
+    urls, background = asyncio.run(mirror.schedule_mirror([URL]))
+    asyncio.run(background())
+    assert TestClient(app).get(urls[0], follow_redirects=False).status_code == 307
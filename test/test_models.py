@@ -0,0 +1,71 @@
+"""模型配置热加载: 文件修改后替换快照, 配置有误时保留旧配置, 进行中的请求不受影响"""
+import os
+import pytest
+from llm_pack_service.apis import metrics
+from llm_pack_service.apis.models import ModelRegistry, load_snapshot
+
+CONFIG = """[Doubao-Pro]
+version  = 32k
+thinking = false
+
+[deepseek-r1]
+version   = 250120
+thinking  = true
+endpoints = DEEPSEEK, DOUBAO
+"""
+
+
+def write_config(path, text, mtime=None):
+    path.write_text(text, encoding="utf-8")
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "model_config.ini"
+    write_config(path, CONFIG, mtime=1_000_000)
+    return path
+
+
+def test_models_are_parsed_with_lowercase_names(config):
+    snapshot = load_snapshot(str(config))
+    assert snapshot.names == ("doubao-pro", "deepseek-r1")
+    spec = snapshot.get("Doubao-Pro")
+    assert spec.upstream_model == "doubao-pro-32k" and not spec.thinking
+    # 没有配置endpoints时使用默认的DOUBAO端点
+    assert spec.endpoints == ("DOUBAO",)
+    assert snapshot.get("deepseek-r1").endpoints == ("DEEPSEEK", "DOUBAO")
+    with pytest.raises(TypeError):
+        snapshot.models["other"] = spec
+
+
+def test_changed_file_replaces_the_snapshot_but_held_specs_stay(config):
+    registry = ModelRegistry(str(config))
+    held = registry.snapshot.get("doubao-pro")
+    etag = registry.snapshot.model_list.etag
+    registry.check()
+    assert registry.snapshot.model_list.etag == etag
+    write_config(config, CONFIG.replace("32k", "128k"), mtime=1_000_100)
+    registry.check()
+    assert registry.snapshot.get("doubao-pro").upstream_model == "doubao-pro-128k"
+    assert registry.snapshot.model_list.etag != etag
+    assert held.upstream_model == "doubao-pro-32k"
+
+
+def test_invalid_config_keeps_the_previous_models_and_is_not_retried(config):
+    registry = ModelRegistry(str(config))
+    previous = registry.snapshot
+    failed = metrics.model_config_reloads_total.get("failed")
+    write_config(config, "[broken]\nversion = 1\n", mtime=1_000_100)
+    registry.check()
+    registry.check()
+    assert registry.snapshot is previous
+    assert metrics.model_config_reloads_total.get("failed") == failed + 1
+    write_config(config, CONFIG.replace("32k", "256k"), mtime=1_000_200)
+    registry.check()
+    assert registry.snapshot.get("doubao-pro").version == "256k"
+
+
+def test_missing_file_means_no_models(tmp_path):
+    assert load_snapshot(str(tmp_path / "missing.ini")).names == ()
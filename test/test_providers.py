@@ -0,0 +1,50 @@
+"""端点配置和排序: 模型使用的端点, 按延迟和错误率选择首选端点"""
+from llm_pack_service.apis.models import model_registry
+from llm_pack_service.apis.providers import Endpoint, ProviderRegistry, parse_endpoint_names
+
+
+def test_deepseek_model_uses_the_deepseek_endpoint(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "sk-test")
+    monkeypatch.setenv("DOUBAO_API_URL", "https://ark.example.com/api/v3/chat/completions")
+    monkeypatch.setenv("DOUBAO_API_KEY", "ark-test")
+    spec = model_registry.snapshot.get("deepseek-r1")
+    assert spec.endpoints == ("DEEPSEEK",)
+    endpoints = ProviderRegistry().select(list(spec.endpoints))
+    assert [endpoint.url for endpoint in endpoints] == [
+        "https://api.deepseek.com/v1/chat/completions"]
+
+
+def test_unconfigured_endpoints_are_skipped(monkeypatch):
+    monkeypatch.delenv("MISSING_API_URL", raising=False)
+    monkeypatch.setenv("BACKUP_API_URL", "http://backup/chat/completions")
+    monkeypatch.setenv("BACKUP_API_KEY", "key")
+    endpoints = ProviderRegistry().select(["MISSING", "BACKUP"])
+    assert [endpoint.name for endpoint in endpoints] == ["BACKUP"]
+
+
+def test_endpoint_names_default_to_doubao():
+    assert parse_endpoint_names(None) == ["DOUBAO"]
+    assert parse_endpoint_names(" doubao , backup ,") == ["doubao", "backup"]
+
+
+def test_faster_and_healthier_endpoints_come_first(monkeypatch):
+    for name in ("SLOW", "FAST", "BROKEN"):
+        monkeypatch.setenv(f"{name}_API_URL", f"http://{name.lower()}/chat/completions")
+        monkeypatch.setenv(f"{name}_API_KEY", "key")
+    registry = ProviderRegistry()
+    slow, fast, broken = (registry.endpoint(name) for name in ("SLOW", "FAST", "BROKEN"))
+    slow.record(2.0, True)
+    fast.record(0.2, True)
+    broken.record(0.1, True)
+    for _ in range(3):
+        broken.record(None, False)
+    assert registry.select(["SLOW", "FAST", "BROKEN"]) == [fast, slow, broken]
+
+
+def test_error_rate_forgets_old_outcomes():
+    endpoint = Endpoint("TEST", "http://test", "key")
+    endpoint.record(None, False)
+    assert endpoint.error_rate() == 1.0
+    endpoint.outcomes[0] = (0.0, False)
+    assert endpoint.error_rate() == 0.0
@@ -0,0 +1,177 @@
+"""熔断器状态转换, 以及call()的重试和熔断行为"""
+import uuid
+import asyncio
+import httpx
+import pytest
+from llm_pack_service.apis import resilience
+from llm_pack_service.apis.error import CircuitOpenError
+from llm_pack_service.apis.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(resilience, "CIRCUIT_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(resilience, "RETRY_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(resilience, "RETRY_BASE_DELAY", 0)
+
+
+def upstream_name() -> str:
+    """每个测试使用新的上游名, 熔断器和重试预算互不影响"""
+    return f"test_{uuid.uuid4().hex[:8]}"
+
+
+def response(status_code: int) -> httpx.Response:
+    return httpx.Response(status_code, request=httpx.Request("POST", "http://upstream/"))
+
+
+def sender(*results):
+    """依次返回results中的响应或抛出其中的异常, 并记录调用次数"""
+    calls = []
+
+    async def send():
+        result = results[len(calls)]
+        calls.append(result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return send, calls
+
+
+def expire(breaker: CircuitBreaker) -> None:
+    breaker.opened_at -= resilience.CIRCUIT_RESET_TIMEOUT
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test")
+    breaker.before_call()
+    breaker.on_failure()
+    breaker.before_call()
+    breaker.on_success()
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == OPEN and breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker("test")
+    for _ in range(2):
+        breaker.on_failure()
+    expire(breaker)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.on_success()
+    assert breaker.state == CLOSED and breaker.failures == 0
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_and_cancelled_probe_frees_the_slot():
+    breaker = CircuitBreaker("test")
+    for _ in range(2):
+        breaker.on_failure()
+    expire(breaker)
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == OPEN and breaker.is_open()
+
+
+def test_call_retries_safe_statuses_for_non_idempotent_requests(monkeypatch):
+    monkeypatch.setattr(resilience, "CIRCUIT_FAILURE_THRESHOLD", 10)
+    send, calls = sender(response(503), response(429), response(200))
+    result = asyncio.run(resilience.call(upstream_name(), send))
+    assert result.status_code == 200 and len(calls) == 3
+
+
+def test_call_retries_502_only_for_idempotent_requests():
+    send, calls = sender(response(502), response(200))
+    assert asyncio.run(resilience.call(upstream_name(), send)).status_code == 502
+    assert len(calls) == 1
+    send, calls = sender(response(502), response(200))
+    assert asyncio.run(resilience.call(upstream_name(), send, idempotent=True)).status_code == 200
+    assert len(calls) == 2
+
+
+def test_call_returns_last_response_when_attempts_run_out(monkeypatch):
+    monkeypatch.setattr(resilience, "CIRCUIT_FAILURE_THRESHOLD", 10)
+    send, calls = sender(response(503), response(503), response(503))
+    assert asyncio.run(resilience.call(upstream_name(), send)).status_code == 503
+    assert len(calls) == 3
+
+
+def test_call_retries_connect_errors_and_raises_the_last_one():
+    request = httpx.Request("POST", "http://upstream/")
+    send, calls = sender(httpx.ConnectError("refused", request=request), response(200))
+    assert asyncio.run(resilience.call(upstream_name(), send)).status_code == 200
+    send, calls = sender(httpx.ReadTimeout("slow", request=request))
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(resilience.call(upstream_name(), send))
+    assert len(calls) == 1
+
+
+def test_client_errors_do_not_count_as_failures():
+    upstream = upstream_name()
+    for _ in range(3):
+        send, calls = sender(response(400))
+        assert asyncio.run(resilience.call(upstream, send)).status_code == 400
+        assert len(calls) == 1
+    assert resilience.get_breaker(upstream).state == CLOSED
+
+
+def test_open_circuit_rejects_without_sending():
+    upstream = upstream_name()
+    send, calls = sender(response(503), response(503), response(200))
+    assert asyncio.run(resilience.call(upstream, send)).status_code == 503
+    assert resilience.get_breaker(upstream).state == OPEN
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(resilience.call(upstream, send))
+    assert len(calls) == 2
+
+
+def test_cancelled_call_releases_the_probe():
+    upstream = upstream_name()
+    breaker = resilience.get_breaker(upstream)
+    for _ in range(2):
+        breaker.on_failure()
+    expire(breaker)
+
+    async def scenario():
+        async def hang():
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(resilience.call(upstream, hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        send, calls = sender(response(200))
+        return await resilience.call(upstream, send)
+
+    assert asyncio.run(scenario()).status_code == 200
+    assert breaker.state == CLOSED
+
+
+def test_errors_raised_by_the_request_itself_do_not_open_the_circuit():
+    upstream = upstream_name()
+    for _ in range(5):
+        send, calls = sender(ValueError("invalid payload"))
+        with pytest.raises(ValueError):
+            asyncio.run(resilience.call(upstream, send))
+    assert resilience.get_breaker(upstream).state == CLOSED
+
+
+def test_timeouts_count_as_failures():
+    upstream = upstream_name()
+    request = httpx.Request("POST", "http://upstream/")
+    for _ in range(2):
+        send, calls = sender(httpx.ReadTimeout("slow", request=request))
+        with pytest.raises(httpx.ReadTimeout):
+            asyncio.run(resilience.call(upstream, send))
+    assert resilience.get_breaker(upstream).state == OPEN
@@ -0,0 +1,76 @@
+"""JSON序列化与预先序列化的响应: 两种实现输出一致, ETag条件请求, 压缩后的弱ETag"""
+import pytest
+from fastapi.testclient import TestClient
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import compression, responses
+from llm_pack_service.apis.error import get_error_response
+from llm_pack_service.apis.responses import CachedJSON, etag_matches
+
+
+@pytest.mark.parametrize("if_none_match,matches", [
+    (None, False), ('"abc"', True), ('W/"abc"', True), ('"x", "abc"', True),
+    ("*", True), ('"abcd"', False),
+])
+def test_if_none_match_uses_weak_comparison(if_none_match, matches):
+    assert etag_matches(if_none_match, '"abc"') == matches
+
+
+def test_cached_body_is_reused_and_answers_304():
+    cached = CachedJSON({"message": "你好"})
+    first, second = cached.response(), cached.response()
+    assert first.body is second.body == '{"message":"你好"}'.encode("utf-8")
+    assert first.headers["etag"] == cached.etag and first.headers["cache-control"] == "no-cache"
+    not_modified = cached.response(cached.etag)
+    assert not_modified.status_code == 304 and not not_modified.body
+    # 非200的响应不按ETag返回304
+    assert cached.response(cached.etag, status_code=503).status_code == 503
+
+
+@pytest.mark.parametrize("path", ["/", "/health", "/api/v1/chat_model_list"])
+def test_metadata_endpoints_support_conditional_requests(path):
+    client = TestClient(app)
+    response = client.get(path, headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_etag_of_a_compressed_response_still_matches(monkeypatch):
+    monkeypatch.setattr(compression, "COMPRESSION_MIN_SIZE", 16)
+    client = TestClient(app)
+    response = client.get("/api/v1/chat_model_list", headers={"Accept-Encoding": "gzip"})
+    assert response.headers.get("content-encoding") == "gzip"
+    assert response.headers["etag"].startswith('W/"')
+    revalidated = client.get("/api/v1/chat_model_list", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304
+
+
+@pytest.fixture(params=["orjson", "json"])
+def serialiser(request, monkeypatch):
+    """分别用orjson和标准库序列化"""
+    if request.param == "json":
+        monkeypatch.setattr(responses, "orjson", None)
+    elif responses.orjson is None:
+        pytest.skip("orjson未安装")
+    return request.param
+
+
+def test_both_serialisers_give_the_same_compact_utf8_output(serialiser):
+    value = {"msg": "成功", "data": [1, 2.5, None, True], 3: "x"}
+    expected = '{"msg":"成功","data":[1,2.5,null,true],"3":"x"}'
+    assert responses.dumps(value) == expected.encode("utf-8")
+    assert responses.dumps_str(value) == expected
+    # 非字符串的键序列化为字符串
+    assert responses.loads(expected.encode("utf-8")) == responses.loads(expected) == {
+        "msg": "成功", "data": [1, 2.5, None, True], "3": "x"}
+
+
+def test_envelope_and_error_responses(serialiser):
+    response = responses.envelope_response({"url": "a"}, headers={"X-Request-Id": "1"})
+    assert response.media_type == responses.JSON_MEDIA_TYPE
+    assert response.headers["x-request-id"] == "1"
+    assert response.body == b'{"code":1,"msg":"success","data":{"url":"a"},"status":200}'
+    error = get_error_response("参数错误", status=400, status_code=429)
+    assert error.status_code == 429
+    assert responses.loads(error.body) == {"code": 0, "msg": "参数错误", "data": {}, "status": 400}
@@ -0,0 +1,92 @@
+"""语义缓存: 命中, 分区隔离, 按条数, 字节数和过期时间淘汰"""
+import time
+import asyncio
+import pytest
+from llm_pack_service.apis import semantic_cache
+from llm_pack_service.apis.semantic_cache import HASHING_THRESHOLD, SemanticCache
+
+
+@pytest.fixture(autouse=True)
+def hashing_vectors(monkeypatch):
+    monkeypatch.setattr(semantic_cache, "SEMANTIC_CACHE_MODEL", "")
+    monkeypatch.setattr(semantic_cache, "SEMANTIC_CACHE_SHARED", False)
+
+
+def make_cache(max_entries: int = 100, max_bytes: int = 1 << 20, ttl: float = 0) -> SemanticCache:
+    cache = SemanticCache(None, max_entries, max_bytes, ttl)
+    cache.load_encoder()
+    return cache
+
+
+def query(cache: SemanticCache, text: str, caller: str = "caller"):
+    messages = [{"role": "user", "content": text}]
+    return asyncio.run(cache.query(messages, [], "doubao-test", caller))
+
+
+def answer(text: str):
+    return {"role": "assistant", "content": text}
+
+
+def test_hashing_vectors_use_the_strict_threshold():
+    assert make_cache().threshold == HASHING_THRESHOLD
+
+
+def test_same_question_hits_and_other_callers_miss():
+    cache = make_cache()
+    cache.store(query(cache, "What is the capital of France?"), answer("Paris"))
+    hit = cache.lookup(query(cache, "what is the capital of france"))
+    assert hit is not None and hit[0] == answer("Paris") and hit[1] >= HASHING_THRESHOLD
+    assert cache.lookup(query(cache, "What is the capital of France?", "other")) is None
+    assert cache.lookup(query(cache, "What is not the capital of France?")) is None
+
+
+def test_least_recently_used_entry_is_evicted_beyond_max_entries():
+    cache = make_cache(max_entries=2)
+    questions = ["first question here", "second question here", "third question here"]
+    cache.store(query(cache, questions[0]), answer("1"))
+    cache.store(query(cache, questions[1]), answer("2"))
+    # 命中会刷新最近使用, 第二个问题变成最久未用
+    assert cache.lookup(query(cache, questions[0])) is not None
+    cache.store(query(cache, questions[2]), answer("3"))
+    assert len(cache._entries) == 2
+    assert cache.lookup(query(cache, questions[1])) is None
+    assert cache.lookup(query(cache, questions[0]))[0] == answer("1")
+    assert cache.lookup(query(cache, questions[2]))[0] == answer("3")
+
+
+def test_entries_are_evicted_beyond_max_bytes():
+    cache = make_cache()
+    first = query(cache, "first question here")
+    cache.store(first, answer("1"))
+    entry_bytes = cache.nbytes
+    cache.max_bytes = entry_bytes * 2 + entry_bytes // 2
+    for text in ("second question here", "third question here"):
+        cache.store(query(cache, text), answer(text[0]))
+    assert len(cache._entries) == 2 and cache.nbytes <= cache.max_bytes
+    assert cache.lookup(first) is None
+
+
+def test_answer_larger_than_the_cache_is_not_stored():
+    cache = make_cache(max_bytes=5000)
+    cache.store(query(cache, "long answer please"), answer("x" * 10000))
+    assert not cache._entries and cache.nbytes == 0
+
+
+def test_expired_entry_is_removed_on_lookup():
+    cache = make_cache(ttl=60)
+    question = query(cache, "will this expire")
+    cache.store(question, answer("yes"))
+    row = next(iter(cache._entries))
+    cache._entries[row] = cache._entries[row]._replace(created=time.time() - 61)
+    assert cache.lookup(question) is None
+    assert not cache._entries and cache.nbytes == 0
+
+
+def test_storing_the_same_question_replaces_the_answer_and_reuses_the_row():
+    cache = make_cache()
+    question = query(cache, "which answer is kept")
+    cache.store(question, answer("old"))
+    cache.store(question, answer("new"))
+    assert len(cache._entries) == 1
+    assert cache.lookup(question)[0] == answer("new")
+    assert cache.index.size == 1
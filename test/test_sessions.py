@@ -0,0 +1,130 @@
+"""会话历史: 按预算截取窗口, system消息和摘要, 消息数上限, 以及会话接口的调用方检查"""
+import time
+from collections import OrderedDict
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import sessions, usage, utils
+from llm_pack_service.apis.sessions import SUMMARY_PREFIX, Session, message_tokens, session_store
+from llm_pack_service.apis.usage import Quota, caller_id, usage_ledger
+
+
+def turn(index: int):
+    return [{"role": "user", "content": f"question {index}"},
+            {"role": "assistant", "content": f"answer {index}"}]
+
+
+def session_with_turns(count: int, system: str = "be brief") -> Session:
+    session = Session(("caller", "session"))
+    session.append([{"role": "system", "content": system}] + turn(0))
+    for index in range(1, count):
+        session.append(turn(index))
+    return session
+
+
+def cost(messages) -> int:
+    return sum(message_tokens(message) for message in messages)
+
+
+def test_window_keeps_the_system_prompt_and_the_latest_turns_that_fit():
+    session = session_with_turns(5)
+    system = {"role": "system", "content": "be brief"}
+    budget = cost([system] + turn(3) + turn(4))
+    history, dropped = session.window(budget)
+    assert history == [system] + turn(3) + turn(4)
+    assert [message["content"] for message in dropped] == [
+        message["content"] for index in range(3) for message in turn(index)]
+
+
+def test_window_starts_at_a_user_message():
+    session = session_with_turns(3)
+    system = {"role": "system", "content": "be brief"}
+    # 预算只够最后一问的回答和前一轮的回答, 不能以assistant消息开头
+    budget = cost([system] + turn(2)) + message_tokens(turn(1)[1])
+    history, dropped = session.window(budget)
+    assert history == [system] + turn(2)
+    assert dropped[-1]["content"] == "answer 1"
+
+
+def test_window_without_budget_still_keeps_the_system_prompt():
+    history, dropped = session_with_turns(2).window(0)
+    assert history == [{"role": "system", "content": "be brief"}]
+    assert len(dropped) == 4
+
+
+def test_summary_replaces_summarised_messages():
+    session = session_with_turns(4)
+    session.summary = "earlier turns"
+    session.summary_upto = 7
+    history, dropped = session.window(10000)
+    assert history[:2] == [{"role": "system", "content": "be brief"},
+                           {"role": "system", "content": SUMMARY_PREFIX + "earlier turns"}]
+    assert history[2:] == turn(3)
+    assert dropped == []
+
+
+def test_new_system_prompt_is_not_pinned_twice():
+    session = session_with_turns(2)
+    history, _ = session.window(10000, pin_system=False)
+    assert history == turn(0) + turn(1)
+
+
+def test_repeated_system_prompt_is_stored_once_and_a_new_one_replaces_it():
+    session = session_with_turns(1)
+    session.append([{"role": "system", "content": "be brief"}] + turn(1))
+    assert [m["content"] for m in session.messages if m["role"] == "system"] == ["be brief"]
+    session.append([{"role": "system", "content": "be detailed"}] + turn(2))
+    assert [m["content"] for m in session.messages if m["role"] == "system"] == ["be detailed"]
+    history, _ = session.window(10000)
+    assert history[0] == {"role": "system", "content": "be detailed"}
+    assert history[1:] == turn(0) + turn(1) + turn(2)
+
+
+def test_oldest_messages_beyond_the_limit_are_dropped_but_not_the_system_prompt(monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_MAX_MESSAGES", 5)
+    session = session_with_turns(4)
+    assert len(session.messages) == 5
+    assert session.messages[0]["role"] == "system"
+    assert [m["content"] for m in session.messages[1:]] == [
+        "question 2", "answer 2", "question 3", "answer 3"]
+    assert session.next_seq == 9
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("DOUBAO_API_URL", "http://upstream/api/v3/chat/completions")
+    monkeypatch.setenv("DOUBAO_API_KEY", "token")
+    monkeypatch.setattr(usage, "QUOTA_REQUIRE_KEY", True)
+    monkeypatch.setattr(usage_ledger, "quotas", {"known": Quota(), "spent": Quota(tokens_per_day=10)})
+    monkeypatch.setattr(session_store, "_sessions", OrderedDict())
+    monkeypatch.setattr(utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, json={
+            "choices": [{"message": {"role": "assistant", "content": "answer"}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1}}))))
+    return TestClient(app)
+
+
+def post_chat(client, api_key=None, **params):
+    headers = {"X-API-Key": api_key} if api_key else {}
+    return client.post("/api/v1/chat", params={"model": "doubao-1.5-pro-32k", "stream": "false",
+                                                **params},
+                       headers=headers, json={"messages": [{"role": "user", "content": "hi"}]})
+
+
+def test_rejected_requests_do_not_create_sessions(client, monkeypatch):
+    monkeypatch.setitem(usage_ledger._day_tokens, caller_id("spent"),
+                        (time.strftime("%Y-%m-%d", time.gmtime()), 10))
+    assert post_chat(client, "unknown", new_session="true").json()["status"] == 401
+    assert post_chat(client, "spent", new_session="true").json()["status"] == 429
+    assert not session_store._sessions
+
+
+def test_session_endpoints_check_the_api_key(client):
+    response = post_chat(client, "known", new_session="true")
+    session_id = response.headers["X-Session-Id"]
+    assert client.get(f"/api/v1/sessions/{session_id}",
+                      headers={"X-API-Key": "unknown"}).json()["status"] == 401
+    assert client.delete(f"/api/v1/sessions/{session_id}").json()["status"] == 401
+    stored = client.get(f"/api/v1/sessions/{session_id}", headers={"X-API-Key": "known"}).json()
+    assert [message["content"] for message in stored["data"]["messages"]] == ["hi", "answer"]
@@ -0,0 +1,93 @@
+"""/static: 小文件从内存返回并带压缩版本, 大文件使用磁盘上的预压缩文件, 缓存按大小淘汰"""
+import os
+import gzip
+import base64
+import asyncio
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from fastapi.testclient import TestClient
+from llm_pack_service.apis import metrics, static
+from llm_pack_service.apis.static import CachedStaticFiles, StaticFileCache
+
+SCRIPT = b"console.log('hello static');\n" * 100
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    file_cache = StaticFileCache(64 * 1024, 16 * 1024)
+    monkeypatch.setattr(static, "file_cache", file_cache)
+    return file_cache
+
+
+@pytest.fixture
+def client(tmp_path, cache):
+    app = Starlette(routes=[Mount("/static", CachedStaticFiles(directory=str(tmp_path)))])
+    return TestClient(app)
+
+
+def test_small_files_are_served_compressed_from_memory(tmp_path, client):
+    (tmp_path / "app.3f2a9c1b.js").write_bytes(SCRIPT)
+    memory = metrics.static_responses_total.get("memory")
+    response = client.get("/static/app.3f2a9c1b.js", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip" and response.content == SCRIPT
+    assert response.headers["etag"].endswith('-gzip"')
+    assert response.headers["cache-control"] == static.IMMUTABLE_CACHE_CONTROL
+    assert response.headers["vary"] == "Accept-Encoding"
+    plain = client.get("/static/app.3f2a9c1b.js", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["etag"] != response.headers["etag"]
+    assert metrics.static_responses_total.get("memory") == memory + 2
+    revalidated = client.get("/static/app.3f2a9c1b.js", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304
+
+
+def test_large_files_use_a_fresh_precompressed_variant(tmp_path, client):
+    path = tmp_path / "bundle.js"
+    body = SCRIPT * 10
+    path.write_bytes(body)
+    (tmp_path / "bundle.js.gz").write_bytes(gzip.compress(body))
+    os.utime(path, (1_000_000, 1_000_000))
+    response = client.get("/static/bundle.js", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip" and response.content == body
+    assert response.headers["cache-control"] == f"public, max-age={static.STATIC_MAX_AGE}"
+    # 预压缩文件比原文件旧时不使用
+    os.utime(path, (2_000_000_000, 2_000_000_000))
+    stale = client.get("/static/bundle.js", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in stale.headers and stale.content == body
+
+
+def test_cache_reloads_changed_files_and_evicts_the_least_recently_used(tmp_path):
+    cache = StaticFileCache(2500, 2000)
+    paths = []
+    for name in "abc":
+        path = tmp_path / f"{name}.bin"
+        path.write_bytes(name.encode() * 1000)
+        paths.append(str(path))
+    first = cache.get(paths[0], os.stat(paths[0]))
+    cache.get(paths[1], os.stat(paths[1]))
+    assert cache.get(paths[0], os.stat(paths[0])) is first
+    cache.get(paths[2], os.stat(paths[2]))
+    assert list(cache._files) == [paths[0], paths[2]] and cache.nbytes == 2000
+    with open(paths[0], "wb") as f:
+        f.write(b"z" * 500)
+    assert cache.get(paths[0], os.stat(paths[0])).body == b"z" * 500
+    big = tmp_path / "big.bin"
+    big.write_bytes(b"x" * 3000)
+    assert cache.get(str(big), os.stat(big)) is None
+
+
+def test_self_urls_are_inlined_only_when_all_point_to_static(tmp_path, monkeypatch, cache):
+    monkeypatch.setattr(static, "STATIC_DIR", str(tmp_path))
+    (tmp_path / "cat.png").write_bytes(b"\x89PNG cat")
+    self_url = "http://localhost:8808/static/cat.png"
+    inlined = asyncio.run(static.inline_self_urls({"image_urls": [self_url], "prompt": "猫"}))
+    assert inlined == {"prompt": "猫",
+                       "binary_data_base64": [base64.b64encode(b"\x89PNG cat").decode()]}
+    mixed = {"image_urls": [self_url, "https://example.com/dog.png"]}
+    assert asyncio.run(static.inline_self_urls(mixed)) is mixed
+    # 目录外的文件即使存在也不读取
+    outside = tmp_path.parent / f"{tmp_path.name}-outside.png"
+    outside.write_bytes(b"secret")
+    assert static.self_static_path(f"http://localhost:8808/static/../{outside.name}") is None
@@ -0,0 +1,82 @@
+"""流式对话: 各阶段计时, timing事件在结束标记之前发送, 首字节之前出错时切换端点"""
+import json
+import asyncio
+import httpx
+import pytest
+from llm_pack_service.apis import chat, metrics, resilience, utils
+from llm_pack_service.apis.providers import Endpoint
+
+USAGE = {"prompt_tokens": 3, "completion_tokens": 2}
+
+
+def upstream_body(done: bool = True) -> bytes:
+    lines = [f"data: {json.dumps({'choices': [{'delta': {'content': text}}], 'usage': USAGE})}"
+             for text in ("你", "好")]
+    if done:
+        lines.append("data: [DONE]")
+    return ("\n\n".join(lines) + "\n\n").encode("utf-8")
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstreams(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_retry_budgets", {})
+
+
+def mock_upstreams(monkeypatch, replies):
+    """replies: 主机名 -> (状态码, 响应体)"""
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        status, body = replies[request.url.host]
+        return httpx.Response(status, content=body)
+
+    monkeypatch.setattr(utils, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return calls
+
+
+def observations(histogram, *labels) -> float:
+    state = histogram._values.get(labels)
+    return state[-1] if state else 0
+
+
+def stream(hosts, timing=False, model_name="timing-test"):
+    endpoints = [Endpoint(host.upper(), f"http://{host}/api/v3/chat/completions", "token")
+                 for host in hosts]
+
+    async def scenario():
+        return [event async for event in chat.stream_generator(
+            endpoints, {"messages": [], "stream": True}, model_name, timing)]
+
+    return asyncio.run(scenario())
+
+
+def test_timing_event_is_sent_before_the_done_marker(monkeypatch):
+    mock_upstreams(monkeypatch, {"a": (200, upstream_body())})
+    ttft = observations(metrics.chat_ttft_seconds, "timing-test")
+    events = stream(["a"], timing=True)
+    assert [json.loads(event[len("data: "):])["content"] for event in events[:2]] == ["你", "好"]
+    assert events[2].startswith("event: timing\ndata: ")
+    assert json.loads(events[3][len("data: "):])["isDone"] == "True"
+    summary = json.loads(events[2].split("data: ", 1)[1])
+    assert summary["model"] == "timing-test" and summary["first_content_ms"] is not None
+    assert observations(metrics.chat_ttft_seconds, "timing-test") == ttft + 1
+
+
+def test_no_timing_event_unless_requested(monkeypatch):
+    mock_upstreams(monkeypatch, {"a": (200, upstream_body())})
+    assert not any(event.startswith("event: timing") for event in stream(["a"]))
+
+
+def test_timing_event_is_sent_at_the_end_without_a_done_marker(monkeypatch):
+    mock_upstreams(monkeypatch, {"a": (200, upstream_body(done=False))})
+    events = stream(["a"], timing=True)
+    assert len(events) == 3 and events[-1].startswith("event: timing")
+
+
+def test_stream_fails_over_before_the_first_byte(monkeypatch):
+    calls = mock_upstreams(monkeypatch, {"a": (500, b""), "b": (200, upstream_body())})
+    events = stream(["a", "b"])
+    assert calls == ["a", "b"] and len(events) == 3
@@ -0,0 +1,119 @@
+"""文生图: b64_json边读边转发, 写入磁盘缓存和按块读取缓存文件, 以及批量生成"""
+import os
+import json
+import base64
+import asyncio
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import resilience, text2image, utils
+from llm_pack_service.apis.cache import ResultCache
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + os.urandom(20000)
+B64 = base64.b64encode(IMAGE).decode("ascii")
+USAGE = {"generated_images": 1}
+
+
+@pytest.fixture(autouse=True)
+def disk_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_retry_budgets", {})
+    # 不是4的倍数, 让每块的边界都不对齐base64分组
+    monkeypatch.setattr(text2image, "STREAM_CHUNK_SIZE", 1001)
+    monkeypatch.setattr(text2image, "txt2img_cache", ResultCache(
+        ttl=60, max_entries=10, disk_dir=str(tmp_path), disk_ttl=60, disk_max_bytes=1 << 30))
+
+
+def mock_upstream(monkeypatch):
+    # 上游JSON中的"/"可能被转义成"\/"
+    body = ('{"created": 1, "data": [{"b64_json": "' + B64.replace("/", "\\/")
+            + '"}], "usage": ' + json.dumps(USAGE) + "}").encode("ascii")
+
+    async def chunks():
+        for start in range(0, len(body), 777):
+            yield body[start:start + 777]
+
+    monkeypatch.setattr(utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, content=chunks()))))
+
+
+async def collect(generator):
+    return b"".join([chunk async for chunk in generator])
+
+
+def test_streamed_image_is_cached_and_served_from_the_file_in_chunks(monkeypatch):
+    mock_upstream(monkeypatch)
+
+    async def scenario():
+        response, chunks, prefix, first = await text2image._open_b64_stream(
+            "http://upstream/images/generations", {}, {})
+        streamed = await collect(text2image.b64_stream_generator(
+            response, chunks, prefix, first, True, "key"))
+        path = await text2image.txt2img_cache.disk_file("key")
+        return (streamed, await collect(text2image.cached_b64_generator(path, True)),
+                await collect(text2image.cached_b64_generator(path, False)))
+
+    streamed, cached_image, cached_json = asyncio.run(scenario())
+    assert streamed == IMAGE and cached_image == IMAGE
+    assert json.loads(cached_json) == {"b64_json": B64, "usage": USAGE}
+
+
+def test_cached_result_with_other_fields_first_is_decoded():
+    async def scenario():
+        cache = text2image.txt2img_cache
+        await cache.set("key", {"usage": USAGE, "b64_json": B64}, disk=True)
+        return await collect(text2image.cached_b64_generator(await cache.disk_file("key"), True))
+
+    assert asyncio.run(scenario()) == IMAGE
+
+
+@pytest.fixture
+def fake_generate(monkeypatch):
+    """替换上游调用, 记录每张图片的参数和同时进行的请求数"""
+    calls = []
+    running = {"now": 0, "max": 0}
+
+    async def generate_image(prompt, seed, **kwargs):
+        calls.append((prompt, seed))
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        if prompt == "broken":
+            raise text2image.ImageGenerationError("upstream failed")
+        return {"image_url": f"http://images/{prompt}/{seed}.png"}
+
+    monkeypatch.setattr(text2image, "generate_image", generate_image)
+    monkeypatch.setattr(text2image, "batch_semaphore", asyncio.Semaphore(2))
+    return calls, running
+
+
+def post_batch(prompts, n=1, **params):
+    return TestClient(app).post("/api/v1/txt2img/batch", json={"prompts": prompts, "n": n},
+                                params={"size": "1024x1024", "response_format": "url",
+                                        "seed": 100, **params})
+
+
+def test_batch_streams_every_image_with_its_own_seed_and_error(fake_generate):
+    calls, running = fake_generate
+    response = post_batch(["cat", "broken", "dog"], n=2)
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    items = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted((item["index"], item["variant"], item["seed"], item["code"]) for item in items) == [
+        (0, 0, 100, 1), (0, 1, 101, 1), (1, 0, 100, 0), (1, 1, 101, 0), (2, 0, 100, 1), (2, 1, 101, 1)]
+    assert {item["msg"] for item in items if item["index"] == 1} == {"upstream failed"}
+    assert sorted(calls) == sorted((p, s) for p in ("cat", "broken", "dog") for s in (100, 101))
+    assert running["max"] == 2
+
+
+def test_batch_as_sse_ends_with_done(fake_generate):
+    events = post_batch(["cat"], output="sse").text.split("\n\n")
+    assert json.loads(events[0][len("data: "):])["data"]["image_url"] == "http://images/cat/100.png"
+    assert events[1] == "data: [DONE]"
+
+
+def test_batch_over_the_image_limit_is_rejected(fake_generate, monkeypatch):
+    monkeypatch.setattr(text2image, "TXT2IMG_BATCH_MAX_IMAGES", 3)
+    assert post_batch(["cat", "dog"], n=2).json()["code"] == 0
+    assert fake_generate[0] == []
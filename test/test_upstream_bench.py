@@ -0,0 +1,58 @@
+"""压测脚本: 模拟上游能支撑各个场景, 分位数和基线比较"""
+import json
+import asyncio
+import httpx
+import pytest
+import upstream_bench
+from llm_pack_service.pack_service import app
+from llm_pack_service.apis import resilience, usage, utils
+
+
+@pytest.fixture
+def mock_upstream(monkeypatch):
+    for name, value in {
+        "DOUBAO_API_URL": "http://mock/chat",
+        "DOUBAO_API_KEY": "bench",
+        "DOUBAO_TEXT_GENERATE_IMAGE_API_URL": "http://mock/images",
+        "DOUBAO_TEXT_GENERATE_IMAGE_API_KEY": "bench",
+    }.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(usage, "USAGE_LEDGER_FILE", "")
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_retry_budgets", {})
+    mock_app = upstream_bench.build_mock_app(upstream_bench.PROFILES["fast"])
+    monkeypatch.setattr(utils, "_http_client", httpx.AsyncClient(
+        transport=httpx.ASGITransport(mock_app), base_url="http://mock"))
+
+
+@pytest.mark.parametrize("scenario", ["chat_stream", "chat_json", "txt2img"])
+def test_scenarios_succeed_against_the_mock_upstream(mock_upstream, scenario):
+    async def scenario_result():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app),
+                                     base_url="http://service") as client:
+            return await upstream_bench._one_request(client, scenario)
+
+    result = asyncio.run(scenario_result())
+    assert result["ok"], result
+    assert (result["ttft"] is not None) == (scenario == "chat_stream")
+
+
+def test_percentiles_use_the_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+    assert upstream_bench._percentile(values, 50) == 50
+    assert upstream_bench._percentile(values, 99) == 99
+    assert upstream_bench._percentile([], 95) is None
+
+
+def test_regressions_beyond_the_tolerance_are_reported(tmp_path):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps([
+        {"scenario": "chat_json", "p95_ms": 100, "rps": 500},
+        {"scenario": "txt2img", "p95_ms": 100, "rps": 500},
+    ]), encoding="utf-8")
+    failures = upstream_bench.compare_baseline([
+        {"scenario": "chat_json", "p95_ms": 119, "rps": 401},
+        {"scenario": "txt2img", "p95_ms": 121, "rps": 399},
+        {"scenario": "auc", "p95_ms": 1000, "rps": 1},
+    ], str(baseline), 0.2)
+    assert len(failures) == 2 and all(failure.startswith("txt2img") for failure in failures)
@@ -0,0 +1,104 @@
+"""用量账本和限额: 每分钟请求数, 每日token数, 并发流, 以及多worker时的启动检查"""
+import json
+import asyncio
+import logging
+import pytest
+from llm_pack_service.apis import chat, usage
+from llm_pack_service.apis.error import QuotaExceededError
+from llm_pack_service.apis.lifecycle import lifecycle
+from llm_pack_service.apis.usage import Quota, UsageLedger, caller_id
+
+
+@pytest.fixture(autouse=True)
+def no_ledger_file(monkeypatch):
+    monkeypatch.setattr(usage, "USAGE_LEDGER_FILE", "")
+
+
+def test_quotas_are_only_enforced_when_a_limit_is_set():
+    assert not UsageLedger({}).enforces_limits()
+    assert not UsageLedger({"key": Quota(0, 0, 0)}).enforces_limits()
+    assert UsageLedger({"key": Quota(max_streams=1)}).enforces_limits()
+
+
+@pytest.mark.parametrize("quotas,logged", [({}, False), ({"key": Quota(requests_per_minute=5)}, True)])
+def test_per_worker_quotas_are_reported_at_startup(monkeypatch, caplog, quotas, logged):
+    monkeypatch.setattr(lifecycle, "workers", 4)
+    monkeypatch.setattr(chat.usage_ledger, "quotas", quotas)
+    monkeypatch.setattr(chat, "SESSION_DB", "sessions.db")
+
+    async def nothing():
+        return None
+
+    monkeypatch.setattr(chat, "semantic_cache_startup", nothing)
+    monkeypatch.setattr(chat.model_registry, "start", lambda: None)
+    monkeypatch.setattr(chat.session_store, "start", nothing)
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(chat.on_startup())
+    assert any("counted per worker" in record.getMessage() for record in caplog.records) == logged
+
+
+def test_requests_per_minute_are_limited_per_caller():
+    ledger = UsageLedger({"key": Quota(requests_per_minute=2)})
+    caller = ledger.caller("key")
+    ledger.admit(caller)
+    ledger.admit(caller)
+    with pytest.raises(QuotaExceededError) as rejected:
+        ledger.admit(caller)
+    assert rejected.value.status_code == 429 and 0 < rejected.value.retry_after <= 60
+    # 其他调用方使用默认限额, 不受影响
+    ledger.admit(ledger.caller("other"))
+
+
+def test_daily_tokens_are_checked_before_the_request():
+    ledger = UsageLedger({"key": Quota(tokens_per_day=10)})
+    caller = ledger.caller("key")
+    ledger.admit(caller)
+    ledger.record(caller, "model", {"prompt_tokens": 6, "completion_tokens": 4})
+    assert ledger.tokens_today(caller.id) == 10
+    with pytest.raises(QuotaExceededError) as rejected:
+        ledger.admit(caller)
+    assert rejected.value.retry_after > 0
+
+
+def test_concurrent_streams_are_limited_until_released():
+    ledger = UsageLedger({"key": Quota(max_streams=1)})
+    caller = ledger.caller("key")
+    ledger.admit(caller, stream=True)
+    with pytest.raises(QuotaExceededError):
+        ledger.admit(caller, stream=True)
+    ledger.admit(caller)
+    ledger.release_stream(caller)
+    ledger.admit(caller, stream=True)
+    assert ledger._streams == {caller.id: 1}
+
+
+def test_unknown_keys_are_rejected_when_keys_are_required(monkeypatch):
+    monkeypatch.setattr(usage, "QUOTA_REQUIRE_KEY", True)
+    ledger = UsageLedger({"key": Quota()})
+    assert ledger.caller("key").id == caller_id("key")
+    for api_key in (None, "other"):
+        with pytest.raises(QuotaExceededError) as rejected:
+            ledger.caller(api_key)
+        assert rejected.value.status_code == 401
+
+
+def test_ledger_is_flushed_with_hashed_callers(monkeypatch, tmp_path):
+    path = tmp_path / "usage.jsonl"
+    monkeypatch.setattr(usage, "USAGE_LEDGER_FILE", str(path))
+    ledger = UsageLedger({})
+    caller = ledger.caller("secret-key")
+
+    async def scenario():
+        for _ in range(2):
+            ledger.record(caller, "model", {"prompt_tokens": 5, "completion_tokens": 1})
+        ledger._flush_task.cancel()
+
+    asyncio.run(scenario())
+    ledger.flush()
+    ledger.flush()
+    lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [{key: line[key] for key in ("caller", "model", "requests", "prompt_tokens",
+                                         "completion_tokens")} for line in lines] == [
+        {"caller": caller_id("secret-key"), "model": "model", "requests": 2,
+         "prompt_tokens": 10, "completion_tokens": 2}]
+    assert "secret-key" not in path.read_text(encoding="utf-8")
@@ -0,0 +1,70 @@
+"""多worker: worker数, SO_REUSEPORT绑定, 指标快照合并, 以及worker之间共享的记录"""
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+import pytest
+from llm_pack_service import server
+from llm_pack_service.apis.metrics import render_multiprocess
+from llm_pack_service.apis.records import RecordStore
+
+
+def test_worker_count():
+    assert server.worker_count("3") == 3
+    assert server.worker_count("0") == 1
+    assert server.worker_count(" AUTO ") == server.available_cpus() >= 1
+
+
+@pytest.mark.skipif(not hasattr(server.socket, "SO_REUSEPORT"), reason="needs SO_REUSEPORT")
+def test_workers_can_bind_the_same_port():
+    first = server.bind_reuseport("127.0.0.1", 0)
+    try:
+        second = server.bind_reuseport("127.0.0.1", first.getsockname()[1])
+        second.close()
+    finally:
+        first.close()
+
+
+def exited_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def write_snapshot(directory, pid, requests, in_flight):
+    snapshot = [
+        {"name": "requests_total", "kind": "counter", "help": "Requests",
+         "samples": [["_total", '{route="/a"}', requests]]},
+        {"name": "in_flight", "kind": "gauge", "help": "In flight",
+         "samples": [["", "", in_flight]]},
+    ]
+    with open(os.path.join(directory, f"{pid}.json"), "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+
+
+def test_counters_of_all_workers_are_summed_and_gauges_of_live_workers_are_labelled(tmp_path):
+    alive, exited = os.getpid(), exited_pid()
+    write_snapshot(tmp_path, alive, 3, 2)
+    write_snapshot(tmp_path, exited, 4, 5)
+    lines = render_multiprocess(str(tmp_path)).splitlines()
+    # 已退出worker的计数仍然计入, 瞬时值不再输出
+    assert 'requests_total_total{route="/a"} 7' in lines
+    assert [line for line in lines if line.startswith("in_flight")] == [
+        f'in_flight{{worker="{alive}"}} 2']
+
+
+def test_records_are_shared_through_files_and_expire(tmp_path):
+    async def scenario():
+        store = RecordStore(str(tmp_path), 60)
+        await store.put("job-1", {"status": "running"})
+        other_worker = RecordStore(str(tmp_path), 60)
+        found = await other_worker.get("job-1")
+        path = os.path.join(str(tmp_path), "job-1.json")
+        os.utime(path, (time.time() - 61, time.time() - 61))
+        return found, await other_worker.get("job-1"), await other_worker.get("../job-1")
+
+    assert asyncio.run(scenario()) == ({"status": "running"}, None, None)
+    with pytest.raises(ValueError):
+        asyncio.run(RecordStore(str(tmp_path), 60).put("../escape", {}))
@@ -0,0 +1,423 @@
+"""用本地模拟上游压测 llm_pack_service 的各个接口
+
+用法:
+    python test/upstream_bench.py [--profile fast|realistic] [--scenarios chat_stream,chat_json,...]
+                                  [--concurrency 16] [--requests 200]
+                                  [--json 结果文件] [--baseline 基线文件] [--tolerance 0.2]
+
+脚本会启动两个子进程: 模拟上游(豆包对话SSE/JSON, AUC提交/查询, Seedream文生图,
+视觉cv_process)和 `llm_pack_service.pack_service:app`, 再用并发客户端逐个场景压测,
+输出RPS, p50/p95/p99延迟, 流式对话的TTFT, 以及服务进程的CPU和RSS。
+给出基线文件时, p95变慢或RPS下降超过容差则以非零状态退出, 可用于CI。
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 模拟上游的延迟和吞吐配置, 单位秒
+PROFILES = {
+    "fast": {
+        "chat_ttft": 0.01, "chat_tokens": 20, "token_interval": 0.001,
+        "chat_json": 0.02, "image": 0.05, "cv": 0.05, "auc_polls": 0,
+    },
+    "realistic": {
+        "chat_ttft": 0.5, "chat_tokens": 200, "token_interval": 0.02,
+        "chat_json": 2.0, "image": 3.0, "cv": 2.0, "auc_polls": 0,
+    },
+}
+
+CHAT_BODY = {"messages": [{"role": "user", "content": "你好, 请介绍一下你自己"}]}
+
+
+# ---------------------------------------------------------------- 模拟上游
+
+def build_mock_app(profile: Dict):
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    auc_polls: Dict[str, int] = {}
+
+    async def chat(request: Request):
+        body = await request.json()
+        usage = {"prompt_tokens": 20, "completion_tokens": profile["chat_tokens"],
+                 "total_tokens": 20 + profile["chat_tokens"]}
+        if not body.get("stream"):
+            await asyncio.sleep(profile["chat_json"])
+            return JSONResponse({
+                "choices": [{"message": {"role": "assistant", "content": "字" * profile["chat_tokens"]}}],
+                "usage": usage
+            })
+
+        async def events():
+            await asyncio.sleep(profile["chat_ttft"])
+            for index in range(profile["chat_tokens"]):
+                chunk = {"choices": [{"delta": {"role": "assistant", "content": "字"}}],
+                         "usage": None}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                if index + 1 < profile["chat_tokens"]:
+                    await asyncio.sleep(profile["token_interval"])
+            yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def images(request: Request):
+        body = await request.json()
+        await asyncio.sleep(profile["image"])
+        item = ({"b64_json": "iVBORw0KGgo" * 1000} if body.get("response_format") == "b64_json"
+                else {"url": "http://127.0.0.1/mock.png"})
+        return JSONResponse({"data": [item], "usage": {"generated_images": 1}})
+
+    async def auc_submit(request: Request):
+        task_id = request.headers.get("X-Api-Request-Id", "")
+        auc_polls[task_id] = profile["auc_polls"]
+        return JSONResponse({}, headers={"X-Api-Status-Code": "20000000",
+                                         "X-Tt-Logid": "mock-logid"})
+
+    async def auc_query(request: Request):
+        task_id = request.headers.get("X-Api-Request-Id", "")
+        remaining = auc_polls.get(task_id, 0)
+        if remaining > 0:
+            auc_polls[task_id] = remaining - 1
+            return JSONResponse({}, headers={"X-Api-Status-Code": "20000001"})
+        auc_polls.pop(task_id, None)
+        return JSONResponse({"result": {"text": "模拟识别结果"}},
+                            headers={"X-Api-Status-Code": "20000000"})
+
+    async def visual(request: Request):
+        await asyncio.sleep(profile["cv"])
+        return JSONResponse({
+            "code": 10000, "message": "Success",
+            "data": {"image_urls": ["http://127.0.0.1/mock.png"], "binary_data_base64": []}
+        })
+
+    async def ping(request: Request):
+        return JSONResponse({"ok": True})
+
+    return Starlette(routes=[
+        Route("/chat", chat, methods=["POST"]),
+        Route("/images", images, methods=["POST"]),
+        Route("/auc/submit", auc_submit, methods=["POST"]),
+        Route("/auc/query", auc_query, methods=["POST"]),
+        Route("/", visual, methods=["POST"]),
+        Route("/ping", ping, methods=["GET"]),
+    ])
+
+
+def serve_mock(port: int, profile_name: str) -> None:
+    import uvicorn
+    uvicorn.run(build_mock_app(PROFILES[profile_name]), host="127.0.0.1", port=port,
+                log_level="warning")
+
+
+# ---------------------------------------------------------------- 压测场景
+
+def _txt2img(client: httpx.AsyncClient):
+    # seed=-1 跳过结果缓存, 每次都请求上游
+    return client.post("/api/v1/txt2img?size=1024x1024&response_format=url&seed=-1",
+                       json={"prompt": "一只猫"})
+
+
+SCENARIOS = {
+    "chat_stream": lambda client: client.stream(
+        "POST", "/api/v1/chat?model=doubao-seed-1.6&thinking=disabled", json=CHAT_BODY),
+    "chat_json": lambda client: client.post(
+        "/api/v1/chat?model=doubao-seed-1.6&thinking=disabled&stream=false", json=CHAT_BODY),
+    "txt2img": _txt2img,
+    "img2img": lambda client: client.post(
+        "/api/v1/img2img", json={"image_urls": ["http://127.0.0.1/mock.png"]}),
+    "out_painting": lambda client: client.post("/api/v1/out_painting", json={}),
+    "auc": lambda client: client.post(
+        "/api/v1/auc", files={"audio": ("bench.mp3", b"\x00" * 32000, "audio/mpeg")}),
+}
+
+
+async def _one_request(client: httpx.AsyncClient, scenario: str) -> Dict:
+    start = time.perf_counter()
+    ttft = None
+    if scenario == "chat_stream":
+        async with SCENARIOS[scenario](client) as response:
+            async for line in response.aiter_lines():
+                if ttft is None and line.startswith("data:") and '"content"' in line:
+                    ttft = time.perf_counter() - start
+            status = response.status_code
+            ok = status == 200 and ttft is not None
+    else:
+        response = await SCENARIOS[scenario](client)
+        status = response.status_code
+        # 出错时返回code为0的信封; /txt2img成功时直接返回结果, 没有code字段
+        ok = status == 200 and response.json().get("code", 1) != 0
+    return {"latency": time.perf_counter() - start, "ttft": ttft, "ok": ok, "status": status}
+
+
+class ProcessSampler:
+    """从/proc采样服务进程的CPU时间和RSS(非Linux时尝试psutil)"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_rss = 0
+        self._task: Optional[asyncio.Task] = None
+        self._clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self._clock_ticks
+        except OSError:
+            try:
+                import psutil # type: ignore
+                times = psutil.Process(self.pid).cpu_times()
+                return times.user + times.system
+            except Exception:
+                return None
+
+    def rss(self) -> Optional[int]:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            try:
+                import psutil # type: ignore
+                return psutil.Process(self.pid).memory_info().rss
+            except Exception:
+                return None
+        return None
+
+    async def _sample(self) -> None:
+        while True:
+            self.peak_rss = max(self.peak_rss, self.rss() or 0)
+            await asyncio.sleep(0.1)
+
+    def start(self) -> None:
+        self.peak_rss = self.rss() or 0
+        self._task = asyncio.create_task(self._sample())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+def _percentile(values: List[float], percentile: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percentile / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def run_scenario(base_url: str, scenario: str, concurrency: int, total: int,
+                       sampler: ProcessSampler) -> Dict:
+    results: List[Dict] = []
+    counter = iter(range(total))
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        for _ in counter:
+            try:
+                results.append(await _one_request(client, scenario))
+            except Exception as e:
+                results.append({"latency": 0.0, "ttft": None, "ok": False,
+                                "status": type(e).__name__})
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        # 预热, 避免把首次导入和建连算进结果
+        await _one_request(client, scenario)
+        cpu_start = sampler.cpu_seconds()
+        sampler.start()
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        await sampler.stop()
+        cpu_end = sampler.cpu_seconds()
+
+    latencies = [r["latency"] for r in results if r["ok"]]
+    ttfts = [r["ttft"] for r in results if r["ok"] and r["ttft"] is not None]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+
+    def ms(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        "scenario": scenario,
+        "requests": len(results),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": ms(_percentile(latencies, 50)),
+        "p95_ms": ms(_percentile(latencies, 95)),
+        "p99_ms": ms(_percentile(latencies, 99)),
+        "ttft_p50_ms": ms(_percentile(ttfts, 50)),
+        "ttft_p95_ms": ms(_percentile(ttfts, 95)),
+        "cpu_percent": None if cpu_start is None or cpu_end is None
+        else round((cpu_end - cpu_start) / elapsed * 100, 1),
+        "peak_rss_mb": round(sampler.peak_rss / 1024 / 1024, 1) if sampler.peak_rss else None,
+    }
+
+
+# ---------------------------------------------------------------- 进程管理
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process for {url} exited with {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def _service_env(mock_url: str, mock_port: int, extra_env: Dict[str, str]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.path.join(ROOT, "src"),
+        "LOG_LEVEL": "WARNING",
+        "DOUBAO_API_URL": f"{mock_url}/chat",
+        "DOUBAO_API_KEY": "bench",
+        "DOUBAO_TEXT_GENERATE_IMAGE_API_URL": f"{mock_url}/images",
+        "DOUBAO_TEXT_GENERATE_IMAGE_API_KEY": "bench",
+        "DOUBAO_AUC_API_SUBMIT_URL": f"{mock_url}/auc/submit",
+        "DOUBAO_AUC_API_QUERY_URL": f"{mock_url}/auc/query",
+        "VOLCENGINE_VISUAL_HOST": f"127.0.0.1:{mock_port}",
+        "VOLCENGINE_VISUAL_SCHEME": "http",
+        "VOLCEENGINE_ACCESS_KEY": "bench",
+        "VOLCEENGINE_SECRET_KEY": "bench",
+        "IMAGE_MIRROR_ENABLED": "false",
+        "USAGE_LEDGER_FILE": "",
+    })
+    env.update(extra_env)
+    return env
+
+
+def compare_baseline(results: List[Dict], baseline_path: str, tolerance: float) -> List[str]:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {item["scenario"]: item for item in json.load(f)}
+    failures = []
+    for result in results:
+        base = baseline.get(result["scenario"])
+        if not base:
+            continue
+        if base.get("p95_ms") and result["p95_ms"] and \
+                result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            failures.append(f"{result['scenario']}: p95 {result['p95_ms']} ms > "
+                            f"baseline {base['p95_ms']} ms")
+        if base.get("rps") and result["rps"] < base["rps"] * (1 - tolerance):
+            failures.append(f"{result['scenario']}: rps {result['rps']} < baseline {base['rps']}")
+    return failures
+
+
+def print_table(results: List[Dict]) -> None:
+    columns = ("scenario", "requests", "rps", "p50_ms", "p95_ms", "p99_ms",
+               "ttft_p50_ms", "ttft_p95_ms", "cpu_percent", "peak_rss_mb", "errors")
+    print("  ".join(f"{name:>12}" for name in columns))
+    for result in results:
+        cells = []
+        for name in columns:
+            value = result[name]
+            if name == "errors":
+                value = ",".join(f"{k}:{v}" for k, v in value.items()) or "-"
+            cells.append(f"{'-' if value is None else value!s:>12}")
+        print("  ".join(cells))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="fast")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="每个场景的请求数")
+    parser.add_argument("--env", action="append", default=[],
+                        help="传给服务进程的环境变量, 例如 --env ADMISSION_ENABLED=false")
+    parser.add_argument("--json", help="把结果写入JSON文件, 可作为之后的基线")
+    parser.add_argument("--baseline", help="与之前--json输出的结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--serve-mock", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_mock:
+        serve_mock(args.serve_mock, args.profile)
+        return 0
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {unknown}, choose from {list(SCENARIOS)}")
+
+    mock_port, service_port = _free_port(), _free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    service_url = f"http://127.0.0.1:{service_port}"
+    extra_env = dict(item.split("=", 1) for item in args.env)
+
+    mock = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve-mock", str(mock_port),
+         "--profile", args.profile], cwd=ROOT)
+    service = None
+    try:
+        _wait_ready(f"{mock_url}/ping", mock)
+        service = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "llm_pack_service.pack_service:app",
+             "--host", "127.0.0.1", "--port", str(service_port), "--log-level", "warning"],
+            cwd=ROOT, env=_service_env(mock_url, mock_port, extra_env))
+        _wait_ready(f"{service_url}/health", service)
+        sampler = ProcessSampler(service.pid)
+
+        results = []
+        for scenario in scenarios:
+            print(f"running {scenario} ({args.requests} requests, "
+                  f"concurrency {args.concurrency}, profile {args.profile})", flush=True)
+            results.append(asyncio.run(run_scenario(
+                service_url, scenario, args.concurrency, args.requests, sampler)))
+    finally:
+        for process in (service, mock):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=35)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        failures = compare_baseline(results, args.baseline, args.tolerance)
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())